@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def hungarian(cost):
+    """
+    Solve the assignment problem with the Hungarian algorithm, in O(n^2 m) with row and column potentials.
+
+    :param cost: array-like, n x m cost matrix
+    :return: list, (row, column) pairs of a minimum cost assignment, min(n, m) of them
+    """
+    cost = np.asarray(cost, dtype=float)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    if n == 0:
+        return []
+
+    # 1-based, column 0 is the virtual start of the augmenting paths
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    row_of = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+    for row in range(1, n + 1):
+        row_of[0] = row
+        column = 0
+        slack = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[column] = True
+            current = row_of[column]
+            free = ~used[1:]
+            reduced = cost[current - 1] - u[current] - v[1:]
+            better = free & (reduced < slack[1:])
+            slack[1:][better] = reduced[better]
+            way[1:][better] = column
+            candidates = np.where(free, slack[1:], np.inf)
+            following = int(np.argmin(candidates)) + 1
+            delta = candidates[following - 1]
+            u[row_of[used]] += delta
+            v[used] -= delta
+            slack[1:][free] -= delta
+            column = following
+            if row_of[column] == 0:
+                break
+        while column:
+            previous = way[column]
+            row_of[column] = row_of[previous]
+            column = previous
+
+    pairs = [(int(row_of[column]) - 1, column - 1) for column in range(1, m + 1) if row_of[column]]
+    if transposed:
+        pairs = [(column, row) for row, column in pairs]
+    return sorted(pairs)
+
+
+def best_assignment(scores, min_score=0.0):
+    """
+    Pair rows and columns so that the sum of their scores is the highest possible, each used at most once.
+
+    :param scores: array-like, n x m matrix of scores, higher is better
+    :param min_score: float, pairs scoring below it are left unassigned
+    :return: dict, row -> column
+    """
+    scores = np.asarray(scores, dtype=float)
+    if scores.size == 0:
+        return {}
+    # Pairs below the threshold are worth nothing, so they never displace a pair above it
+    weights = np.where(scores >= min_score, scores, 0.0)
+    return {row: column for row, column in hungarian(-weights) if weights[row, column] > 0}
@@ -0,0 +1,257 @@
+import argparse
+import glob
+import json
+import os
+import time
+from types import SimpleNamespace
+
+from decouple import config
+
+from clients import get_openai_client
+from retry import get_retry_policy
+from state import RUN_ID, atomic_write, file_lock, pid_alive, write_json
+from utils import OPENAI_SAMPLING, _update_tokens, say
+
+BATCH_DIR = "batches"
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_POLL_INTERVAL = config("OPENAI_BATCH_POLL_INTERVAL", default=60, cast=int)
+# Batch API requests cost half of the synchronous ones
+BATCH_PRICE_FACTOR = 0.5
+FAILED_STATUSES = ("failed", "expired", "cancelled")
+
+# Stage name -> the job of this process, whose files are named after the run so that concurrent runs of a
+# stage do not overwrite each other's files
+_jobs = {}
+
+
+def batch_request(custom_id, content, system_role=None, model='gpt-4o', json_mode=False):
+    """
+    Build one line of a Batch API input file, with the same body that utils.query_openai sends.
+
+    :param custom_id: str, the id used to map the response back to the request
+    :return: dict, the request line
+    """
+    if system_role is None:
+        system_role = "You are a helpful assistant."
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_role},
+                {"role": "user", "content": content},
+            ],
+            "response_format": {"type": "json_object"} if json_mode else {"type": "text"},
+            **OPENAI_SAMPLING,
+        },
+    }
+
+
+def _state_path(name):
+    return f"{BATCH_DIR}/{name}.json"
+
+
+def _job(name):
+    return _jobs.get(name, f"{name}-{RUN_ID}")
+
+
+def stage_jobs(name):
+    """
+    :param name: str, the name of the stage
+    :return: list, the jobs of the stage, including the one named after the stage alone by older versions
+    """
+    jobs = sorted(os.path.basename(path)[:-len(".json")] for path in glob.glob(f"{BATCH_DIR}/{glob.escape(name)}-*.json"))
+    return jobs + [name] if os.path.exists(_state_path(name)) else jobs
+
+
+def load_state(name):
+    try:
+        with open(_state_path(name), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def save_state(name, state):
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    write_json(_state_path(name), state, indent=4)
+
+
+def write_batch_file(name, requests):
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    path = f"{BATCH_DIR}/{name}_input.jsonl"
+
+    def write(file):
+        for request in requests:
+            file.write(json.dumps(request) + "\n")
+
+    atomic_write(path, write)
+    return path
+
+
+def claim_batch(name):
+    """
+    Find an unfinished batch of a stage to resume: the one of this run, else one whose process is gone. The batch
+    is claimed by recording the process in its state, so that concurrent runs do not resume the same one.
+
+    :param name: str, the name of the stage
+    :return: dict|None, the state of the batch
+    """
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    own = f"{name}-{RUN_ID}"
+    with file_lock(f"{BATCH_DIR}/{name}"):
+        for job in [own] + [j for j in stage_jobs(name) if j != own]:
+            state = load_state(job)
+            if not state or state["status"] in FAILED_STATUSES or state.get("ingested"):
+                continue
+            if job != own and state.get("pid") != os.getpid() and pid_alive(state.get("pid")):
+                continue
+            state["pid"] = os.getpid()
+            save_state(job, state)
+            _jobs[name] = job
+            return state
+    return None
+
+
+def submit_batch(name, requests):
+    """
+    Write the requests into a JSONL file and submit it to the Batch API. A batch of the same stage that was
+    already submitted and has not failed is resumed instead of submitted again, see claim_batch().
+
+    :param name: str, the name of the stage, e.g. "extract_pros"
+    :param requests: list, request lines from batch_request()
+    :return: dict, the state of the batch
+    """
+    state = claim_batch(name)
+    if state:
+        print(f"Resuming batch {_job(name)} ({state['batch_id']}, {state['status']})")
+        return state
+    if not requests:
+        return None
+
+    job = _jobs[name] = f"{name}-{RUN_ID}"
+    path = write_batch_file(job, requests)
+    if os.path.exists(f"{BATCH_DIR}/{job}_output.jsonl"):
+        os.remove(f"{BATCH_DIR}/{job}_output.jsonl")
+    client = get_openai_client()
+    retry = get_retry_policy("openai")
+    with open(path, "rb") as file:
+        # Bytes rather than the file object, a retried upload has to send the file from the start
+        input_file = retry.call(client.files.create, file=(os.path.basename(path), file.read()), purpose="batch")
+    batch = retry.call(client.batches.create, input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window="24h", metadata={"name": job})
+    state = {
+        "batch_id": batch.id,
+        "input_file_id": input_file.id,
+        "output_file_id": None,
+        "status": batch.status,
+        "requests": len(requests),
+        "created_at": time.time(),
+        "ingested": False,
+        "pid": os.getpid(),
+    }
+    save_state(job, state)
+    print(f"Submitted batch {job} ({batch.id}) with {len(requests)} requests")
+    return state
+
+
+def poll_batch(name, interval=BATCH_POLL_INTERVAL, wait=True):
+    """
+    Refresh the status of a submitted batch, optionally until it finishes.
+
+    :param name: str, the name of the stage
+    :param interval: int, seconds between status checks
+    :param wait: bool, keep polling until the batch is completed or has failed
+    :return: dict, the state of the batch
+    """
+    return _poll(_job(name), interval, wait)
+
+
+def _poll(name, interval=BATCH_POLL_INTERVAL, wait=True):
+    state = load_state(name)
+    client = get_openai_client()
+    while True:
+        batch = get_retry_policy("openai").call(client.batches.retrieve, state["batch_id"])
+        state["status"] = batch.status
+        state["output_file_id"] = batch.output_file_id
+        state["error_file_id"] = batch.error_file_id
+        save_state(name, state)
+        counts = batch.request_counts
+        say(f"Batch {name}: {batch.status}" + (f", {counts.completed}/{counts.total} done" if counts else ""))
+        if batch.status == "completed" or batch.status in FAILED_STATUSES or not wait:
+            return state
+        time.sleep(interval)
+
+
+def batch_results(name):
+    """
+    Download the output of a completed batch and account its token usage.
+
+    :param name: str, the name of the stage
+    :return: dict, custom_id -> response content, None for requests that failed
+    """
+    job = _job(name)
+    state = load_state(job)
+    if state["status"] != "completed":
+        raise Exception(f"Batch {job} is {state['status']}, it cannot be ingested")
+    path = f"{BATCH_DIR}/{job}_output.jsonl"
+    if not os.path.exists(path):
+        client = get_openai_client()
+        content = get_retry_policy("openai").call(client.files.content, state["output_file_id"]).content if state["output_file_id"] else b""
+        # Written atomically, an interrupted download must not pass for the output on the next run
+        atomic_write(path, lambda file: file.write(content), mode="wb")
+
+    results = {}
+    with open(path, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") != 200:
+                say(f"Batch request {item['custom_id']} failed: {item.get('error') or response}")
+                results[item["custom_id"]] = None
+                continue
+            body = response["body"]
+            if not state.get("accounted"):
+                # The custom ids of the pipeline start with the kind of request and the trial
+                trial = item["custom_id"].split("|")[1] if "|" in item["custom_id"] else None
+                _update_tokens(SimpleNamespace(**body["usage"]), body["model"], price_factor=BATCH_PRICE_FACTOR, stage=name, trial=trial)
+            results[item["custom_id"]] = body["choices"][0]["message"]["content"]
+    state["accounted"] = True
+    save_state(job, state)
+    return results
+
+
+def mark_ingested(name):
+    job = _job(name)
+    state = load_state(job)
+    if state is None:
+        return
+    state["ingested"] = True
+    save_state(job, state)
+
+
+def run_batch(name, requests, interval=BATCH_POLL_INTERVAL):
+    """
+    Submit or resume a batch, wait for it and return its results.
+
+    :return: dict|None, custom_id -> response content or None if there was nothing to do or the batch failed
+    """
+    state = submit_batch(name, requests)
+    if state is None:
+        return None
+    state = poll_batch(name, interval)
+    if state["status"] != "completed":
+        print(f"Batch {_job(name)} ended as {state['status']}, it will be resubmitted on the next run")
+        return None
+    return batch_results(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect Batch API jobs of the pipeline")
+    parser.add_argument("name", help="the name of the stage, e.g. extract_pros")
+    args = parser.parse_args()
+    for job in stage_jobs(args.name):
+        print(json.dumps({job: _poll(job, wait=False)}, indent=4))
@@ -0,0 +1,149 @@
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the OpenAI Files and Batch APIs. Point the pipeline at it with
+# OPENAI_BASE_URL=http://127.0.0.1:8765/v1 and OPENAI_BATCH_MODE=True.
+
+files = {}
+batches = {}
+_lock = threading.Lock()
+
+
+def stub_answer(content):
+    """
+    Answer a prompt of the pipeline with a valid but uninformative JSON object.
+
+    :param content: str, the user prompt
+    :return: str, the answer
+    """
+    if "key 'scores'" in content:
+        return json.dumps({"scores": []})
+    if "'match_number'" in content:
+        return json.dumps({"match_number": -1, "has_changed": False})
+    if "key 'outcomes'" in content:
+        numbers = [int(n) for n in re.findall(r'"number": (\d+)', content)]
+        return json.dumps({"outcomes": [{"number": n, "is_pro": False, "reason": "Stub answer", "instrument": None} for n in numbers]})
+    return json.dumps({"is_pro": False, "reason": "Stub answer", "instrument": None})
+
+
+def run_request(line):
+    request = json.loads(line)
+    content = request["body"]["messages"][-1]["content"]
+    answer = stub_answer(content)
+    usage = {"prompt_tokens": len(content) // 4, "completion_tokens": len(answer) // 4}
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    return {
+        "id": f"batch_req_{uuid.uuid4().hex}",
+        "custom_id": request["custom_id"],
+        "response": {
+            "status_code": 200,
+            "request_id": uuid.uuid4().hex,
+            "body": {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["body"]["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop", "logprobs": None}],
+                "usage": usage,
+            },
+        },
+        "error": None,
+    }
+
+
+def file_object(file_id):
+    f = files[file_id]
+    return {"id": file_id, "object": "file", "bytes": len(f["content"]), "created_at": f["created_at"], "filename": f["filename"], "purpose": f["purpose"], "status": "processed"}
+
+
+def store_file(content, filename, purpose):
+    file_id = f"file-{uuid.uuid4().hex}"
+    files[file_id] = {"content": content, "filename": filename, "purpose": purpose, "created_at": int(time.time())}
+    return file_id
+
+
+def batch_object(batch_id, delay):
+    batch = batches[batch_id]
+    # The batch goes through the statuses of the real service so that polling is exercised
+    if batch["status"] != "cancelled" and time.time() - batch["created_at"] >= delay and batch["output_file_id"] is None:
+        lines = [json.dumps(run_request(line)) for line in files[batch["input_file_id"]]["content"].decode().splitlines() if line.strip()]
+        batch["output_file_id"] = store_file("\n".join(lines).encode() + b"\n", f"{batch_id}_output.jsonl", "batch_output")
+        batch["status"] = "completed"
+        batch["request_counts"] = {"total": len(lines), "completed": len(lines), "failed": 0}
+    elif batch["status"] == "validating":
+        batch["status"] = "in_progress"
+    return {"id": batch_id, "object": "batch", "errors": None, "error_file_id": None, **batch}
+
+
+class Handler(BaseHTTPRequestHandler):
+    delay = 0
+
+    def _send(self, status, body, content_type="application/json"):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        with _lock:
+            if self.path == "/v1/files":
+                message = BytesParser(policy=policy.default).parsebytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + self._body()
+                )
+                fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+                file_id = store_file(fields["file"].get_payload(decode=True), fields["file"].get_filename(), fields["purpose"].get_content().strip())
+                return self._send(200, file_object(file_id))
+            if self.path == "/v1/batches":
+                request = json.loads(self._body())
+                batch_id = f"batch_{uuid.uuid4().hex}"
+                batches[batch_id] = {
+                    "endpoint": request["endpoint"],
+                    "input_file_id": request["input_file_id"],
+                    "completion_window": request["completion_window"],
+                    "metadata": request.get("metadata"),
+                    "status": "validating",
+                    "output_file_id": None,
+                    "created_at": int(time.time()),
+                    "request_counts": {"total": 0, "completed": 0, "failed": 0},
+                }
+                return self._send(200, batch_object(batch_id, self.delay))
+            match = re.fullmatch(r"/v1/batches/([^/]+)/cancel", self.path)
+            if match and match.group(1) in batches:
+                batches[match.group(1)]["status"] = "cancelled"
+                return self._send(200, batch_object(match.group(1), self.delay))
+        self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_GET(self):
+        with _lock:
+            match = re.fullmatch(r"/v1/batches/([^/]+)", self.path)
+            if match and match.group(1) in batches:
+                return self._send(200, batch_object(match.group(1), self.delay))
+            match = re.fullmatch(r"/v1/files/([^/]+)/content", self.path)
+            if match and match.group(1) in files:
+                return self._send(200, files[match.group(1)]["content"], "application/octet-stream")
+            match = re.fullmatch(r"/v1/files/([^/]+)", self.path)
+            if match and match.group(1) in files:
+                return self._send(200, file_object(match.group(1)))
+        self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI Batch API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=5, help="seconds before a batch completes")
+    args = parser.parse_args()
+    Handler.delay = args.delay
+    print(f"Serving the Batch API stub on http://127.0.0.1:{args.port}/v1")
+    ThreadingHTTPServer(("127.0.0.1", args.port), Handler).serve_forever()
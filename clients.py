@@ -0,0 +1,117 @@
+import asyncio
+import importlib.util
+import os
+import threading
+import weakref
+
+import httpx
+import replicate
+from decouple import config
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+OPENAI_ORGANIZATION = 'org-OjCSzLcscYwYrWwsc7EWJZs7'
+OPENAI_PROJECT = 'proj_LL7UZDSKgr42Lp0P7QnO30i1'
+# Point the OpenAI clients elsewhere, e.g. to batch_stub_server.py
+OPENAI_BASE_URL = config('OPENAI_BASE_URL', default=None)
+# Keep-alive connections per provider and process
+MAX_CONNECTIONS = config('PROVIDER_MAX_CONNECTIONS', default=32, cast=int)
+# HTTP/2 needs the h2 package of requirements.txt, without it the clients fall back to HTTP/1.1 keep-alive
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+_clients = {}
+# Async clients are bound to the event loop that opened their connections, they are forgotten with their loop
+_loop_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def _limits(max_connections=MAX_CONNECTIONS):
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+
+
+def _shared(key, factory):
+    # Clients are kept per process, a forked worker builds its own connection pools
+    key = (os.getpid(),) + key
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def _shared_async(key, factory):
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _loop_clients.setdefault(loop, {})
+        if key not in clients:
+            clients[key] = factory()
+        return clients[key]
+
+
+def get_openai_client():
+    """
+    Return the OpenAI client of the process. It is thread-safe and keeps its connections alive between calls.
+
+    :return: OpenAI, the shared client
+    """
+    return _shared(("openai",), lambda: OpenAI(
+        organization=OPENAI_ORGANIZATION,
+        project=OPENAI_PROJECT,
+        api_key=config('OPENAI_API_KEY'),
+        base_url=OPENAI_BASE_URL,
+        # Retries are done by retry.py, which also honors Retry-After and the retry budget
+        max_retries=0,
+        http_client=DefaultHttpxClient(http2=HTTP2, limits=_limits()),
+    ))
+
+
+def get_async_openai_client():
+    """
+    Return the AsyncOpenAI client of the running event loop.
+
+    :return: AsyncOpenAI, the shared client
+    """
+    return _shared_async(("async_openai",), lambda: AsyncOpenAI(
+        organization=OPENAI_ORGANIZATION,
+        project=OPENAI_PROJECT,
+        api_key=config('OPENAI_API_KEY'),
+        base_url=OPENAI_BASE_URL,
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(http2=HTTP2, limits=_limits()),
+    ))
+
+
+def get_replicate_client():
+    return _shared(("replicate",), lambda: replicate.Client(api_token=config('REPLICATE_API_KEY')))
+
+
+def get_http_client(name, proxy=None, max_connections=MAX_CONNECTIONS, **kwargs):
+    """
+    Return a pooled HTTP client for plain HTTP APIs.
+
+    :param name: str, the service using the client, e.g. "registry" or "gemini"
+    :param proxy: str, the proxy URL, every proxy gets its own client
+    :param max_connections: int, the size of the connection pool, only used when the client is created
+    :param kwargs: further httpx.Client arguments, only used when the client is created
+    :return: httpx.Client, the shared client
+    """
+    return _shared(("http", name, proxy), lambda: httpx.Client(http2=HTTP2, proxy=proxy, limits=_limits(max_connections), **kwargs))
+
+
+def get_async_http_client(name, proxy=None, max_connections=MAX_CONNECTIONS, **kwargs):
+    return _shared_async(("async_http", name, proxy), lambda: httpx.AsyncClient(http2=HTTP2, proxy=proxy, limits=_limits(max_connections), **kwargs))
+
+
+def drop_http_client(name, proxy=None):
+    """
+    Close and forget the client of a proxy that stopped working.
+    """
+    with _clients_lock:
+        client = _clients.pop((os.getpid(), "http", name, proxy), None)
+    if client is not None:
+        client.close()
+
+
+async def drop_async_http_client(name, proxy=None):
+    with _clients_lock:
+        client = _loop_clients.get(asyncio.get_running_loop(), {}).pop(("async_http", name, proxy), None)
+    if client is not None:
+        await client.aclose()
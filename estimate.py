@@ -0,0 +1,164 @@
+import argparse
+
+import pandas as pd
+
+from batch_jobs import BATCH_PRICE_FACTOR
+from llm_cache import LLM_CACHE, LLM_CACHE_BYPASS_STAGES, cache_key, has_cached_response
+from main import CLASSIFY_BATCHED, CLASSIFY_WORKERS, MATCH_ASSIGNMENT, outcome_chunks, prepare_trial, submission_outcomes
+from prematch import PREMATCH, prematch
+from prompts import SYSTEM_ROLE, match_matrix_prompt, match_prompt, pro_batch_prompt, pro_prompt
+from rate_limit import OPENAI_RPM, OPENAI_TPM
+from registry import normalize_registrations
+from results_store import SOURCES, get_ai_outcomes, matched_unique_ids
+from tokens import count_tokens, count_tokens_batch
+from trial_cache import cached_at, load_trial
+from usage import price
+from utils import COMPLETION_TOKENS_ESTIMATE, sampling_params
+
+MODEL = "gpt-4o"
+# Share of the registry outcomes expected to be PROs, for trials that are not classified yet
+PRO_RATIO = 0.3
+# Seconds a request takes when the rate limits are not the bottleneck
+REQUEST_LATENCY = 3.0
+# Completion tokens of a classification answer per outcome and of a matching answer
+CLASSIFY_COMPLETION_TOKENS = 80
+MATCH_COMPLETION_TOKENS = 20
+
+
+def build_prompts(file_path, limit=False, batched=CLASSIFY_BATCHED, pro_ratio=PRO_RATIO, assignment=MATCH_ASSIGNMENT):
+    """
+    Build the prompts a run over the workbook would send, without sending them.
+
+    Trials that are not classified yet are matched with all their registry outcomes, weighted by pro_ratio.
+    Matching prompts are built against all outcomes of the source, a real run leaves out the ones already
+    matched, so they are slightly overestimated. Registry outcomes the pre-matcher resolves get no prompt.
+
+    :param file_path: str, the workbook
+    :param limit: int, only the first registrations, like get_trials_data_from_xlsx
+    :param batched: bool, whether outcomes are classified in batched prompts
+    :param pro_ratio: float, the expected share of PRO outcomes
+    :param assignment: bool, whether outcomes are matched with one scoring prompt per trial and source
+    :return: tuple, stage -> list of (prompt, weight, completion tokens), the number of registrations, the
+        number of registrations without a cached record and the number of matching prompts resolved locally
+    """
+    df = pd.read_excel(file_path)
+    df["nct_id"] = normalize_registrations(df['Registrationnumber'])
+    df = df[df["nct_id"].notna() & ~df['Unique.ID'].astype(str).isin(matched_unique_ids())]
+    registrations = df.groupby("nct_id", sort=False)['Unique.ID'].agg(list)
+    if limit:
+        registrations = registrations.head(limit)
+    submissions = submission_outcomes(df, {str(u) for unique_ids in registrations for u in unique_ids})
+
+    prompts = {"extract_pros": [], "match_results": []}
+    missing = 0
+    resolved = 0
+    for nct_id, unique_ids in registrations.items():
+        if cached_at(nct_id) is None:
+            missing += 1
+            continue
+        # A dry run, legacy records are read without being migrated
+        trial = prepare_trial(nct_id, unique_ids, migrate=False)
+        if trial is not None and trial["classification"] is None:
+            for chunk in outcome_chunks(trial, batched):
+                content = pro_batch_prompt(trial["title"], chunk) if batched else pro_prompt(trial["title"], chunk[0][1])
+                prompts["extract_pros"].append((content, 1, CLASSIFY_COMPLETION_TOKENS * len(chunk)))
+
+        title = load_trial(nct_id, migrate=False).get("protocolSection", {}).get("identificationModule", {}).get("briefTitle")
+        for unique_id in unique_ids:
+            outcomes_ai = get_ai_outcomes(unique_id)
+            if outcomes_ai is not None:
+                candidates = [(o, 1) for o in outcomes_ai if o["is_pro"]]
+            elif trial is not None:
+                candidates = [({"number": i + 1, "outcome": o, "instrument": None, "is_pro": True}, pro_ratio) for i, o in enumerate(trial["outcomes"])]
+            else:
+                continue
+            data = {"title": title, "outcomes_ethical": [], "outcomes_publication": [], **submissions.get(str(unique_id), {})}
+            if assignment:
+                data["outcomes_ai"] = [o for o, _ in candidates]
+                pros = sum(weight for _, weight in candidates)
+                for source in SOURCES:
+                    if candidates and data[f"outcomes_{source}"]:
+                        prompts["match_results"].append((match_matrix_prompt(data, source), 1, MATCH_COMPLETION_TOKENS * pros))
+                continue
+            for source in SOURCES:
+                for outcome_ai, weight in candidates:
+                    # Pairs the pre-matcher resolves are not sent to the model
+                    if PREMATCH and prematch(data, outcome_ai, source, count=False) is not None:
+                        resolved += 1
+                        continue
+                    prompts["match_results"].append((match_prompt(data, outcome_ai, source), weight, MATCH_COMPLETION_TOKENS))
+    return prompts, len(registrations), missing, resolved
+
+
+def project(prompts, registrations=0, missing=0, concurrency=CLASSIFY_WORKERS, rpm=OPENAI_RPM, tpm=OPENAI_TPM,
+            latency=REQUEST_LATENCY, batch_api=False):
+    """
+    Project the requests, tokens, dollars and wall time of the prompts from build_prompts().
+
+    :return: dict, stage -> projection, with a "total" entry
+    """
+    system_tokens = count_tokens(SYSTEM_ROLE)
+    prompt_price, completion_price = price(MODEL)
+    price_factor = BATCH_PRICE_FACTOR if batch_api else 1.0
+    # Registrations without a cached record are assumed to look like the average cached one
+    scale = registrations / (registrations - missing) if missing and registrations > missing else 1
+
+    projection = {}
+    for stage, items in prompts.items():
+        counts = count_tokens_batch([content for content, _, _ in items])
+        row = {"prompts": len(items), "cached": 0, "requests": 0.0, "prompt_tokens": 0.0, "completion_tokens": 0.0, "reserved_tokens": 0.0}
+        for (content, weight, completion), tokens in zip(items, counts):
+            key = cache_key(MODEL, SYSTEM_ROLE, content, True, sampling_params(MODEL))
+            if LLM_CACHE and stage not in LLM_CACHE_BYPASS_STAGES and has_cached_response(key):
+                row["cached"] += 1
+                continue
+            row["requests"] += weight
+            row["prompt_tokens"] += weight * (tokens + system_tokens)
+            row["completion_tokens"] += weight * completion
+            # The rate limiter reserves a fixed completion budget per request
+            row["reserved_tokens"] += weight * (tokens + system_tokens + COMPLETION_TOKENS_ESTIMATE)
+        for key in ("requests", "prompt_tokens", "completion_tokens", "reserved_tokens"):
+            row[key] *= scale
+        row["cost"] = (row["prompt_tokens"] * prompt_price + row["completion_tokens"] * completion_price) / 1000000 * price_factor
+        projection[stage] = row
+
+    total = {key: sum(row[key] for row in projection.values()) for key in next(iter(projection.values()))}
+    requests_per_minute = min(rpm, concurrency * 60 / latency)
+    total["minutes"] = max(total["requests"] / requests_per_minute, total["reserved_tokens"] / tpm) if total["requests"] else 0
+    projection["total"] = total
+    return projection
+
+
+def print_projection(projection, registrations, missing, batch_api=False, resolved=0):
+    print(f"{registrations} registrations to process" + (f", {missing} without a cached record were extrapolated" if missing else ""))
+    if resolved:
+        print(f"{resolved} matching prompts resolved locally by the pre-matcher")
+    for stage, row in projection.items():
+        print(
+            f"{stage}: {row['prompts']} prompts ({row['cached']} cached), {row['requests']:.0f} requests, "
+            f"{row['prompt_tokens']:,.0f} prompt + {row['completion_tokens']:,.0f} completion tokens, {row['cost']:.2f}$"
+        )
+    if batch_api:
+        print("Wall time: up to 24 h per Batch API job")
+    else:
+        minutes = projection["total"]["minutes"]
+        print(f"Wall time: about {minutes / 60:.1f} h" if minutes >= 90 else f"Wall time: about {minutes:.0f} min")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate the requests, cost and duration of a run without calling any model")
+    parser.add_argument("file", nargs="?", default="ASPIRE_2016_OSKARI.xlsx", help="the workbook")
+    parser.add_argument("--limit", type=int, default=False, help="only the first registrations")
+    parser.add_argument("--batched", action="store_true", default=CLASSIFY_BATCHED, help="classify outcomes in batched prompts")
+    parser.add_argument("--batch-api", action="store_true", help="price the run at the Batch API discount")
+    parser.add_argument("--concurrency", type=int, default=CLASSIFY_WORKERS, help="requests in flight")
+    parser.add_argument("--rpm", type=int, default=OPENAI_RPM, help="requests per minute allowed")
+    parser.add_argument("--tpm", type=int, default=OPENAI_TPM, help="tokens per minute allowed")
+    parser.add_argument("--latency", type=float, default=REQUEST_LATENCY, help="seconds per request")
+    parser.add_argument("--assignment", action="store_true", default=MATCH_ASSIGNMENT, help="match with one scoring prompt per trial and source")
+    parser.add_argument("--pro-ratio", type=float, default=PRO_RATIO, help="expected share of PRO outcomes in unclassified trials")
+    args = parser.parse_args()
+
+    prompts, registrations, missing, resolved = build_prompts(args.file, args.limit, args.batched, args.pro_ratio, args.assignment)
+    projection = project(prompts, registrations, missing, args.concurrency, args.rpm, args.tpm, args.latency, args.batch_api)
+    print_projection(projection, registrations, missing, args.batch_api, resolved)
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import math
+
+from prompts import MATCH_PROMPT, SYSTEM_ROLE, match_matrix_prompt, pro_batch_prompt, pro_prompt
+from results_store import classified_unique_ids, load_results, matched_unique_ids, save_stage_digest, stage_digests
+from trial_cache import load_trial
+
+
+def digest(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _submission_key(outcome):
+    # Outcomes read from the workbook and from the store differ in the types of their empty cells
+    def clean(value):
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return None
+        return str(value)
+    return [int(outcome["number"]), clean(outcome["name"]), clean(outcome["instrument"]), bool(outcome["is_primary"])]
+
+
+def classify_digest(record, model="gpt-4o"):
+    """
+    Digest the inputs of the PRO classification of a registration: the registry outcomes and title, the
+    prompt templates and the model.
+
+    :param record: dict, the study record
+    :return: str, the digest
+    """
+    protocol = record.get("protocolSection", {})
+    return digest(
+        protocol.get("identificationModule", {}).get("briefTitle"),
+        protocol.get("outcomesModule"),
+        SYSTEM_ROLE,
+        pro_prompt("", ""),
+        pro_batch_prompt("", []),
+        model,
+    )
+
+
+def match_digest(data, assignment=False, model="gpt-4o"):
+    """
+    Digest the inputs of the matching of a trial: the classified registry outcomes, the outcomes of its workbook
+    row, the prompt template of the matching mode and the model.
+
+    :param data: dict, the pro_results.json entry of the trial
+    :param assignment: bool, whether the trial is matched with the global assignment
+    :return: str, the digest
+    """
+    template = match_matrix_prompt({"title": "", "outcomes_ai": [], "outcomes_ethical": []}, "ethical") if assignment else MATCH_PROMPT
+    return digest(
+        data.get("title"),
+        data.get("outcomes_ai"),
+        [_submission_key(o) for o in data.get("outcomes_ethical", [])],
+        [_submission_key(o) for o in data.get("outcomes_publication", [])],
+        SYSTEM_ROLE,
+        template,
+        model,
+    )
+
+
+def changed_classifications(registrations, adopt=True):
+    """
+    Find the classified workbook rows whose registry record or classification prompt changed since they were
+    classified. Rows classified before digests were recorded have nothing to compare with, their current digest
+    is adopted as the reference.
+
+    :param registrations: iterable, (NCT id, Unique.IDs) pairs
+    :param adopt: bool, record the digest of rows without one
+    :return: list, the Unique.IDs to classify again
+    """
+    stored = stage_digests("extract_pros")
+    classified = classified_unique_ids()
+    changed = []
+    for nct_id, unique_ids in registrations:
+        unique_ids = [str(u) for u in unique_ids if str(u) in classified]
+        record = load_trial(nct_id) if unique_ids else None
+        if record is None:
+            continue
+        current = classify_digest(record)
+        changed += [u for u in unique_ids if stored.get(u, current) != current]
+        if adopt:
+            save_stage_digest([u for u in unique_ids if u not in stored], "extract_pros", current)
+    return changed
+
+
+def changed_matchings(unique_ids=None, assignment=False, adopt=True, submissions=None):
+    """
+    Find the matched trials whose classified outcomes, workbook outcomes or matching prompt changed since they
+    were matched. Like in changed_classifications, trials without a digest adopt the current one.
+
+    :param unique_ids: iterable, only check these trials, all matched trials by default
+    :param assignment: bool, whether trials are matched with the global assignment
+    :param adopt: bool, record the digest of trials without one
+    :param submissions: dict, Unique.ID -> workbook outcomes read now, instead of the ones in the store
+    :return: list, the Unique.IDs to match again
+    """
+    stored = stage_digests("match_results")
+    matched = matched_unique_ids()
+    changed = []
+    for unique_id in sorted(matched if unique_ids is None else {str(u) for u in unique_ids} & matched):
+        data = load_results(unique_id)
+        if submissions and unique_id in submissions:
+            data = {**data, **submissions[unique_id]}
+        current = match_digest(data, assignment)
+        if unique_id not in stored:
+            if adopt:
+                save_stage_digest([unique_id], "match_results", current)
+        elif stored[unique_id] != current:
+            changed.append(unique_id)
+    return changed
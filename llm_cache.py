@@ -0,0 +1,174 @@
+import argparse
+import hashlib
+import json
+import threading
+import time
+
+from decouple import Csv, config
+from peewee import CharField, FloatField, IntegerField, Model, SqliteDatabase, TextField, fn
+
+LLM_CACHE = config("LLM_CACHE", default=True, cast=bool)
+LLM_CACHE_DB = config("LLM_CACHE_DB", default="llm_cache.sqlite")
+# Seconds a cached response is kept, 0 keeps them forever
+LLM_CACHE_MAX_AGE = config("LLM_CACHE_MAX_AGE", default=180 * 24 * 3600, cast=int)
+# Total size of the cached responses, the least recently used ones are evicted first. 0 means no limit
+LLM_CACHE_MAX_BYTES = config("LLM_CACHE_MAX_BYTES", default=1024 ** 3, cast=int)
+# Stages whose prompts always go to the model, their fresh responses are still stored
+LLM_CACHE_BYPASS_STAGES = config("LLM_CACHE_BYPASS_STAGES", default="", cast=Csv())
+EVICT_EVERY = 500
+
+cache_db = SqliteDatabase(None)
+_cache_lock = threading.Lock()
+stats = {"hits": 0, "misses": 0, "writes": 0}
+
+
+class CachedResponse(Model):
+    key = CharField(primary_key=True)
+    model = CharField()
+    stage = CharField(null=True, index=True)
+    response = TextField()
+    size = IntegerField()
+    created_at = FloatField(index=True)
+    accessed_at = FloatField(index=True)
+
+    class Meta:
+        database = cache_db
+        table_name = "llm_cache"
+
+
+def open_cache(path=LLM_CACHE_DB):
+    with _cache_lock:
+        if cache_db.database != path:
+            cache_db.init(path, pragmas={"journal_mode": "wal", "synchronous": "normal"})
+            cache_db.create_tables([CachedResponse])
+    return cache_db
+
+
+def cache_key(model, system_role, content, json_mode, sampling):
+    """
+    Hash everything that determines the model's answer.
+
+    :return: str, the sha256 hex digest of the request
+    """
+    payload = json.dumps([model, system_role, content, json_mode, sampling], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _count(name):
+    with _cache_lock:
+        stats[name] += 1
+        return stats[name]
+
+
+def get_cached_response(key, max_age=LLM_CACHE_MAX_AGE):
+    """
+    Look up a cached response.
+
+    :param key: str, the cache key from cache_key()
+    :param max_age: int, ignore responses older than this many seconds, 0 for no limit
+    :return: str|None, the response or None on a miss
+    """
+    open_cache()
+    entry = CachedResponse.get_or_none(CachedResponse.key == key)
+    now = time.time()
+    if entry is None or (max_age and now - entry.created_at > max_age):
+        _count("misses")
+        return None
+    CachedResponse.update(accessed_at=now).where(CachedResponse.key == key).execute()
+    _count("hits")
+    return entry.response
+
+
+def has_cached_response(key, max_age=LLM_CACHE_MAX_AGE):
+    """
+    Check for a cached response without counting a lookup or touching its access time.
+    """
+    open_cache()
+    entry = CachedResponse.select(CachedResponse.created_at).where(CachedResponse.key == key).first()
+    return entry is not None and not (max_age and time.time() - entry.created_at > max_age)
+
+
+def put_cached_response(key, response, model, stage=None):
+    open_cache()
+    now = time.time()
+    CachedResponse.insert(
+        key=key, model=model, stage=stage, response=response, size=len(response.encode("utf-8")), created_at=now, accessed_at=now
+    ).on_conflict_replace().execute()
+    if _count("writes") % EVICT_EVERY == 0:
+        evict()
+
+
+def evict(max_age=LLM_CACHE_MAX_AGE, max_bytes=LLM_CACHE_MAX_BYTES):
+    """
+    Drop responses older than max_age and then the least recently used ones until the cache fits in max_bytes.
+
+    :return: int, the number of evicted responses
+    """
+    open_cache()
+    evicted = 0
+    if max_age:
+        evicted += CachedResponse.delete().where(CachedResponse.created_at < time.time() - max_age).execute()
+    if max_bytes:
+        total = CachedResponse.select(fn.COALESCE(fn.SUM(CachedResponse.size), 0)).scalar()
+        if total > max_bytes:
+            keys = []
+            for entry in CachedResponse.select(CachedResponse.key, CachedResponse.size).order_by(CachedResponse.accessed_at):
+                if total <= max_bytes:
+                    break
+                keys.append(entry.key)
+                total -= entry.size
+            with cache_db.atomic():
+                for i in range(0, len(keys), 500):
+                    evicted += CachedResponse.delete().where(CachedResponse.key.in_(keys[i:i + 500])).execute()
+    return evicted
+
+
+def delete_cached_response(key):
+    open_cache()
+    CachedResponse.delete().where(CachedResponse.key == key).execute()
+
+
+def invalidate(stage=None, model=None):
+    """
+    Delete cached responses, e.g. after a prompt change in one stage.
+
+    :param stage: str, only delete the responses of this stage
+    :param model: str, only delete the responses of this model
+    :return: int, the number of deleted responses
+    """
+    open_cache()
+    query = CachedResponse.delete()
+    if stage:
+        query = query.where(CachedResponse.stage == stage)
+    if model:
+        query = query.where(CachedResponse.model == model)
+    return query.execute()
+
+
+def cache_report():
+    lookups = stats["hits"] + stats["misses"]
+    rate = f"{stats['hits'] / lookups * 100:.0f}%" if lookups else "n/a"
+    out = f"LLM cache: {stats['hits']} hits, {stats['misses']} misses (hit rate {rate}), {stats['writes']} new responses stored."
+    print(out)
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the LLM response cache")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="print the size of the cache per stage")
+    commands.add_parser("evict", help="apply the age and size limits")
+    invalidate_parser = commands.add_parser("invalidate", help="delete cached responses")
+    invalidate_parser.add_argument("--stage")
+    invalidate_parser.add_argument("--model")
+    args = parser.parse_args()
+
+    open_cache()
+    if args.command == "stats":
+        query = CachedResponse.select(CachedResponse.stage, fn.COUNT(CachedResponse.key).alias("count"), fn.SUM(CachedResponse.size).alias("size")).group_by(CachedResponse.stage)
+        for row in query:
+            print(f"{row.stage or '-'}: {row.count} responses, {row.size / 1024 ** 2:.1f} MB")
+    elif args.command == "evict":
+        print("Evicted", evict(), "responses")
+    else:
+        print("Deleted", invalidate(args.stage, args.model), "responses")
@@ -1,84 +1,108 @@
 import json
 import math
-import requests
-from utils import ask_ai, finish_run, start_run
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import copy_context
+import httpx
+import numpy as np
+from decouple import config
+from batch_jobs import batch_request, mark_ingested, run_batch
+from registry import FETCH_MODE, FETCH_WORKERS, REGISTRY_OFFLINE, fetch_trial, fetch_trials, fresh_trials, load_offline_trial, normalize_registrations, pick_nct_id
+from incremental import changed_classifications, changed_matchings, classify_digest, digest, match_digest
+from prematch import PREMATCH, prematch, prematch_report
+from assignment import best_assignment
+from prompts import SYSTEM_ROLE, match_matrix_prompt, match_prompt, pro_batch_prompt, pro_prompt
+from results_store import SOURCES, classified_unique_ids, export_json, get_ai_outcomes, import_legacy_json, invalidate, known_unique_ids, matched_unique_ids, pending_matches, save_ai_outcomes, save_matching, save_submission_outcomes
+from state import atomic_write, write_json
+from tokens import count_tokens_batch
+from trial_cache import load_trial, trial_path
+from usage import usage_context
+from utils import ask_ai, count_tokens, finish_run, say, start_run
 import pandas as pd
 import traceback
 import time
 
+# Concurrent outcome classification requests, paced by the OPENAI_RPM and OPENAI_TPM budgets
+CLASSIFY_WORKERS = config("CLASSIFY_WORKERS", default=16, cast=int)
+# Classify a chunk of outcomes of a trial per request, chunks are limited to CLASSIFY_BATCH_TOKENS prompt tokens
+CLASSIFY_BATCHED = config("CLASSIFY_BATCHED", default=False, cast=bool)
+CLASSIFY_BATCH_TOKENS = config("CLASSIFY_BATCH_TOKENS", default=6000, cast=int)
+# Send the classification and matching prompts through the OpenAI Batch API, for overnight runs
+OPENAI_BATCH_MODE = config("OPENAI_BATCH_MODE", default=False, cast=bool)
+# Match all registry PRO outcomes of a trial at once: one scoring prompt per source, then the best overall assignment
+MATCH_ASSIGNMENT = config("MATCH_ASSIGNMENT", default=False, cast=bool)
+# Scores below it are not considered a match by the assignment
+MATCH_MIN_SCORE = config("MATCH_MIN_SCORE", default=0.5, cast=float)
+# Concurrent matchings, each matches one trial against one source
+MATCH_WORKERS = config("MATCH_WORKERS", default=8, cast=int)
+# Classify and match again the trials whose registry record, workbook row, prompt or model changed
+INCREMENTAL = config("INCREMENTAL", default=True, cast=bool)
+
 trials_processed = 0
 matches_processed = 0
+# The counters are increased from the classification and matching worker threads
+counters_lock = threading.Lock()
 
 
 def get_trial_data(trial_id):
-    try:
-        # Here could be ; and remember to strip the spaces
-        trial_id = trial_id.replace(";", ",")
-        trial_id = trial_id.replace("_x000D_", ",")
-        trial_id = trial_id.replace(" ", ",")
-        trial_id = trial_id.replace("\n", ",")
-        trial_id = trial_id.replace("\t", ",")
-        trial_id = trial_id.replace("&", ",")
-        trial_ids = [e for e in trial_id.split(",") if e]
-        # print("Trial ids:", trial_ids)
-    except:
+    trial_id = pick_nct_id(trial_id)
+    if not trial_id:
         return None
-    
-    for id in trial_ids:
-        if "NCT" in id:
-            trial_id = id
-            break
-    # Only clinicaltrials.gov supported at the moment
-    if "NCT" in id:
-        url = f"https://clinicaltrials.gov/api/v2/studies/{trial_id}"
-        try:
-            response = requests.get(url, timeout=5).json()
-        except requests.exceptions.JSONDecodeError as e:
-            print("Error in looking for trials dara for: ", trial_id)
-            return None
-        with open(f"trials/trial_{trial_id}.json", "w") as f:
-            f.write(json.dumps(response, indent=4))
+    if trial_id in fresh_trials([trial_id]):
+        return load_trial(trial_id)
+    response = load_offline_trial(trial_id)
+    if response is not None or REGISTRY_OFFLINE:
         return response
-    return None
-
-
-def get_trials_data_from_xlsx(file_path, limit=False):
     try:
-        with open(f'pro_results.json', 'r') as file:
-            data = json.load(file)
-    except:
-        data = {}
-    df = pd.read_excel(file_path)
-    trial_ids = df['Registrationnumber'].tolist()
-    unique_ids = df['Unique.ID'].tolist()
-    counter = 0
-    for trial_id, unique_id in zip(trial_ids, unique_ids):
-        if unique_id in data:
-            continue
-        counter += 1
-        print("Processing trials data for", trial_id)
-        get_trial_data(trial_id)
-        extract_pros(trial_id, unique_id)
-        if limit and counter >= limit:
-            break
-
-
-def extract_pros(trial_id, unique_id):
-    global trials_processed
-    try:
-        with open(f'pro_results.json', 'r') as file:
-            global_results = json.load(file)
-    except:
-        global_results = {}
-    if unique_id in global_results.keys() and "outcomes_ai" in global_results[unique_id]:
+        response, _ = fetch_trial(trial_id)
+    except (httpx.HTTPError, ValueError):
+        print("Error in looking for trials data for: ", trial_id)
         return None
-    
-    try:
-        study_data_path = f"trials/trial_{trial_id}.json"
-        with open(study_data_path, "r") as f:
-            data = json.load(f)
-    except Exception as e:
+    return response
+
+
+def get_trials_data_from_xlsx(file_path, limit=False, max_workers=FETCH_WORKERS, fetch_mode=FETCH_MODE, classify_workers=CLASSIFY_WORKERS, batched=CLASSIFY_BATCHED, use_batch_api=OPENAI_BATCH_MODE):
+    classified = classified_unique_ids()
+    df = read_workbook(file_path)
+    df["nct_id"] = normalize_registrations(df['Registrationnumber'])
+    rows = df[df["nct_id"].notna()]
+    pending = rows[~rows['Unique.ID'].astype(str).isin(classified)]
+    # Every registration is fetched and classified once for all the rows referencing it. The classified rows stay
+    # in the group, so that a new row of a registration classified before reuses that classification.
+    registrations = rows[rows["nct_id"].isin(pending["nct_id"])].groupby("nct_id", sort=False)['Unique.ID'].agg(list)
+    if limit:
+        registrations = registrations.head(limit)
+    print(f"{len(pending)} workbook rows reference {len(registrations)} unique registrations")
+
+    fetch_trials(registrations.index.tolist(), max_workers=max_workers, mode=fetch_mode)
+    if use_batch_api:
+        extract_pros_batch(registrations.items(), batched=batched)
+    else:
+        extract_pros_parallel(registrations.items(), max_workers=classify_workers, batched=batched)
+
+
+def prepare_trial(trial_id, unique_ids, migrate=True):
+    """
+    Load the registry outcomes of a registration that still needs to be classified.
+
+    :param trial_id: str, the registration number
+    :param unique_ids: list|str, the Unique.IDs of the workbook rows referencing the registration
+    :param migrate: bool, see trial_cache.load_trial
+    :return: dict|None, the trial or None if there is nothing to classify
+    """
+    if not isinstance(unique_ids, list):
+        unique_ids = [unique_ids]
+    trial_id = pick_nct_id(trial_id)
+    if not trial_id:
+        return None
+    classified = [u for u in unique_ids if get_ai_outcomes(u) is not None]
+    if len(classified) == len(unique_ids):
         return None
+
+    data = load_trial(trial_id, migrate)
+    if data is None:
+        return None
+    digest = classify_digest(data)
     
     
     outcomes = []
@@ -92,261 +116,816 @@ def extract_pros(trial_id, unique_id):
         for d in data["protocolSection"]["outcomesModule"]["secondaryOutcomes"]:
             d["is_primary"] = False
             outcomes.append(d)
-    title = data["protocolSection"]["identificationModule"]["briefTitle"]
-    results = []
+    return {
+        "trial_id": trial_id,
+        # The rows classified before keep their stored classification
+        "unique_ids": [u for u in unique_ids if u not in classified],
+        "study_data_path": trial_path(trial_id),
+        "title": data["protocolSection"]["identificationModule"]["briefTitle"],
+        "outcomes": outcomes,
+        # Another row of the workbook references the same registration, its classification is reused
+        "classification": get_ai_outcomes(classified[0]) if classified else None,
+        "digest": digest,
+    }
+
+
+def valid_classification(response):
+    answer = json.loads(response)
+    return isinstance(answer, dict) and isinstance(answer.get("is_pro"), bool)
+
+
+def classify_outcome(title, outcome, number):
+    answer = json.loads(ask_ai(
+        pro_prompt(title, outcome),
+        system_role=SYSTEM_ROLE,
+        model="gpt-4o",
+        json_mode=True,
+        stage="extract_pros",
+        validate=valid_classification
+    ))
+    answer["outcome"] = outcome
+    answer["number"] = number
+    return answer
+
+
+def chunk_outcomes(title, outcomes, max_tokens=CLASSIFY_BATCH_TOKENS):
+    """
+    Split the outcomes of a trial into chunks whose batched prompt stays within the token budget.
+
+    :param title: str, the brief title of the trial
+    :param outcomes: list, the registry outcomes in their registry order
+    :param max_tokens: int, the prompt token budget of one chunk
+    :return: list, lists of (number, outcome) pairs
+    """
+    chunks = [[]]
+    base_tokens = count_tokens(pro_batch_prompt(title, []))
+    outcome_tokens = count_tokens_batch([json.dumps({"number": i + 1, **outcome}, indent=4) for i, outcome in enumerate(outcomes)])
+    tokens = base_tokens
     for i, outcome in enumerate(outcomes):
-        answer = json.loads(ask_ai(
-            f"In a clinical trial, a patient-reported outcome (PRO) is any information about a patient's health condition that comes partially from the patient themselves, i.e. a subjective report. Below, you receive a JSON string of an Outcome Measure in the clinical trial '{title}'. Please respond if this outcome is PRO or not (partially PRO is still considered a PRO, such as ARC20), specify the instrument used if any and give the reason for your assessment as a JSON string with keys 'is_pro', 'reason' and 'instrument'.\n{outcome}",
-            system_role="You are an expert clinical analyst specialized in assessing integrity of clinical trial data",
-            model="gpt-4o",
-            json_mode=True
-        ))
+        if chunks[-1] and tokens + outcome_tokens[i] > max_tokens:
+            chunks.append([])
+            tokens = base_tokens
+        chunks[-1].append((i + 1, outcome))
+        tokens += outcome_tokens[i]
+    return [chunk for chunk in chunks if chunk]
+
+
+def valid_pro_answer(item):
+    return (
+        isinstance(item, dict)
+        and isinstance(item.get("number"), int)
+        and isinstance(item.get("is_pro"), bool)
+        and isinstance(item.get("reason"), str)
+        and (item.get("instrument") is None or isinstance(item.get("instrument"), str))
+    )
+
+
+def classify_outcomes_batched(title, numbered_outcomes):
+    """
+    Classify several outcomes of a trial with one request.
+
+    :param title: str, the brief title of the trial
+    :param numbered_outcomes: list, (number, outcome) pairs
+    :return: list, the classification answers in the order of numbered_outcomes
+    """
+    response = ask_ai(
+        pro_batch_prompt(title, numbered_outcomes),
+        system_role=SYSTEM_ROLE,
+        model="gpt-4o",
+        json_mode=True,
+        stage="extract_pros",
+        validate=lambda r: isinstance(json.loads(r).get("outcomes"), list)
+    )
+    return parse_batched_answers(title, numbered_outcomes, response)
+
+
+def parse_batched_answers(title, numbered_outcomes, response):
+    """
+    Map the answer to a batched classification prompt back onto the outcomes. Outcomes missing from the
+    answer or answered with an invalid object are classified one by one.
+
+    :param title: str, the brief title of the trial
+    :param numbered_outcomes: list, (number, outcome) pairs
+    :param response: str|None, the answer of the model
+    :return: list, the classification answers in the order of numbered_outcomes
+    """
+    try:
+        items = json.loads(response).get("outcomes")
+    except (json.JSONDecodeError, AttributeError, TypeError):
+        items = None
+    if not isinstance(items, list):
+        items = []
+
+    answers = {}
+    for item in items:
+        if valid_pro_answer(item) and item["number"] not in answers:
+            answers[item["number"]] = {"is_pro": item["is_pro"], "reason": item["reason"], "instrument": item.get("instrument")}
+
+    results = []
+    for number, outcome in numbered_outcomes:
+        if number not in answers:
+            say(f"No valid batched answer for outcome {number} of '{title}', asking separately")
+            results.append(classify_outcome(title, outcome, number))
+            continue
+        answer = answers[number]
         answer["outcome"] = outcome
-        answer["number"] = i + 1
+        answer["number"] = number
         results.append(answer)
+    return results
 
 
-    path = f"results/trial_{trial_id}_pros.json"
-    with open(path, "w") as f:
-        f.write(json.dumps(results, indent=4))
-    
-    with open(f'pro_results.json', 'a') as _:
-        pass
+def outcome_chunks(trial, batched=CLASSIFY_BATCHED):
+    if batched:
+        return chunk_outcomes(trial["title"], trial["outcomes"])
+    return [[(i + 1, outcome)] for i, outcome in enumerate(trial["outcomes"])]
 
-    try:
-        with open(f'pro_results.json', 'r') as file:
-            data = json.load(file)
-    except:
-        data = {}
 
-    if unique_id not in data:
-        data[unique_id] = {"study_data_path": study_data_path, "title": title}
-    data[unique_id]["outcomes_ai"] = results
+def classify_outcomes(title, numbered_outcomes, batched=CLASSIFY_BATCHED):
+    if batched:
+        return classify_outcomes_batched(title, numbered_outcomes)
+    return [classify_outcome(title, outcome, number) for number, outcome in numbered_outcomes]
 
-    with open(f'pro_results.json', 'w') as file:
-        json.dump(data, file, indent=4)
 
-    trials_processed += 1
+def store_pros(trial, results):
+    global trials_processed
+    path = f"results/trial_{trial['trial_id']}_pros.json"
+    write_json(path, results, indent=4)
+
+    save_ai_outcomes(trial["unique_ids"], trial["trial_id"], trial["study_data_path"], trial["title"], results, trial["digest"])
+
+    with counters_lock:
+        trials_processed += 1
     return results
 
-def compile_results_data(file_path):
-    with open(f'pro_results.json', 'r') as file:
-        results = json.load(file)
-    
-    df = pd.read_excel(file_path)
-    protocol_sec_names = []
-    protocol_sec_instruments = []
-    for i in range(1, 22):
-        protocol_sec_names.append(f"Protocol_sec_outcome{i}")
-        protocol_sec_instruments.append(f"Protocol_sec_instrument{i}")
-    
-    protocol_sec_pub_names = []
-    protocol_sec_pub_instruments = []
-    for j in range(10):
-        protocol_sec_pub_names.append(f"pub_pro_sec_{chr(ord('a')+j)}_name")
-        protocol_sec_pub_instruments.append(f"pub_pro_sec_{chr(ord('a')+j)}_ins")
-
-    for index, row in df.iterrows():
-        unique_id = row['Unique.ID']
-        if unique_id not in results:
+
+def extract_pros(trial_id, unique_ids, batched=CLASSIFY_BATCHED):
+    trial = prepare_trial(trial_id, unique_ids)
+    if trial is None:
+        return None
+    if trial["classification"] is not None:
+        return store_pros(trial, trial["classification"])
+    with usage_context(trial=trial_id):
+        results = [answer for chunk in outcome_chunks(trial, batched) for answer in classify_outcomes(trial["title"], chunk, batched)]
+    return store_pros(trial, results)
+
+
+def extract_pros_parallel(registrations, max_workers=CLASSIFY_WORKERS, batched=CLASSIFY_BATCHED):
+    """
+    Classify the outcomes of many registrations concurrently, across outcomes and across trials.
+
+    The requests are paced by the per-model rate limiter in utils.query_openai. The results are written
+    by the calling thread, trial by trial, with the outcomes in their registry order.
+
+    :param registrations: iterable, (registration number, Unique.IDs) pairs
+    :param max_workers: int, the number of concurrent classification requests
+    :param batched: bool, classify a token-budgeted chunk of outcomes per request instead of one outcome
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        jobs = []
+        for trial_id, unique_ids in registrations:
+            trial = prepare_trial(trial_id, unique_ids)
+            if trial is None:
+                continue
+            if trial["classification"] is not None:
+                store_pros(trial, trial["classification"])
+                continue
+            chunks = outcome_chunks(trial, batched)
+            # The workers account their usage to the trial they classify
+            with usage_context(trial=trial["trial_id"]):
+                futures = [pool.submit(copy_context().run, classify_outcomes, trial["title"], chunk, batched) for chunk in chunks]
+            jobs.append((trial, futures))
+
+        for trial, futures in jobs:
+            print("Processing trials data for", trial["trial_id"])
+            try:
+                results = [answer for future in futures for answer in future.result()]
+            except Exception as e:
+                print("Failed to classify the outcomes of", trial["trial_id"], e)
+                continue
+            store_pros(trial, results)
+
+def extract_pros_batch(registrations, batched=CLASSIFY_BATCHED, name="extract_pros"):
+    """
+    Classify the outcomes through the OpenAI Batch API. Running it again while the batch is being
+    processed resumes waiting for the same batch instead of submitting a new one.
+
+    :param registrations: iterable, (registration number, Unique.IDs) pairs
+    :param batched: bool, classify a token-budgeted chunk of outcomes per request instead of one outcome
+    :param name: str, the name of the batch
+    """
+    trials = {}
+    requests = []
+    for trial_id, unique_ids in registrations:
+        trial = prepare_trial(trial_id, unique_ids)
+        if trial is None:
             continue
-        
-        results[unique_id]["outcomes_ethical"] = [{
-            "number": i+1, "name": row[protocol_sec_names[i]], "instrument": row[protocol_sec_instruments[i]], "is_primary": False}
-            for i in range(len(protocol_sec_names))
-            if row[protocol_sec_names[i]] and str(row[protocol_sec_names[i]]) != "nan" and str(row[protocol_sec_names[i]]) != "."]
-        results[unique_id]["outcomes_publication"] = [
-            {"number": i+1, "name": row[protocol_sec_pub_names[i]], "instrument": row[protocol_sec_pub_instruments[i]], "is_primary": False}
-            for i in range(len(protocol_sec_pub_names))
-            if row[protocol_sec_pub_names[i]] and str(row[protocol_sec_pub_names[i]]) != "nan" and str(row[protocol_sec_pub_names[i]]) != "."]
-        
-        # Adding the primary outcome to the data
-        if row["Protocol_PrimaryOutcome"] and str(row["Protocol_PrimaryOutcome"]) != "nan":
-            results[unique_id]["outcomes_ethical"].append({"number": len(protocol_sec_names)+1, "name": row["Protocol_PrimaryOutcome"], "instrument": "", "is_primary": True})
-
-        if row["Pub_PrimaryOutcome"] and str(row["Pub_PrimaryOutcome"]) != "nan":
-            results[unique_id]["outcomes_publication"].append({"number": len(protocol_sec_pub_names)+1, "name": row["Pub_PrimaryOutcome"], "instrument": "", "is_primary": True})
-        
-        
-    with open(f'pro_results.json', 'w') as file:
-        json.dump(results, file, indent=4)
-
-
-def match_results():
-    global matches_processed
-    print("Matching results")
-    with open(f'pro_results.json', 'r') as file:
-        results = json.load(file)
-    
-    for unique_id, data in results.items():
-        if "outcomes_ai" in data and "outcomes_ethical" in data and "outcomes_publication" in data and "matching" not in data:
-            
-            ethical_matches = []
-            ethical_additional = []
-            publication_matches = []
-            publication_additional = []
-            text = "Below, you receive a JSON list of Outcome Measures in the clinical trial '%s':\n%s\n\nOne of the above outcomes should match with this outcome, which has been formulated differently:\Measure: %s\nDescription: %s\nInstrument: %s\n\nPlease indicate the best matching number (-1 if no match) in a JSON dictionary with the key 'match_number'. In addition, report with the boolean key 'has_changed' if the Outcome Measure is significantly different (measure or instrument has changed).\n"
-            for i, outcome_ai in enumerate(data["outcomes_ai"]):
-                if outcome_ai["is_pro"]:
-                    # Match registry measures with ethical submission measures
-                    reserved_numbers_ethical = [m["match"] for m in ethical_matches]
-                    prompt = text % (
-                        data["title"],
-                        json.dumps([o for o in data["outcomes_ethical"] if o["number"] not in reserved_numbers_ethical], indent=4),
-                        outcome_ai["outcome"]["measure"],
-                        outcome_ai["outcome"].get("description", "No description"),
-                        outcome_ai["instrument"]
-                    )
-                    answer = json.loads(ask_ai(
-                        prompt,
-                        system_role="You are an expert clinical analyst specialized in assessing integrity of clinical trial data",
-                        model="gpt-4o",
-                        json_mode=True
-                    ))
-                    if answer["match_number"] > -1:
-                        element = outcome_ai.copy()
-                        element["match"] = answer["match_number"]
-                        element["has_changed"] = answer["has_changed"]
-                        ethical_matches.append(element)
-                    else:
-                        ethical_additional.append(outcome_ai)
-
-                    # Match registry measures with publication measures
-                    reserved_numbers_publication = [m["match"] for m in publication_matches]
-                    prompt = text % (
-                        data["title"],
-                        json.dumps([o for o in data["outcomes_publication"] if o["number"] not in reserved_numbers_publication], indent=4),
-                        outcome_ai["outcome"]["measure"],
-                        outcome_ai["outcome"].get("description", "No description"),
-                        outcome_ai["instrument"]
-                    )
-                    answer = json.loads(ask_ai(
-                        prompt,
-                        system_role="You are an expert clinical analyst specialized in assessing integrity of clinical trial data",
-                        model="gpt-4o",
-                        json_mode=True
-                    ))
-                    if answer["match_number"] > -1:
-                        element = outcome_ai.copy()
-                        element["match"] = answer["match_number"]
-                        element["has_changed"] = answer["has_changed"]
-                        publication_matches.append(element)
-                    else:
-                        publication_additional.append(outcome_ai)
-            
-            leftover_outcomes_ethical = [o for o in data["outcomes_ethical"] if o["number"] not in [m["match"] for m in ethical_matches]]
-            leftover_outcomes_publication = [o for o in data["outcomes_publication"] if o["number"] not in [m["match"] for m in publication_matches]]
-
-            # a-j has been translated to numbers
-            results[unique_id]["matching"] = {
-                    "outcomes_in_registry_matching_ethical":  ethical_matches,
-                    "extra_outcomes_in_registry_wrt_ethical":  ethical_additional,
-                    "missing_outcomes_in_registry_wrt_ethical":  leftover_outcomes_ethical,
-                    "modified_outcomes_in_registry_wrt_ethical":  [m for m in ethical_matches if m["has_changed"]],
-                    "outcomes_in_registry_matching_publication":  publication_matches,
-                    "extra_outcomes_in_registry_wrt_publication":  publication_additional,
-                    "missing_outcomes_in_registry_wrt_publication":  leftover_outcomes_publication,
-                    "modified_outcomes_in_registry_wrt_publication":  [m for m in publication_matches if m["has_changed"]],
-                }
-
-            if not results[unique_id]["matching"]["extra_outcomes_in_registry_wrt_ethical"] and not results[unique_id]["matching"]["missing_outcomes_in_registry_wrt_ethical"] and not results[unique_id]["matching"]["modified_outcomes_in_registry_wrt_ethical"]:
-                results[unique_id]["matching"]["ethical_match_ai"] = True
-            else:
-                results[unique_id]["matching"]["ethical_match_ai"] = False
-            if not results[unique_id]["matching"]["extra_outcomes_in_registry_wrt_publication"] and not results[unique_id]["matching"]["missing_outcomes_in_registry_wrt_publication"] and not results[unique_id]["matching"]["modified_outcomes_in_registry_wrt_publication"]:
-                results[unique_id]["matching"]["publication_match_ai"] = True
+        if trial["classification"] is not None:
+            store_pros(trial, trial["classification"])
+            continue
+        trials[trial["trial_id"]] = trial
+        for chunk in outcome_chunks(trial, batched):
+            numbers = ",".join(str(number) for number, _ in chunk)
+            # The record is loaded again when the batch is ingested, the digest tells whether these outcomes changed
+            checksum = digest(*[outcome for _, outcome in chunk])[:12]
+            if batched:
+                content = pro_batch_prompt(trial["title"], chunk)
             else:
-                results[unique_id]["matching"]["publication_match_ai"] = False
+                content = pro_prompt(trial["title"], chunk[0][1])
+            requests.append(batch_request(f"pro|{trial['trial_id']}|{'batched' if batched else 'single'}|{numbers}|{checksum}", content, SYSTEM_ROLE, "gpt-4o", json_mode=True))
+
+    responses = run_batch(name, requests)
+    if responses is None:
+        return
+
+    by_trial = {}
+    for custom_id, response in responses.items():
+        # Batches submitted by older versions have no digest
+        _, trial_id, mode, numbers, checksum = (custom_id.split("|") + [None])[:5]
+        by_trial.setdefault(trial_id, []).append((mode, [int(n) for n in numbers.split(",")], checksum, response))
+    for trial_id, trial in trials.items():
+        if trial_id not in by_trial:
+            continue
+        outcomes = {i + 1: outcome for i, outcome in enumerate(trial["outcomes"])}
+        stale = [
+            numbers for _, numbers, checksum, _ in by_trial[trial_id]
+            if any(number not in outcomes for number in numbers)
+            or (checksum is not None and checksum != digest(*[outcomes[number] for number in numbers])[:12])
+        ]
+        if stale:
+            # The registry record changed since the batch was submitted, the trial stays unclassified and is
+            # submitted again by the next run
+            print("The outcomes of", trial_id, "changed since the batch was submitted, it will be classified again")
+            continue
+        print("Processing trials data for", trial_id)
+        results = []
+        with usage_context(trial=trial_id):
+            for mode, numbers, _, response in by_trial[trial_id]:
+                numbered_outcomes = [(number, outcomes[number]) for number in numbers]
+                if mode == "batched":
+                    results += parse_batched_answers(trial["title"], numbered_outcomes, response)
+                    continue
+                try:
+                    answer = json.loads(response)
+                    answer["outcome"] = numbered_outcomes[0][1]
+                    answer["number"] = numbers[0]
+                except (json.JSONDecodeError, TypeError):
+                    answer = classify_outcome(trial["title"], numbered_outcomes[0][1], numbers[0])
+                results.append(answer)
+            # Outcomes added to the registry record after the batch was submitted are classified online
+            answered = [answer["number"] for answer in results]
+            results += [classify_outcome(trial["title"], outcome, number) for number, outcome in outcomes.items() if number not in answered]
+        store_pros(trial, sorted(results, key=lambda answer: answer["number"]))
+    mark_ingested(name)
+
+
+def read_workbook(workbook):
+    """
+    Parse the workbook, or pass through a workbook parsed before so that a run reads the Excel file only once.
+
+    :param workbook: str|DataFrame, the path of the workbook or the parsed workbook
+    :return: DataFrame, the workbook
+    """
+    if isinstance(workbook, pd.DataFrame):
+        return workbook
+    return pd.read_excel(workbook)
+
+
+def classified_registrations(df):
+    """
+    :param df: DataFrame, the workbook with an "nct_id" column
+    :return: Series, NCT id -> the classified Unique.IDs referencing it
+    """
+    rows = df[df['Unique.ID'].astype(str).isin(classified_unique_ids()) & df["nct_id"].notna()]
+    return rows.groupby("nct_id", sort=False)['Unique.ID'].agg(list)
+
+
+def invalidate_changed_classifications(file_path, max_workers=FETCH_WORKERS, fetch_mode=FETCH_MODE):
+    """
+    Drop the classification and matching of the workbook rows whose registry record or classification prompt
+    changed, so that the run computes them again. The stale cached records are fetched again first.
+
+    :param file_path: str|DataFrame, the workbook
+    :return: list, the Unique.IDs to classify again
+    """
+    df = read_workbook(file_path)
+    df["nct_id"] = normalize_registrations(df['Registrationnumber'])
+    registrations = classified_registrations(df)
+    fetch_trials(registrations.index.tolist(), max_workers=max_workers, mode=fetch_mode)
+    changed = changed_classifications(registrations.items())
+    if changed:
+        print(f"The inputs of {len(changed)} classified workbook rows changed, they are classified again")
+    invalidate(changed, "extract_pros")
+    return changed
+
+
+def invalidate_changed_matchings(unique_ids=None, assignment=MATCH_ASSIGNMENT):
+    """
+    Drop the matching of the trials whose classified outcomes, workbook outcomes or matching prompt changed.
+
+    :param unique_ids: iterable, only check these trials, all matched trials by default
+    :return: list, the Unique.IDs to match again
+    """
+    changed = changed_matchings(unique_ids, assignment)
+    if changed:
+        print(f"The inputs of {len(changed)} matched trials changed, they are matched again")
+    invalidate(changed, "match_results")
+    return changed
+
+
+def changed_report(file_path, assignment=MATCH_ASSIGNMENT, max_workers=FETCH_WORKERS, fetch_mode=FETCH_MODE):
+    """
+    List the workbook rows whose stored results no longer match their inputs, without changing the store.
+
+    :param file_path: str|DataFrame, the workbook
+    :return: dict, stage -> the Unique.IDs to compute again, rows classified again are matched again as well
+    """
+    df = read_workbook(file_path)
+    df["nct_id"] = normalize_registrations(df['Registrationnumber'])
+    registrations = classified_registrations(df)
+    fetch_trials(registrations.index.tolist(), max_workers=max_workers, mode=fetch_mode)
+    classify = changed_classifications(registrations.items(), adopt=False)
+    submissions = submission_outcomes(df, matched_unique_ids())
+    match = changed_matchings(assignment=assignment, adopt=False, submissions=submissions)
+    return {"extract_pros": classify, "match_results": [u for u in match if u not in classify]}
 
-            matches_processed += 1
-            if not (results[unique_id]["matching"]["publication_match_ai"] and results[unique_id]["matching"]["ethical_match_ai"]):
-                print(f"Registry entry didn't match the data for entry: {unique_id}: {data['title']}")
 
-            with open(f'pro_results.json', 'w') as file:
-                json.dump(results, file, indent=4)
+def compile_results_data(file_path):
+    df = read_workbook(file_path)
+    save_submission_outcomes(submission_outcomes(df, known_unique_ids()))
+
+
+PROTOCOL_SEC_NAMES = [f"Protocol_sec_outcome{i}" for i in range(1, 22)]
+PROTOCOL_SEC_INSTRUMENTS = [f"Protocol_sec_instrument{i}" for i in range(1, 22)]
+PUB_SEC_NAMES = [f"pub_pro_sec_{chr(ord('a') + j)}_name" for j in range(10)]
+PUB_SEC_INSTRUMENTS = [f"pub_pro_sec_{chr(ord('a') + j)}_ins" for j in range(10)]
+
+
+def _filled(values, placeholders=("nan", ".")):
+    # Empty cells, zeros and the placeholders used in the workbook do not count as outcomes
+    return values.notna() & ~values.astype(str).isin(placeholders) & ~(values.eq("") | values.eq(0))
+
+
+def _long_outcomes(rows, names, instruments, primary):
+    """
+    Reshape the outcome columns of one source from wide to long, one line per filled outcome.
+
+    :param rows: DataFrame, the workbook rows with a "unique_id" and a "row" column
+    :param names: list, the columns of the secondary outcome names, numbered from 1
+    :param instruments: list, the columns of their instruments
+    :param primary: str, the column of the primary outcome, numbered after the secondary ones
+    :return: DataFrame, the outcomes ordered by row and number
+    """
+    secondary = rows.melt(id_vars=["unique_id", "row"], value_vars=names, var_name="column", value_name="name")
+    # melt stacks the columns in the same order, so the instruments line up with the names
+    secondary["instrument"] = rows.melt(id_vars=["unique_id"], value_vars=instruments, value_name="instrument")["instrument"].to_numpy()
+    secondary["number"] = secondary["column"].map({column: i + 1 for i, column in enumerate(names)})
+    secondary["is_primary"] = False
+    secondary = secondary[_filled(secondary["name"])]
+
+    primary_rows = rows[_filled(rows[primary], ("nan",))]
+    primary = pd.DataFrame({
+        "unique_id": primary_rows["unique_id"],
+        "row": primary_rows["row"],
+        "name": primary_rows[primary],
+        "instrument": "",
+        "number": len(names) + 1,
+        "is_primary": True,
+    })
+    outcomes = pd.concat([secondary.drop(columns="column"), primary], ignore_index=True)
+    return outcomes.sort_values(["row", "number"], kind="stable")
+
+
+def submission_outcomes(df, unique_ids):
+    """
+    Read the ethical submission and publication outcomes of workbook rows.
+
+    :param df: DataFrame, the workbook
+    :param unique_ids: set, the Unique.IDs of the rows to read
+    :return: dict, Unique.ID -> {"outcomes_ethical": [...], "outcomes_publication": [...]}
+    """
+    rows = df.assign(unique_id=df['Unique.ID'].astype(str))
+    # A Unique.ID that appears twice is described by its last row
+    rows = rows[rows["unique_id"].isin(unique_ids)].drop_duplicates("unique_id", keep="last")
+    rows = rows.assign(row=range(len(rows)))
+
+    results = {unique_id: {"outcomes_ethical": [], "outcomes_publication": []} for unique_id in rows["unique_id"]}
+    sources = (
+        ("outcomes_ethical", PROTOCOL_SEC_NAMES, PROTOCOL_SEC_INSTRUMENTS, "Protocol_PrimaryOutcome"),
+        ("outcomes_publication", PUB_SEC_NAMES, PUB_SEC_INSTRUMENTS, "Pub_PrimaryOutcome"),
+    )
+    for key, names, instruments, primary in sources:
+        outcomes = _long_outcomes(rows, names, instruments, primary)
+        columns = ["number", "name", "instrument", "is_primary"]
+        for unique_id, group in outcomes.groupby("unique_id", sort=False):
+            results[unique_id][key] = group[columns].to_dict("records")
+    return results
 
 
-def convert_results_to_csv(input_file, output_file):
-    with open(input_file, 'r') as file:
-        results = json.load(file)
-    
-    separator = ';'
-    output_data = [separator.join([
-        "unique_id",
-        "ethical_match_ai",
-        "publication_match_ai",
-        "extra_outcomes_in_registry_wrt_ethical",
-        "missing_outcomes_in_registry_wrt_ethical",
-        "modified_outcomes_in_registry_wrt_ethical",
-        "extra_outcomes_in_registry_wrt_publication",
-        "missing_outcomes_in_registry_wrt_publication",
-        "modified_outcomes_in_registry_wrt_publication",
-        "comments"])]
-    for unique_id, data in results.items():
-        row = []
-        row.append(unique_id)
-        row.append(data["matching"]["ethical_match_ai"])
-        row.append(data["matching"]["publication_match_ai"])
-        comments = []
-        if len(data["matching"]["extra_outcomes_in_registry_wrt_ethical"]):
-            row.append(True)
-            comments.append(f"Registry has {len(data['matching']['extra_outcomes_in_registry_wrt_ethical'])} additional PRO outcomes that are not found in the ethical submission")
-        else:
-            row.append(False)
+def valid_match(response):
+    answer = json.loads(response)
+    return isinstance(answer, dict) and isinstance(answer.get("match_number"), int) and "has_changed" in answer
+
+
+def match_outcome(data, outcome_ai, source, reserved_numbers):
+    return json.loads(ask_ai(
+        match_prompt(data, outcome_ai, source, reserved_numbers),
+        system_role=SYSTEM_ROLE,
+        model="gpt-4o",
+        json_mode=True,
+        stage="match_results",
+        validate=valid_match
+    ))
+
+
+def match_source(data, source, answers=None):
+    """
+    Match the registry PRO outcomes of a trial with the ethical submission or publication outcomes.
+
+    :param data: dict, the pro_results.json entry of the trial
+    :param source: str, "ethical" or "publication"
+    :param answers: dict, registry outcome number -> answer computed ahead against all outcomes of the source, e.g. by
+        the Batch API. Answers pointing to an outcome that is already matched are asked again without it.
+    :return: tuple, the matched and the additional registry outcomes
+    """
+    matches = []
+    additional = []
+    for outcome_ai in data["outcomes_ai"]:
+        if outcome_ai["is_pro"]:
+            reserved_numbers = [m["match"] for m in matches]
+            answer = (answers or {}).get(outcome_ai["number"])
+            if answer is None or answer["match_number"] in reserved_numbers:
+                answer = prematch(data, outcome_ai, source, reserved_numbers) if PREMATCH else None
+            if answer is None:
+                answer = match_outcome(data, outcome_ai, source, reserved_numbers)
+            if answer["match_number"] > -1:
+                element = outcome_ai.copy()
+                element["match"] = answer["match_number"]
+                element["has_changed"] = answer["has_changed"]
+                matches.append(element)
+            else:
+                additional.append(outcome_ai)
+    return matches, additional
 
-        if len(data["matching"]["missing_outcomes_in_registry_wrt_ethical"]):
-            row.append(True)
-            comments.append(f"Registry is {len(data['matching']['missing_outcomes_in_registry_wrt_ethical'])} missing PRO outcomes that are present in the ethical submission")
-        else:
-            row.append(False)
 
-        if len(data["matching"]["modified_outcomes_in_registry_wrt_ethical"]):
-            row.append(True)
-            comments.append(f"Registry has {len(data['matching']['modified_outcomes_in_registry_wrt_ethical'])} outcomes matching the ethical submission but they might have been modified")
-        else:
-            row.append(False)
+def parse_scores(response):
+    """
+    Read the answer to match_matrix_prompt, pairs with invalid fields are left out.
 
-        if len(data["matching"]["extra_outcomes_in_registry_wrt_publication"]):
-            row.append(True)
-            comments.append(f"Registry has {len(data['matching']['extra_outcomes_in_registry_wrt_publication'])} additional PRO outcomes that are not found in the publication")
+    :param response: str, the answer
+    :return: dict, (registry number, outcome number) -> (score, has_changed)
+    """
+    scores = {}
+    for item in json.loads(response)["scores"]:
+        try:
+            pair = (int(item["registry_number"]), int(item["match_number"]))
+            scores[pair] = (float(item["score"]), bool(item.get("has_changed", False)))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return scores
+
+
+def score_outcomes(data, source):
+    return parse_scores(ask_ai(
+        match_matrix_prompt(data, source),
+        system_role=SYSTEM_ROLE,
+        model="gpt-4o",
+        json_mode=True,
+        stage="match_results",
+        validate=lambda r: isinstance(json.loads(r)["scores"], list)
+    ))
+
+
+def match_source_global(data, source, scores=None, min_score=MATCH_MIN_SCORE):
+    """
+    Match the registry PRO outcomes of a trial with the ethical submission or publication outcomes with one scoring
+    request and the assignment maximizing the total score, so the result does not depend on the outcome order.
+
+    :param data: dict, the pro_results.json entry of the trial
+    :param source: str, "ethical" or "publication"
+    :param scores: dict, the parsed scores computed ahead, e.g. by the Batch API
+    :return: tuple, the matched and the additional registry outcomes
+    """
+    pros = [o for o in data["outcomes_ai"] if o["is_pro"]]
+    numbers = [o["number"] for o in data[f"outcomes_{source}"]]
+    if not pros or not numbers:
+        return [], pros
+    if scores is None:
+        scores = score_outcomes(data, source)
+
+    matrix = np.zeros((len(pros), len(numbers)))
+    for row, outcome_ai in enumerate(pros):
+        for column, number in enumerate(numbers):
+            matrix[row, column] = scores.get((outcome_ai["number"], number), (0.0, False))[0]
+    assigned = best_assignment(matrix, min_score)
+
+    matches = []
+    additional = []
+    for row, outcome_ai in enumerate(pros):
+        if row in assigned:
+            element = outcome_ai.copy()
+            element["match"] = numbers[assigned[row]]
+            element["has_changed"] = scores[(outcome_ai["number"], element["match"])][1]
+            matches.append(element)
         else:
-            row.append(False)
+            additional.append(outcome_ai)
+    return matches, additional
+
+
+def build_matching(data, ethical_matches, ethical_additional, publication_matches, publication_additional):
+    leftover_outcomes_ethical = [o for o in data["outcomes_ethical"] if o["number"] not in [m["match"] for m in ethical_matches]]
+    leftover_outcomes_publication = [o for o in data["outcomes_publication"] if o["number"] not in [m["match"] for m in publication_matches]]
+
+    # a-j has been translated to numbers
+    matching = {
+            "outcomes_in_registry_matching_ethical":  ethical_matches,
+            "extra_outcomes_in_registry_wrt_ethical":  ethical_additional,
+            "missing_outcomes_in_registry_wrt_ethical":  leftover_outcomes_ethical,
+            "modified_outcomes_in_registry_wrt_ethical":  [m for m in ethical_matches if m["has_changed"]],
+            "outcomes_in_registry_matching_publication":  publication_matches,
+            "extra_outcomes_in_registry_wrt_publication":  publication_additional,
+            "missing_outcomes_in_registry_wrt_publication":  leftover_outcomes_publication,
+            "modified_outcomes_in_registry_wrt_publication":  [m for m in publication_matches if m["has_changed"]],
+        }
+
+    if not matching["extra_outcomes_in_registry_wrt_ethical"] and not matching["missing_outcomes_in_registry_wrt_ethical"] and not matching["modified_outcomes_in_registry_wrt_ethical"]:
+        matching["ethical_match_ai"] = True
+    else:
+        matching["ethical_match_ai"] = False
+    if not matching["extra_outcomes_in_registry_wrt_publication"] and not matching["missing_outcomes_in_registry_wrt_publication"] and not matching["modified_outcomes_in_registry_wrt_publication"]:
+        matching["publication_match_ai"] = True
+    else:
+        matching["publication_match_ai"] = False
+    return matching
+
+
+def match_trial(unique_id, data, answers=None, assignment=MATCH_ASSIGNMENT):
+    match = match_source_global if assignment else match_source
+    with usage_context(trial=unique_id):
+        sides = {source: match(data, source, (answers or {}).get(source)) for source in SOURCES}
+    return record_matching(unique_id, data, sides, assignment)
+
+
+def record_matching(unique_id, data, sides, assignment=MATCH_ASSIGNMENT):
+    """
+    Build the matching of a trial from the matches of both sources and store it in one transaction.
+
+    :param unique_id: str, the Unique.ID of the workbook row
+    :param data: dict, the pro_results.json entry of the trial
+    :param sides: dict, source -> (matched, additional registry outcomes)
+    :param assignment: bool, whether the sides were matched with the global assignment
+    :return: dict, the matching
+    """
+    global matches_processed
+    matching = build_matching(data, *sides["ethical"], *sides["publication"])
+
+    with counters_lock:
+        matches_processed += 1
+    if not (matching["publication_match_ai"] and matching["ethical_match_ai"]):
+        print(f"Registry entry didn't match the data for entry: {unique_id}: {data['title']}")
+
+    save_matching(unique_id, matching, match_digest(data, assignment))
+    return matching
+
+
+def match_trials_parallel(pending, answers=None, max_workers=MATCH_WORKERS, assignment=MATCH_ASSIGNMENT):
+    """
+    Match many trials concurrently, across trials and across the ethical and publication sides of a trial.
+
+    The workers only talk to the model. The results are written by the calling thread, which stores every trial
+    in its own transaction as soon as both of its sides are done, so finished trials survive a crash.
+
+    :param pending: list, (Unique.ID, pro_results.json entry) pairs
+    :param answers: dict, Unique.ID -> source -> answers computed ahead, see match_source and match_source_global
+    :param max_workers: int, the number of concurrent matchings
+    :param assignment: bool, use the global assignment instead of the greedy matching
+    :return: list, the Unique.IDs of the trials that failed
+    """
+    match = match_source_global if assignment else match_source
+    trials = dict(pending)
+    sides = {}
+    failed = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for unique_id, data in pending:
+            # The workers account their usage to the trial they match
+            with usage_context(trial=unique_id):
+                for source in SOURCES:
+                    future = pool.submit(copy_context().run, match, data, source, (answers or {}).get(unique_id, {}).get(source))
+                    futures[future] = (unique_id, source)
+
+        for future in as_completed(futures):
+            unique_id, source = futures[future]
+            if unique_id in failed:
+                continue
+            try:
+                sides.setdefault(unique_id, {})[source] = future.result()
+            except Exception as e:
+                print("Failed to match the outcomes of", unique_id, e)
+                # Nothing of the trial is stored, it stays pending for the next run
+                failed.add(unique_id)
+                sides.pop(unique_id, None)
+                continue
+            if len(sides[unique_id]) == len(SOURCES):
+                record_matching(unique_id, trials[unique_id], sides.pop(unique_id), assignment)
+    if failed:
+        print(f"{len(failed)} trials could not be matched, they are left out of the CSV until a run matches them")
+    return sorted(failed)
+
+
+def match_results(max_workers=MATCH_WORKERS):
+    print("Matching results")
+    match_trials_parallel(list(pending_matches()), max_workers=max_workers)
 
-        if len(data["matching"]["missing_outcomes_in_registry_wrt_publication"]):
-            row.append(True)
-            comments.append(f"Registry is {len(data['matching']['missing_outcomes_in_registry_wrt_publication'])} missing PRO outcomes that are present in the publication")
-        else:
-            row.append(False)
 
-        if len(data["matching"]["modified_outcomes_in_registry_wrt_publication"]):
-            row.append(True)
-            comments.append(f"Registry has {len(data['matching']['modified_outcomes_in_registry_wrt_publication'])} outcomes matching the publication but they might have been modified")
-        else:
-            row.append(False)
+def match_results_batch(name="match_results"):
+    """
+    Match the outcomes through the OpenAI Batch API.
 
-        if comments:
-            row.append(". ".join(comments) + ".")
-        else:
-            row.append("")
+    Every registry PRO outcome is matched against all outcomes of the source at once. When two registry outcomes
+    claim the same outcome, the later one is asked again online without the claimed outcome, like match_results does.
+
+    :param name: str, the name of the batch
+    """
+    print("Matching results")
+    pending = list(pending_matches())
+    answers = {}
+    requests = []
+    for unique_id, data in pending:
+        for source in SOURCES:
+            for outcome_ai in data["outcomes_ai"]:
+                if not outcome_ai["is_pro"]:
+                    continue
+                # Pairs the pre-matcher resolves are not sent, their answers are used like the batch ones
+                answer = prematch(data, outcome_ai, source) if PREMATCH else None
+                if answer is not None:
+                    answers.setdefault(unique_id, {s: {} for s in SOURCES})[source][outcome_ai["number"]] = answer
+                    continue
+                custom_id = f"match|{unique_id}|{source}|{outcome_ai['number']}"
+                requests.append(batch_request(custom_id, match_prompt(data, outcome_ai, source), SYSTEM_ROLE, "gpt-4o", json_mode=True))
+    responses = run_batch(name, requests) if requests else {}
+    if responses is None:
+        return
+
+    for custom_id, response in responses.items():
+        unique_id, source, number = custom_id[len("match|"):].rsplit("|", 2)
+        try:
+            answer = json.loads(response)
+            if not isinstance(answer.get("match_number"), int):
+                continue
+        except (json.JSONDecodeError, TypeError, AttributeError):
+            continue
+        answers.setdefault(unique_id, {s: {} for s in SOURCES})[source][int(number)] = answer
+    # Trials without PRO outcomes get an empty matching, outcomes without a valid answer are asked online
+    match_trials_parallel(pending, answers, assignment=False)
+    if requests:
+        mark_ingested(name)
+
+
+def match_results_global_batch(name="match_results_global"):
+    """
+    Match the outcomes through the OpenAI Batch API with the global assignment, one scoring request per trial and
+    source. Trials whose scores are missing or invalid are scored again online.
+
+    :param name: str, the name of the batch
+    """
+    print("Matching results")
+    pending = list(pending_matches())
+    requests = [
+        batch_request(f"matrix|{unique_id}|{source}", match_matrix_prompt(data, source), SYSTEM_ROLE, "gpt-4o", json_mode=True)
+        for unique_id, data in pending
+        for source in SOURCES
+        if data[f"outcomes_{source}"] and any(o["is_pro"] for o in data["outcomes_ai"])
+    ]
+    responses = run_batch(name, requests) if requests else {}
+    if responses is None:
+        return
+
+    answers = {}
+    for custom_id, response in responses.items():
+        unique_id, source = custom_id[len("matrix|"):].rsplit("|", 1)
+        try:
+            answers.setdefault(unique_id, {})[source] = parse_scores(response)
+        except (json.JSONDecodeError, TypeError, KeyError):
+            continue
+    match_trials_parallel(pending, answers, assignment=True)
+    if requests:
+        mark_ingested(name)
+
+
+CSV_SEPARATOR = ';'
+CSV_HEADER = [
+    "unique_id",
+    "ethical_match_ai",
+    "publication_match_ai",
+    "extra_outcomes_in_registry_wrt_ethical",
+    "missing_outcomes_in_registry_wrt_ethical",
+    "modified_outcomes_in_registry_wrt_ethical",
+    "extra_outcomes_in_registry_wrt_publication",
+    "missing_outcomes_in_registry_wrt_publication",
+    "modified_outcomes_in_registry_wrt_publication",
+    "comments"]
+
+
+def csv_row(unique_id, data):
+    """
+    Build the CSV line of a matched trial.
+
+    :param unique_id: str, the Unique.ID of the trial
+    :param data: dict, the pro_results.json entry of the trial
+    :return: str, the line without the line break
+    """
+    row = []
+    row.append(unique_id)
+    row.append(data["matching"]["ethical_match_ai"])
+    row.append(data["matching"]["publication_match_ai"])
+    comments = []
+    if len(data["matching"]["extra_outcomes_in_registry_wrt_ethical"]):
+        row.append(True)
+        comments.append(f"Registry has {len(data['matching']['extra_outcomes_in_registry_wrt_ethical'])} additional PRO outcomes that are not found in the ethical submission")
+    else:
+        row.append(False)
+
+    if len(data["matching"]["missing_outcomes_in_registry_wrt_ethical"]):
+        row.append(True)
+        comments.append(f"Registry is {len(data['matching']['missing_outcomes_in_registry_wrt_ethical'])} missing PRO outcomes that are present in the ethical submission")
+    else:
+        row.append(False)
+
+    if len(data["matching"]["modified_outcomes_in_registry_wrt_ethical"]):
+        row.append(True)
+        comments.append(f"Registry has {len(data['matching']['modified_outcomes_in_registry_wrt_ethical'])} outcomes matching the ethical submission but they might have been modified")
+    else:
+        row.append(False)
+
+    if len(data["matching"]["extra_outcomes_in_registry_wrt_publication"]):
+        row.append(True)
+        comments.append(f"Registry has {len(data['matching']['extra_outcomes_in_registry_wrt_publication'])} additional PRO outcomes that are not found in the publication")
+    else:
+        row.append(False)
+
+    if len(data["matching"]["missing_outcomes_in_registry_wrt_publication"]):
+        row.append(True)
+        comments.append(f"Registry is {len(data['matching']['missing_outcomes_in_registry_wrt_publication'])} missing PRO outcomes that are present in the publication")
+    else:
+        row.append(False)
+
+    if len(data["matching"]["modified_outcomes_in_registry_wrt_publication"]):
+        row.append(True)
+        comments.append(f"Registry has {len(data['matching']['modified_outcomes_in_registry_wrt_publication'])} outcomes matching the publication but they might have been modified")
+    else:
+        row.append(False)
+
+    if comments:
+        row.append(". ".join(comments) + ".")
+    else:
+        row.append("")
+    return CSV_SEPARATOR.join([str(r) for r in row])
 
-        output_data.append(separator.join([str(r) for r in row]))
+
+def convert_results_to_csv(input_file, output_file):
+    with open(input_file, 'r') as file:
+        results = json.load(file)
+
+    output_data = [CSV_SEPARATOR.join(CSV_HEADER)]
+    unmatched = []
+    for unique_id, data in results.items():
+        # Trials whose classification or matching has not completed have no row yet
+        if "matching" not in data:
+            unmatched.append(unique_id)
+            continue
+        output_data.append(csv_row(unique_id, data))
+    if unmatched:
+        print(f"Left {len(unmatched)} trials that are not matched yet out of {output_file}")
     output_data = "\n".join(output_data)
 
-    with open(output_file, 'w') as file:
-        file.write(output_data)
+    atomic_write(output_file, lambda file: file.write(output_data))
 
 
-start_run()
-try:
-    # EDIT HERE THE DATA FILE NAMES
-    get_trials_data_from_xlsx("ASPIRE_2016_OSKARI.xlsx")
-    compile_results_data("ASPIRE_2016_OSKARI.xlsx")
-    match_results()
-    convert_results_to_csv("pro_results.json", "pro_results_2016.csv")
+if __name__ == "__main__":
+    start_run()
+    try:
+        import_legacy_json("pro_results.json")
+        # EDIT HERE THE DATA FILE NAMES
+        workbook = read_workbook("ASPIRE_2016_OSKARI.xlsx")
+        if INCREMENTAL:
+            invalidate_changed_classifications(workbook)
+        get_trials_data_from_xlsx(workbook)
+        compile_results_data(workbook)
+        if INCREMENTAL:
+            invalidate_changed_matchings()
+        if OPENAI_BATCH_MODE and MATCH_ASSIGNMENT:
+            match_results_global_batch()
+        elif OPENAI_BATCH_MODE:
+            match_results_batch()
+        else:
+            match_results()
+        export_json("pro_results.json")
+        convert_results_to_csv("pro_results.json", "pro_results_2016.csv")
 
-except Exception as e:
-    print("An exception occurred:", str(e))
-    traceback.print_exc()
-finally:
-    print("Trials processed:", trials_processed, "Matches processed:", matches_processed)
-    finish_run()
+    except Exception as e:
+        print("An exception occurred:", str(e))
+        traceback.print_exc()
+    finally:
+        print("Trials processed:", trials_processed, "Matches processed:", matches_processed)
+        prematch_report()
+        finish_run()
@@ -0,0 +1,213 @@
+import argparse
+import queue
+import threading
+import traceback
+
+from decouple import config
+
+import main
+from main import (
+    CLASSIFY_BATCHED, CLASSIFY_WORKERS, CSV_HEADER, CSV_SEPARATOR, INCREMENTAL, MATCH_ASSIGNMENT, MATCH_WORKERS,
+    changed_report, csv_row, extract_pros, invalidate_changed_classifications, match_trial, read_workbook,
+    submission_outcomes,
+)
+from incremental import changed_matchings
+from prematch import prematch_report
+from registry import BATCH_SIZE, FETCH_MODE, FETCH_WORKERS, fetch_trials, normalize_registrations
+from results_store import export_json, get_ai_outcomes, import_legacy_json, invalidate, load_results, save_submission_outcomes
+from utils import finish_run, say, start_run
+
+# Items waiting between two stages, a slow stage makes the ones before it wait instead of piling up work
+PIPELINE_QUEUE_SIZE = config("PIPELINE_QUEUE_SIZE", default=64, cast=int)
+
+DONE = object()
+
+
+def take(inbox, batch_size):
+    """
+    Wait for an item of the inbox and take the ones already queued behind it, up to batch_size in all.
+
+    :return: tuple, the items and whether DONE was reached
+    """
+    items = []
+    item = inbox.get()
+    while item is not DONE:
+        items.append(item)
+        if len(items) == batch_size:
+            return items, False
+        try:
+            item = inbox.get_nowait()
+        except queue.Empty:
+            return items, False
+    # Let the other workers of the stage see the end as well
+    inbox.put(DONE)
+    return items, True
+
+
+def run_stage(name, fn, inbox, outbox, workers=1, batch_size=None):
+    """
+    Start the worker threads of a stage. Every worker takes items from the inbox and puts what fn yields for
+    them into the outbox. When the inbox is exhausted, the last worker passes DONE on.
+
+    :param name: str, the name of the stage, for errors and thread names
+    :param fn: callable, takes an item and returns an iterable of items for the next stage
+    :param inbox: queue.Queue, the items of the stage, ended by DONE
+    :param outbox: queue.Queue|None, the items of the next stage
+    :param workers: int, the number of threads
+    :param batch_size: int, pass fn lists of up to batch_size items queued together instead of single items
+    :return: list, the threads
+    """
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def work():
+        done = False
+        while not done:
+            if batch_size:
+                item, done = take(inbox, batch_size)
+                if not item:
+                    break
+            else:
+                item = inbox.get()
+                if item is DONE:
+                    # Let the other workers of the stage see the end as well
+                    inbox.put(DONE)
+                    break
+            try:
+                for result in fn(item):
+                    if outbox is not None:
+                        outbox.put(result)
+            except Exception as e:
+                print(f"The {name} stage failed for {item}:", e)
+                traceback.print_exc()
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last and outbox is not None:
+            outbox.put(DONE)
+
+    threads = [threading.Thread(target=work, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def classified(unique_ids):
+    return [u for u in unique_ids if get_ai_outcomes(u) is not None]
+
+
+def fetch(items, mode=FETCH_MODE):
+    # Registrations whose rows are all classified do not need their record again
+    needed = [nct_id for nct_id, unique_ids in items if len(classified(unique_ids)) < len(unique_ids)]
+    # One registry request for the records of the batch that are not cached or stale
+    _, report = fetch_trials(needed, max_workers=1, mode=mode, batch_size=len(needed) or 1) if needed else (None, {"failures": {}})
+    for item in items:
+        if item[0] not in report["failures"]:
+            yield item
+
+
+def extract(item, batched=CLASSIFY_BATCHED):
+    nct_id, unique_ids = item
+    if len(classified(unique_ids)) < len(unique_ids):
+        print("Processing trials data for", nct_id)
+        extract_pros(nct_id, unique_ids, batched)
+    yield from classified(unique_ids)
+
+
+def join(unique_id, submissions, changed=()):
+    save_submission_outcomes({unique_id: submissions[unique_id]})
+    if unique_id in changed:
+        invalidate([unique_id], "match_results")
+    yield unique_id
+
+
+def match(unique_id):
+    data = load_results(unique_id)
+    if "matching" not in data:
+        match_trial(unique_id, data)
+    yield unique_id
+
+
+def run_pipeline(file_path, output_file, limit=False, batched=CLASSIFY_BATCHED, fetch_workers=FETCH_WORKERS,
+                 classify_workers=CLASSIFY_WORKERS, match_workers=MATCH_WORKERS, queue_size=PIPELINE_QUEUE_SIZE,
+                 incremental=INCREMENTAL):
+    """
+    Run the whole pipeline trial by trial: fetch, PRO extraction, join with the workbook outcomes, matching and
+    the CSV row. The stages run concurrently, connected by bounded queues, so a trial can be matched while later
+    ones are still being fetched and the CSV grows as trials finish.
+
+    :param file_path: str|DataFrame, the workbook
+    :param output_file: str, the CSV file, rewritten from scratch
+    :return: int, the number of rows written
+    """
+    df = read_workbook(file_path)
+    df["nct_id"] = normalize_registrations(df['Registrationnumber'])
+    df = df[df["nct_id"].notna()]
+    registrations = df.groupby("nct_id", sort=False)['Unique.ID'].agg(lambda ids: [str(u) for u in ids])
+    if limit:
+        registrations = registrations.head(limit)
+    submissions = submission_outcomes(df, {u for unique_ids in registrations for u in unique_ids})
+    # The matchings to compute again are found once for the workbook, against the outcomes read now
+    changed = set(changed_matchings(submissions, MATCH_ASSIGNMENT, submissions=submissions)) if incremental else set()
+    if changed:
+        print(f"The inputs of {len(changed)} matched trials changed, they are matched again")
+    print(f"Streaming {len(registrations)} registrations")
+
+    to_fetch, to_extract, to_join, to_match, to_write = (queue.Queue(maxsize=queue_size) for _ in range(5))
+    written = [0]
+
+    def write(unique_id):
+        file.write(csv_row(unique_id, load_results(unique_id)) + "\n")
+        file.flush()
+        written[0] += 1
+        say(f"Wrote the row of {unique_id}")
+        return ()
+
+    with open(output_file, "w") as file:
+        file.write(CSV_SEPARATOR.join(CSV_HEADER) + "\n")
+        threads = (
+            run_stage("fetch", fetch, to_fetch, to_extract, fetch_workers, batch_size=BATCH_SIZE)
+            + run_stage("extract", lambda item: extract(item, batched), to_extract, to_join, classify_workers)
+            + run_stage("join", lambda unique_id: join(unique_id, submissions, changed), to_join, to_match)
+            + run_stage("match", match, to_match, to_write, match_workers)
+            + run_stage("write", write, to_write, None)
+        )
+        for item in registrations.items():
+            to_fetch.put(item)
+        to_fetch.put(DONE)
+        for thread in threads:
+            thread.join()
+    return written[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline with all stages overlapping")
+    parser.add_argument("file", nargs="?", default="ASPIRE_2016_OSKARI.xlsx", help="the workbook")
+    parser.add_argument("output", nargs="?", default="pro_results_2016.csv", help="the CSV file")
+    parser.add_argument("--limit", type=int, default=False, help="only the first registrations")
+    parser.add_argument("--batched", action="store_true", default=CLASSIFY_BATCHED, help="classify outcomes in batched prompts")
+    parser.add_argument("--changed-only", action="store_true", help="only list the rows whose inputs changed since they were computed")
+    args = parser.parse_args()
+
+    if args.changed_only:
+        import_legacy_json("pro_results.json")
+        for stage, unique_ids in changed_report(args.file).items():
+            print(f"{stage}: {len(unique_ids)} rows changed" + (f": {', '.join(unique_ids)}" if unique_ids else ""))
+        raise SystemExit
+
+    start_run()
+    try:
+        import_legacy_json("pro_results.json")
+        workbook = read_workbook(args.file)
+        if INCREMENTAL:
+            invalidate_changed_classifications(workbook)
+        rows = run_pipeline(workbook, args.output, args.limit, args.batched)
+        print(f"Wrote {rows} rows to {args.output}")
+        export_json("pro_results.json")
+    except Exception as e:
+        print("An exception occurred:", str(e))
+        traceback.print_exc()
+    finally:
+        print("Trials processed:", main.trials_processed, "Matches processed:", main.matches_processed)
+        prematch_report()
+        finish_run()
@@ -0,0 +1,179 @@
+import math
+import re
+import threading
+from collections import Counter
+
+from decouple import config
+
+# Resolve the obvious matches and non-matches locally and only ask the model about the ambiguous ones
+PREMATCH = config("PREMATCH", default=True, cast=bool)
+# Similarity of a confident match, and how far it must be ahead of the runner-up
+PREMATCH_MATCH_SCORE = config("PREMATCH_MATCH_SCORE", default=0.75, cast=float)
+PREMATCH_MARGIN = config("PREMATCH_MARGIN", default=0.25, cast=float)
+# Below this similarity with every outcome, and without a shared instrument, the outcome has no match
+PREMATCH_NO_MATCH_SCORE = config("PREMATCH_NO_MATCH_SCORE", default=0.08, cast=float)
+
+# Spellings of the common instruments, the first one is the canonical name. Abbreviations that are also ordinary
+# words (ACT, CAT, DASH, ISI) are left out, they would match unrelated outcomes.
+INSTRUMENT_ALIASES = [
+    ["eq5d", "eq 5d", "euroqol", "euro qol"],
+    ["sf36", "sf 36", "short form 36", "rand 36", "rand36"],
+    ["sf12", "sf 12", "short form 12"],
+    ["vas", "visual analogue scale", "visual analog scale"],
+    ["nrs", "numeric rating scale", "numerical rating scale"],
+    ["hads", "hospital anxiety and depression scale"],
+    ["phq9", "phq 9", "patient health questionnaire 9"],
+    ["gad7", "gad 7", "generalized anxiety disorder 7"],
+    ["bdi", "beck depression inventory"],
+    ["eortc qlq c30", "qlq c30", "qlqc30"],
+    ["fact g", "functional assessment of cancer therapy general"],
+    ["odi", "oswestry", "oswestry disability index"],
+    ["womac", "western ontario and mcmaster"],
+    ["koos", "knee injury and osteoarthritis outcome score"],
+    ["bpi", "brief pain inventory"],
+    ["mpq", "mcgill pain questionnaire"],
+    ["quickdash", "quick dash", "disabilities of the arm shoulder and hand"],
+    ["psqi", "pittsburgh sleep quality index"],
+    ["insomnia severity index"],
+    ["promis"],
+    ["ipss", "international prostate symptom score"],
+    ["iief", "international index of erectile function"],
+    ["pgic", "patient global impression of change"],
+    ["sgrq", "st george s respiratory questionnaire", "st georges respiratory questionnaire"],
+    ["asthma control test"],
+    ["copd assessment test"],
+    ["kccq", "kansas city cardiomyopathy questionnaire"],
+    ["mlhfq", "minnesota living with heart failure"],
+    ["fiq", "fibromyalgia impact questionnaire"],
+    ["ndi", "neck disability index"],
+    ["rmdq", "roland morris"],
+]
+_ALIASES = {alias: aliases[0] for aliases in INSTRUMENT_ALIASES for alias in aliases}
+_ALIAS_RE = re.compile(r"\b(" + "|".join(sorted(map(re.escape, _ALIASES), key=len, reverse=True)) + r")\b")
+STOPWORDS = {
+    "a", "an", "and", "as", "assessed", "at", "by", "change", "for", "from", "in", "measured", "of", "on", "or",
+    "score", "scores", "the", "to", "using", "with", "baseline", "week", "weeks", "month", "months", "day", "days",
+}
+
+_stats_lock = threading.Lock()
+stats = {"matches": 0, "non_matches": 0, "escalated": 0}
+
+
+def normalize(text):
+    if text is None or (isinstance(text, float) and math.isnan(text)):
+        return ""
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", str(text).lower()).split())
+
+
+def instruments(text):
+    """
+    Find the known instruments mentioned in a text.
+
+    :param text: str, normalized text
+    :return: set, the canonical instrument names
+    """
+    return {_ALIASES[alias] for alias in _ALIAS_RE.findall(text)}
+
+
+def tokens(text):
+    return [t for t in text.split() if t not in STOPWORDS and not t.isdigit()]
+
+
+def tfidf_vectors(documents):
+    """
+    Build TF-IDF vectors of a few documents, the documents of one trial are their own corpus.
+
+    :param documents: list, lists of tokens
+    :return: list, dicts of token -> weight, normalized to unit length
+    """
+    frequency = Counter(t for doc in documents for t in set(doc))
+    vectors = []
+    for doc in documents:
+        counts = Counter(doc)
+        vector = {t: c * (math.log((1 + len(documents)) / (1 + frequency[t])) + 1) for t, c in counts.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1
+        vectors.append({t: w / norm for t, w in vector.items()})
+    return vectors
+
+
+def cosine(a, b):
+    return sum(w * b.get(t, 0) for t, w in a.items())
+
+
+def instrument_changed(registry_instruments, candidate_instruments, registry_instrument, candidate_instrument):
+    """
+    Tell whether a matched outcome changed its instrument, which the matching prompt reports as 'has_changed'.
+
+    :param registry_instruments: set, the known instruments of the registry outcome
+    :param candidate_instruments: set, the known instruments of the submission outcome
+    :param registry_instrument: str, the instrument the classification found in the registry outcome
+    :param candidate_instrument: str, the instrument column of the submission outcome
+    :return: bool
+    """
+    if registry_instruments or candidate_instruments:
+        return registry_instruments != candidate_instruments
+    # Neither names a known instrument, compare the instruments as written
+    registry_instrument, candidate_instrument = normalize(registry_instrument), normalize(candidate_instrument)
+    return bool(registry_instrument and candidate_instrument and registry_instrument != candidate_instrument)
+
+
+def _count(name):
+    with _stats_lock:
+        stats[name] += 1
+
+
+def prematch(data, outcome_ai, source, reserved_numbers=(), count=True):
+    """
+    Try to match a registry PRO outcome with the ethical submission or publication outcomes without the model.
+
+    :param data: dict, the pro_results.json entry of the trial
+    :param outcome_ai: dict, the classified registry outcome
+    :param source: str, "ethical" or "publication"
+    :param reserved_numbers: list, numbers of the outcomes already matched
+    :param count: bool, add the outcome to the stats of prematch_report()
+    :return: dict|None, the answer in the format of the matching prompt or None if the pair is ambiguous
+    """
+    tally = _count if count else (lambda name: None)
+    candidates = [o for o in data[f"outcomes_{source}"] if o["number"] not in reserved_numbers]
+    if not candidates:
+        tally("non_matches")
+        return {"match_number": -1, "has_changed": False}
+
+    outcome = outcome_ai["outcome"]
+    registry_text = normalize(" ".join(str(outcome.get(k) or "") for k in ("measure", "description")) + " " + normalize(outcome_ai.get("instrument")))
+    candidate_texts = [normalize(o.get("name")) + " " + normalize(o.get("instrument")) for o in candidates]
+    registry_instruments = instruments(registry_text)
+    vectors = tfidf_vectors([tokens(registry_text)] + [tokens(text) for text in candidate_texts])
+
+    scored = []
+    for candidate, text, vector in zip(candidates, candidate_texts, vectors[1:]):
+        candidate_instruments = instruments(text)
+        shared = bool(registry_instruments & candidate_instruments)
+        conflict = bool(registry_instruments and candidate_instruments and not shared)
+        changed = instrument_changed(registry_instruments, candidate_instruments, outcome_ai.get("instrument"), candidate.get("instrument"))
+        scored.append((cosine(vectors[0], vector), shared, conflict, candidate["number"], changed))
+    scored.sort(key=lambda s: s[:4], reverse=True)
+
+    best, shared, conflict, number, changed = scored[0]
+    runner_up = scored[1][0] if len(scored) > 1 else 0
+    if best >= PREMATCH_MATCH_SCORE and best - runner_up >= PREMATCH_MARGIN and not conflict:
+        tally("matches")
+        return {"match_number": number, "has_changed": changed}
+    if best < PREMATCH_NO_MATCH_SCORE and not any(s[1] for s in scored):
+        tally("non_matches")
+        return {"match_number": -1, "has_changed": False}
+    tally("escalated")
+    return None
+
+
+def prematch_report():
+    resolved = stats["matches"] + stats["non_matches"]
+    total = resolved + stats["escalated"]
+    if not total:
+        return ""
+    out = (
+        f"Pre-matcher: {stats['matches']} matches and {stats['non_matches']} non-matches resolved locally, "
+        f"{stats['escalated']} escalated. {resolved} of {total} matching calls saved."
+    )
+    print(out)
+    return out
@@ -0,0 +1,63 @@
+import json
+
+SYSTEM_ROLE = "You are an expert clinical analyst specialized in assessing integrity of clinical trial data"
+
+PRO_DEFINITION = "In a clinical trial, a patient-reported outcome (PRO) is any information about a patient's health condition that comes partially from the patient themselves, i.e. a subjective report."
+
+MATCH_PROMPT = "Below, you receive a JSON list of Outcome Measures in the clinical trial '%s':\n%s\n\nOne of the above outcomes should match with this outcome, which has been formulated differently:\Measure: %s\nDescription: %s\nInstrument: %s\n\nPlease indicate the best matching number (-1 if no match) in a JSON dictionary with the key 'match_number'. In addition, report with the boolean key 'has_changed' if the Outcome Measure is significantly different (measure or instrument has changed).\n"
+
+
+def pro_prompt(title, outcome):
+    return f"{PRO_DEFINITION} Below, you receive a JSON string of an Outcome Measure in the clinical trial '{title}'. Please respond if this outcome is PRO or not (partially PRO is still considered a PRO, such as ARC20), specify the instrument used if any and give the reason for your assessment as a JSON string with keys 'is_pro', 'reason' and 'instrument'.\n{outcome}"
+
+
+def pro_batch_prompt(title, numbered_outcomes):
+    """
+    Build one prompt classifying several outcomes of a trial.
+
+    :param title: str, the brief title of the trial
+    :param numbered_outcomes: list, (number, outcome) pairs
+    :return: str, the prompt
+    """
+    outcomes = [{"number": number, **outcome} for number, outcome in numbered_outcomes]
+    return f"{PRO_DEFINITION} Below, you receive a JSON list of Outcome Measures in the clinical trial '{title}', each identified by its 'number'. For every outcome, please respond if it is PRO or not (partially PRO is still considered a PRO, such as ARC20), specify the instrument used if any and give the reason for your assessment. Answer with a JSON object with the key 'outcomes' holding a list with one object per outcome, each with the keys 'number', 'is_pro', 'reason' and 'instrument'.\n{json.dumps(outcomes, indent=4)}"
+
+
+def match_prompt(data, outcome_ai, source, reserved_numbers=()):
+    """
+    Build the prompt matching a registry outcome with the ethical submission or publication outcomes.
+
+    :param data: dict, the pro_results.json entry of the trial
+    :param outcome_ai: dict, the classified registry outcome
+    :param source: str, "ethical" or "publication"
+    :param reserved_numbers: list, numbers of the outcomes already matched, they are left out of the prompt
+    :return: str, the prompt
+    """
+    return MATCH_PROMPT % (
+        data["title"],
+        json.dumps([o for o in data[f"outcomes_{source}"] if o["number"] not in reserved_numbers], indent=4),
+        outcome_ai["outcome"]["measure"],
+        outcome_ai["outcome"].get("description", "No description"),
+        outcome_ai["instrument"]
+    )
+
+
+def match_matrix_prompt(data, source):
+    """
+    Build the prompt scoring every registry PRO outcome of a trial against all ethical submission or publication
+    outcomes at once, for the global assignment.
+
+    :param data: dict, the pro_results.json entry of the trial
+    :param source: str, "ethical" or "publication"
+    :return: str, the prompt
+    """
+    registry = [
+        {
+            "number": o["number"],
+            "measure": o["outcome"]["measure"],
+            "description": o["outcome"].get("description", "No description"),
+            "instrument": o["instrument"],
+        }
+        for o in data["outcomes_ai"] if o["is_pro"]
+    ]
+    return f"Below, you receive a JSON list of Outcome Measures in the clinical trial '{data['title']}':\n{json.dumps(data[f'outcomes_{source}'], indent=4)}\n\nThe following JSON list holds the outcomes of the same trial in its registry, formulated differently:\n{json.dumps(registry, indent=4)}\n\nFor every pair of a registry outcome and an Outcome Measure above that could be the same outcome, give a score between 0 and 1 of how well they match and report with the boolean 'has_changed' if the Outcome Measure is significantly different (measure or instrument has changed). Pairs you leave out are considered not to match. Answer with a JSON object with the key 'scores' holding a list of objects with the keys 'registry_number', 'match_number', 'score' and 'has_changed'.\n"
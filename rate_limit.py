@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+
+from decouple import config
+
+# Requests and tokens per minute allowed for each OpenAI model of the account
+OPENAI_RPM = config("OPENAI_RPM", default=500, cast=int)
+OPENAI_TPM = config("OPENAI_TPM", default=30000, cast=int)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket that refills continuously up to its capacity.
+    """
+
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.available = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def _take(self, amount):
+        # Take the amount if it is available, otherwise return the seconds until it will be
+        with self.lock:
+            self._refill()
+            if self.available >= amount:
+                self.available -= amount
+                return 0
+            return (amount - self.available) / self.refill_per_second
+
+    def acquire(self, amount=1):
+        """
+        Block until the amount can be taken from the bucket.
+
+        :param amount: float, the amount to take, capped to the capacity so that large requests still go through
+        :return: float, the seconds spent waiting
+        """
+        amount = min(amount, self.capacity)
+        waited = 0
+        while wait := self._take(amount):
+            time.sleep(wait)
+            waited += wait
+        return waited
+
+    async def acquire_async(self, amount=1):
+        amount = min(amount, self.capacity)
+        waited = 0
+        while wait := self._take(amount):
+            await asyncio.sleep(wait)
+            waited += wait
+        return waited
+
+    def drain(self):
+        # The API told us we are over the limit, stop handing out capacity until it refills
+        with self.lock:
+            self._refill()
+            self.available = 0
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budget of one model.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm, rpm / 60)
+        self.tokens = TokenBucket(tpm, tpm / 60)
+
+    def acquire(self, tokens):
+        """
+        Block until a request of the given size fits in both budgets.
+
+        :param tokens: int, the prompt tokens plus the expected completion tokens
+        :return: float, the seconds spent waiting
+        """
+        return self.requests.acquire(1) + self.tokens.acquire(tokens)
+
+    async def acquire_async(self, tokens):
+        return await self.requests.acquire_async(1) + await self.tokens.acquire_async(tokens)
+
+    def drain(self):
+        self.requests.drain()
+        self.tokens.drain()
+
+
+def get_rate_limiter(model, rpm=OPENAI_RPM, tpm=OPENAI_TPM):
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = RateLimiter(rpm, tpm)
+        return _limiters[model]
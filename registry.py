@@ -0,0 +1,258 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import httpx
+from decouple import config
+
+from clients import get_http_client
+from registry_dump import has_index, indexed, lookup
+from retry import get_retry_policy
+from trial_cache import TRIAL_CACHE_POLICY, TRIAL_CACHE_TTL, cached_at, is_fresh, last_update, load_trial, save_trial
+from utils import say
+
+STUDIES_URL = "https://clinicaltrials.gov/api/v2/studies"
+FETCH_WORKERS = config("REGISTRY_FETCH_WORKERS", default=8, cast=int)
+FETCH_TIMEOUT = config("REGISTRY_FETCH_TIMEOUT", default=5, cast=float)
+# "batched" asks for many studies per request, "concurrent" asks for one study per request
+FETCH_MODE = config("REGISTRY_FETCH_MODE", default="batched")
+BATCH_SIZE = config("REGISTRY_BATCH_SIZE", default=100, cast=int)
+# Resolve trials only from the offline registry index, see registry_dump.py
+REGISTRY_OFFLINE = config("REGISTRY_OFFLINE", default=False, cast=bool)
+
+NCT_ID_RE = re.compile(r"(NCT\d{8})", re.IGNORECASE)
+
+
+def get_client():
+    """
+    Return the process-wide keep-alive client used for registry requests.
+
+    :return: httpx.Client, shared between all fetcher threads
+    """
+    return get_http_client("registry", max_connections=FETCH_WORKERS, timeout=FETCH_TIMEOUT)
+
+
+def _get(url, **kwargs):
+    response = get_client().get(url, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def registry_get(url, **kwargs):
+    """
+    GET a registry URL, retrying throttled and failed requests under the registry retry policy.
+
+    :return: httpx.Response, the successful response
+    """
+    return get_retry_policy("registry").call(_get, url, **kwargs)
+
+
+def normalize_registrations(registrations):
+    """
+    Extract the clinicaltrials.gov registration of every workbook cell in one vectorized pass.
+
+    Cells can hold several registrations separated by ;, &, _x000D_, whitespace and so on.
+
+    :param registrations: pandas.Series, the Registrationnumber column
+    :return: pandas.Series, the first NCT id of every cell or NA if there is none
+    """
+    return registrations.astype("string").str.extract(NCT_ID_RE, expand=False).str.upper()
+
+
+def pick_nct_id(trial_id):
+    """
+    Pick the clinicaltrials.gov registration from a workbook cell.
+
+    :param trial_id: str, the raw Registrationnumber cell
+    :return: str|None, the first NCT id of the cell or None if there is none
+    """
+    # Only clinicaltrials.gov supported at the moment
+    match = NCT_ID_RE.search(str(trial_id))
+    return match.group(1).upper() if match else None
+
+
+def load_offline_trial(nct_id):
+    """
+    Resolve a study record from the offline registry index and store it in the trials folder.
+
+    :param nct_id: str, the NCT id of the study
+    :return: dict|None, the study record or None if it is not indexed
+    """
+    record = lookup(nct_id)
+    if record is not None:
+        save_trial(nct_id, record)
+    return record
+
+
+def fetch_trial(nct_id, timeout=FETCH_TIMEOUT):
+    """
+    Fetch a single study record over the shared client and store it in the trials folder.
+
+    :param nct_id: str, the NCT id of the study
+    :param timeout: float, the request timeout in seconds
+    :return: tuple, the study record and the request latency in seconds
+    """
+    start = time.perf_counter()
+    response = registry_get(f"{STUDIES_URL}/{nct_id}", timeout=timeout)
+    latency = time.perf_counter() - start
+    record = response.json()
+    save_trial(nct_id, record)
+    return record, latency
+
+
+def unique_nct_ids(trial_ids):
+    return list(dict.fromkeys(n for n in (pick_nct_id(t) for t in trial_ids) if n))
+
+
+def record_nct_ids(record):
+    """
+    Return the NCT ids a study record answers to, i.e. its own id and its obsolete aliases.
+
+    :param record: dict, the study record
+    :return: list, the NCT ids of the record
+    """
+    identification = record.get("protocolSection", {}).get("identificationModule", {})
+    return [identification.get("nctId")] + identification.get("nctIdAliases", [])
+
+
+def fetch_batch(nct_ids, timeout=FETCH_TIMEOUT, fields=None):
+    """
+    Fetch a chunk of study records with one filter.ids query, following the page tokens.
+
+    :param nct_ids: list, the NCT ids of the chunk
+    :param timeout: float, the request timeout in seconds
+    :param fields: str, only return these fields of the studies, partial records are not cached
+    :return: tuple, a dict of NCT id -> record, a list of page latencies and a dict of failures
+    """
+    wanted = set(nct_ids)
+    records = {}
+    latencies = []
+    failures = {}
+    params = {"filter.ids": ",".join(nct_ids), "pageSize": min(len(nct_ids), 1000)}
+    if fields:
+        params["fields"] = fields
+    while True:
+        start = time.perf_counter()
+        try:
+            response = registry_get(STUDIES_URL, params=params, timeout=timeout)
+            latencies.append(time.perf_counter() - start)
+            page = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            say("Failed to fetch a batch of trial data", e)
+            failures.update({nct_id: str(e) for nct_id in wanted - records.keys()})
+            return records, latencies, failures
+        for record in page.get("studies", []):
+            for nct_id in record_nct_ids(record):
+                if nct_id in wanted and nct_id not in records:
+                    if not fields:
+                        save_trial(nct_id, record)
+                    records[nct_id] = record
+        if not page.get("nextPageToken"):
+            break
+        params["pageToken"] = page["nextPageToken"]
+    failures.update({nct_id: "Not returned by the registry" for nct_id in wanted - records.keys()})
+    return records, latencies, failures
+
+
+def fresh_trials(nct_ids, policy=TRIAL_CACHE_POLICY, ttl=TRIAL_CACHE_TTL, timeout=FETCH_TIMEOUT):
+    """
+    Find the trials whose cached record is still current.
+
+    :param nct_ids: list, the NCT ids to check
+    :param policy: str, "ttl" to trust records younger than ttl seconds or "last_update" to compare the
+        cached last update date with the one in the registry
+    :param ttl: int, the cache lifetime in seconds for the "ttl" policy
+    :param timeout: float, the request timeout in seconds
+    :return: set, the NCT ids that do not need to be fetched
+    """
+    cached = [nct_id for nct_id in nct_ids if cached_at(nct_id) is not None]
+    if REGISTRY_OFFLINE:
+        # The registry cannot be asked. Expired records are read again from the offline index when it has them,
+        # the other cached records are used as they are
+        if policy == "last_update":
+            return set(cached)
+        return set(cached) - indexed([nct_id for nct_id in cached if not is_fresh(nct_id, ttl)])
+    if policy != "last_update":
+        return {nct_id for nct_id in cached if is_fresh(nct_id, ttl)}
+
+    fresh = set()
+    for i in range(0, len(cached), BATCH_SIZE):
+        remote, _, failures = fetch_batch(cached[i:i + BATCH_SIZE], timeout, fields="NCTId,LastUpdatePostDate")
+        for nct_id, record in remote.items():
+            if last_update(record) and last_update(record) == last_update(load_trial(nct_id)):
+                fresh.add(nct_id)
+        # The registry could not be asked, better to use the cached records than nothing
+        fresh.update(nct_id for nct_id, error in failures.items() if error != "Not returned by the registry")
+    return fresh
+
+
+def fetch_trials(trial_ids, max_workers=FETCH_WORKERS, timeout=FETCH_TIMEOUT, mode=FETCH_MODE, batch_size=BATCH_SIZE):
+    """
+    Fetch many study records in parallel. Each record is written to trials/ as soon as it arrives.
+
+    :param trial_ids: list, raw Registrationnumber cells or NCT ids
+    :param max_workers: int, the number of concurrent requests
+    :param timeout: float, the request timeout in seconds
+    :param mode: str, "batched" to request batch_size studies at a time or "concurrent" to request them one by one
+    :param batch_size: int, the number of NCT ids per request in the batched mode
+    :return: tuple, a dict of NCT id -> record resolved by this call (cached trials are only counted in the
+        report) and a report dict with latencies and failures
+    """
+    nct_ids = unique_nct_ids(trial_ids)
+    records = {}
+    report = {"requested": len(nct_ids), "cached": 0, "offline": 0, "requests": 0, "latencies": [], "failures": {}, "wall_time": 0}
+    start = time.perf_counter()
+    fresh = fresh_trials(nct_ids)
+    report["cached"] = len(fresh)
+    nct_ids = [nct_id for nct_id in nct_ids if nct_id not in fresh]
+    if has_index():
+        for nct_id in nct_ids:
+            record = load_offline_trial(nct_id)
+            if record is not None:
+                records[nct_id] = record
+        report["offline"] = len(records)
+    nct_ids = [nct_id for nct_id in nct_ids if nct_id not in records]
+    if REGISTRY_OFFLINE:
+        report["failures"].update({nct_id: "Not found in the offline registry index" for nct_id in nct_ids})
+        nct_ids = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        if mode == "batched":
+            chunks = [nct_ids[i:i + batch_size] for i in range(0, len(nct_ids), batch_size)]
+            futures = [pool.submit(fetch_batch, chunk, timeout) for chunk in chunks]
+            for future in as_completed(futures):
+                batch_records, latencies, failures = future.result()
+                say(f"Fetched {len(batch_records)} trials in {len(latencies)} requests")
+                records.update(batch_records)
+                report["latencies"] += latencies
+                report["failures"].update(failures)
+        else:
+            futures = {pool.submit(fetch_trial, nct_id, timeout): nct_id for nct_id in nct_ids}
+            for future in as_completed(futures):
+                nct_id = futures[future]
+                try:
+                    record, latency = future.result()
+                except (httpx.HTTPError, ValueError) as e:
+                    say("Failed to fetch trial data for", nct_id, e)
+                    report["failures"][nct_id] = str(e)
+                    report["requests"] += 1
+                    continue
+                say(f"Fetched {nct_id} in {latency * 1000:.0f} ms")
+                records[nct_id] = record
+                report["latencies"].append(latency)
+    report["requests"] += len(report["latencies"])
+    report["wall_time"] = time.perf_counter() - start
+    print_fetch_report(report, report["cached"] + len(records), max_workers)
+    return records, report
+
+
+def print_fetch_report(report, fetched, max_workers=FETCH_WORKERS):
+    latencies = sorted(report["latencies"])
+    if latencies:
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+        timing = f"p50 {p50:.0f} ms, p95 {p95:.0f} ms, max {latencies[-1] * 1000:.0f} ms"
+    else:
+        timing = "no successful requests"
+    print(f"Fetched {fetched}/{report['requested']} trials ({report['cached']} cached, {report['offline']} from the offline index) with {report['requests']} requests in {report['wall_time']:.1f} s using {max_workers} workers ({timing}), {len(report['failures'])} failures")
+    for nct_id, error in report["failures"].items():
+        print("Error in looking for trials data for:", nct_id, error)
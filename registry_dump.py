@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+import struct
+import threading
+import zipfile
+import zlib
+
+from decouple import config
+from peewee import CharField, IntegerField, Model, SqliteDatabase, TextField, chunked
+
+REGISTRY_INDEX = config("REGISTRY_INDEX", default="registry_index.sqlite")
+
+# Fixed part of a zip local file header, see APPNOTE.TXT 4.3.7
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+index_db = SqliteDatabase(None)
+_index_lock = threading.Lock()
+
+
+class IndexEntry(Model):
+    nct_id = CharField(primary_key=True)
+    archive = TextField()
+    member = TextField()
+    header_offset = IntegerField()
+    compress_type = IntegerField()
+    compress_size = IntegerField()
+
+    class Meta:
+        database = index_db
+        table_name = "registry_index"
+
+
+def open_index(index_path=REGISTRY_INDEX):
+    with _index_lock:
+        if index_db.database != index_path:
+            index_db.init(index_path, pragmas={"journal_mode": "wal", "synchronous": "normal"})
+            index_db.create_tables([IndexEntry])
+    return index_db
+
+
+def has_index(index_path=REGISTRY_INDEX):
+    return bool(index_path) and os.path.exists(index_path)
+
+
+def ingest(archive_path, index_path=REGISTRY_INDEX):
+    """
+    Index a ClinicalTrials.gov bulk download (ctg-studies.json.zip) by NCT id.
+
+    The index stores the byte offset of every study inside the archive so that a lookup
+    reads only that study instead of opening the whole zip.
+
+    :param archive_path: str, the path to the downloaded zip of study JSON records
+    :param index_path: str, the path to the SQLite index file
+    :return: int, the number of indexed studies
+    """
+    archive_path = os.path.abspath(archive_path)
+    open_index(index_path)
+    with zipfile.ZipFile(archive_path) as archive:
+        rows = [{
+            "nct_id": os.path.splitext(os.path.basename(info.filename))[0],
+            "archive": archive_path,
+            "member": info.filename,
+            "header_offset": info.header_offset,
+            "compress_type": info.compress_type,
+            "compress_size": info.compress_size,
+        } for info in archive.infolist() if info.filename.endswith(".json") and os.path.basename(info.filename).startswith("NCT")]
+
+    with index_db.atomic():
+        for batch in chunked(rows, 100):
+            IndexEntry.insert_many(batch).on_conflict_replace().execute()
+    print(f"Indexed {len(rows)} studies from {archive_path} into {index_path}")
+    return len(rows)
+
+
+def read_member(entry):
+    with open(entry.archive, "rb") as f:
+        f.seek(entry.header_offset)
+        header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+        if header[0] != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f"Bad local header for {entry.member} in {entry.archive}")
+        name_length, extra_length = header[9], header[10]
+        f.seek(name_length + extra_length, os.SEEK_CUR)
+        data = f.read(entry.compress_size)
+    if entry.compress_type == zipfile.ZIP_STORED:
+        return data
+    if entry.compress_type == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(data, -zlib.MAX_WBITS)
+    # Other compression methods are rare in the registry dumps, let zipfile deal with them
+    with zipfile.ZipFile(entry.archive) as archive:
+        return archive.read(entry.member)
+
+
+def lookup(nct_id, index_path=REGISTRY_INDEX):
+    """
+    Read a study record from the offline registry index.
+
+    :param nct_id: str, the NCT id of the study
+    :param index_path: str, the path to the SQLite index file
+    :return: dict|None, the study record or None if the study is not indexed
+    """
+    if not has_index(index_path):
+        return None
+    open_index(index_path)
+    entry = IndexEntry.get_or_none(IndexEntry.nct_id == nct_id)
+    if entry is None:
+        return None
+    return json.loads(read_member(entry))
+
+
+def indexed(nct_ids, index_path=REGISTRY_INDEX):
+    """
+    :param nct_ids: list, the NCT ids to look for
+    :param index_path: str, the path to the SQLite index file
+    :return: set, the NCT ids the offline registry index has
+    """
+    if not nct_ids or not has_index(index_path):
+        return set()
+    open_index(index_path)
+    found = set()
+    for batch in chunked(nct_ids, 500):
+        found.update(entry.nct_id for entry in IndexEntry.select(IndexEntry.nct_id).where(IndexEntry.nct_id.in_(batch)))
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline index of a ClinicalTrials.gov bulk download")
+    parser.add_argument("--index", default=REGISTRY_INDEX, help="path to the SQLite index file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = commands.add_parser("ingest", help="index a downloaded ctg-studies.json.zip")
+    ingest_parser.add_argument("archive")
+    lookup_parser = commands.add_parser("lookup", help="print indexed study records")
+    lookup_parser.add_argument("nct_ids", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        ingest(args.archive, args.index)
+    else:
+        for nct_id in args.nct_ids:
+            print(json.dumps(lookup(nct_id, args.index), indent=4))
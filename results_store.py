@@ -0,0 +1,376 @@
+import json
+import math
+import os
+import threading
+
+from decouple import config
+from peewee import BooleanField, CharField, ForeignKeyField, IntegerField, Model, SqliteDatabase, TextField
+
+from state import write_json
+from trial_cache import export_trial
+
+RESULTS_DB = config("RESULTS_DB", default="pro_results.sqlite")
+# Point the study_data_path of the export to plain JSON copies of the compressed records, see trial_cache.export_trial
+EXPORT_PLAIN_TRIALS = config("EXPORT_PLAIN_TRIALS", default=False, cast=bool)
+
+results_db = SqliteDatabase(None)
+_store_lock = threading.Lock()
+
+SOURCES = ("ethical", "publication")
+
+
+class JSONField(TextField):
+    def db_value(self, value):
+        return json.dumps(value)
+
+    def python_value(self, value):
+        return json.loads(value) if value is not None else None
+
+
+class BaseModel(Model):
+    class Meta:
+        database = results_db
+
+
+class Trial(BaseModel):
+    unique_id = CharField(primary_key=True)
+    nct_id = CharField(null=True, index=True)
+    study_data_path = TextField(null=True)
+    title = TextField(null=True)
+    classified = BooleanField(default=False)
+    compiled = BooleanField(default=False)
+    ethical_match_ai = BooleanField(null=True)
+    publication_match_ai = BooleanField(null=True)
+
+
+class AiOutcome(BaseModel):
+    # The classification answer of the registry outcome, including the outcome itself
+    trial = ForeignKeyField(Trial, backref="outcomes_ai", on_delete="CASCADE")
+    number = IntegerField()
+    is_pro = BooleanField(null=True, index=True)
+    data = JSONField()
+
+    class Meta:
+        indexes = ((("trial", "number"), True),)
+
+
+class SubmissionOutcome(BaseModel):
+    # An outcome of the ethical submission or the publication, from the workbook
+    trial = ForeignKeyField(Trial, backref="outcomes_submission", on_delete="CASCADE")
+    source = CharField(choices=[(s, s) for s in SOURCES])
+    number = IntegerField()
+    name = TextField(null=True)
+    instrument = TextField(null=True)
+    is_primary = BooleanField(default=False)
+
+    class Meta:
+        indexes = ((("trial", "source", "number"), True),)
+
+
+class Match(BaseModel):
+    # The registry outcome matched with a submission outcome, match_number is None when there is no match
+    trial = ForeignKeyField(Trial, backref="matches", on_delete="CASCADE")
+    source = CharField(choices=[(s, s) for s in SOURCES])
+    ai_number = IntegerField()
+    match_number = IntegerField(null=True)
+    has_changed = BooleanField(null=True)
+
+    class Meta:
+        indexes = ((("trial", "source", "ai_number"), True),)
+
+
+class StageInput(BaseModel):
+    # The digest of the inputs a stage computed the results of the trial from, see incremental.py
+    trial = ForeignKeyField(Trial, backref="stage_inputs", on_delete="CASCADE")
+    stage = CharField()
+    digest = CharField()
+
+    class Meta:
+        indexes = ((("trial", "stage"), True),)
+
+
+MODELS = [Trial, AiOutcome, SubmissionOutcome, Match, StageInput]
+
+
+def open_store(path=RESULTS_DB):
+    with _store_lock:
+        if results_db.database != path:
+            results_db.init(path, pragmas={"journal_mode": "wal", "synchronous": "normal", "foreign_keys": 1})
+            results_db.create_tables(MODELS)
+    return results_db
+
+
+def _clean(value):
+    # Empty workbook cells come in as NaN
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return str(value)
+
+
+def known_unique_ids():
+    open_store()
+    return {t.unique_id for t in Trial.select(Trial.unique_id)}
+
+
+def matched_unique_ids():
+    open_store()
+    return {t.unique_id for t in Trial.select(Trial.unique_id).where(Trial.ethical_match_ai.is_null(False))}
+
+
+def classified_unique_ids():
+    open_store()
+    return {t.unique_id for t in Trial.select(Trial.unique_id).where(Trial.classified)}
+
+
+def get_ai_outcomes(unique_id):
+    """
+    Return the classified registry outcomes of a trial.
+
+    :param unique_id: str, the Unique.ID of the workbook row
+    :return: list|None, the outcomes or None if the trial has not been classified
+    """
+    open_store()
+    trial = Trial.get_or_none(Trial.unique_id == str(unique_id))
+    if trial is None or not trial.classified:
+        return None
+    return [o.data for o in trial.outcomes_ai.order_by(AiOutcome.number)]
+
+
+def save_ai_outcomes(unique_ids, nct_id, study_data_path, title, results, digest=None):
+    """
+    Store the classified registry outcomes for every workbook row of a registration in one transaction.
+
+    :param unique_ids: list, the Unique.IDs referencing the registration
+    :param nct_id: str, the NCT id of the registration
+    :param study_data_path: str, the path to the cached study record
+    :param title: str, the brief title of the study
+    :param results: list, the classification answers with 'number' and 'outcome' keys
+    :param digest: str, the digest of the classification inputs
+    """
+    open_store()
+    with results_db.atomic():
+        for unique_id in unique_ids:
+            unique_id = str(unique_id)
+            Trial.insert(unique_id=unique_id, nct_id=nct_id, study_data_path=study_data_path, title=title, classified=True).on_conflict(
+                conflict_target=[Trial.unique_id],
+                update={Trial.nct_id: nct_id, Trial.study_data_path: study_data_path, Trial.title: title, Trial.classified: True},
+            ).execute()
+            AiOutcome.delete().where(AiOutcome.trial == unique_id).execute()
+            if results:
+                AiOutcome.insert_many([
+                    {"trial": unique_id, "number": r["number"], "is_pro": r.get("is_pro"), "data": r} for r in results
+                ]).execute()
+        if digest is not None:
+            save_stage_digest(unique_ids, "extract_pros", digest)
+
+
+def save_submission_outcomes(outcomes):
+    """
+    Store the ethical submission and publication outcomes of the workbook for the known trials.
+
+    :param outcomes: dict, Unique.ID -> {"outcomes_ethical": [...], "outcomes_publication": [...]}
+    """
+    open_store()
+    with results_db.atomic():
+        for unique_id, lists in outcomes.items():
+            unique_id = str(unique_id)
+            SubmissionOutcome.delete().where(SubmissionOutcome.trial == unique_id).execute()
+            rows = [{
+                "trial": unique_id,
+                "source": source,
+                "number": o["number"],
+                "name": _clean(o["name"]),
+                "instrument": _clean(o["instrument"]),
+                "is_primary": o["is_primary"],
+            } for source in SOURCES for o in lists[f"outcomes_{source}"]]
+            if rows:
+                SubmissionOutcome.insert_many(rows).execute()
+            Trial.update(compiled=True).where(Trial.unique_id == unique_id).execute()
+
+
+def save_matching(unique_id, matching, digest=None):
+    """
+    Store the matching of a trial in one transaction.
+
+    :param unique_id: str, the Unique.ID of the workbook row
+    :param matching: dict, the matching in the legacy pro_results.json format
+    :param digest: str, the digest of the matching inputs
+    """
+    open_store()
+    unique_id = str(unique_id)
+    rows = []
+    for source in SOURCES:
+        rows += [{"trial": unique_id, "source": source, "ai_number": m["number"], "match_number": m["match"], "has_changed": m["has_changed"]}
+                 for m in matching[f"outcomes_in_registry_matching_{source}"]]
+        rows += [{"trial": unique_id, "source": source, "ai_number": o["number"], "match_number": None, "has_changed": None}
+                 for o in matching[f"extra_outcomes_in_registry_wrt_{source}"]]
+    with results_db.atomic():
+        Match.delete().where(Match.trial == unique_id).execute()
+        if rows:
+            Match.insert_many(rows).on_conflict_replace().execute()
+        Trial.update(
+            ethical_match_ai=matching["ethical_match_ai"],
+            publication_match_ai=matching["publication_match_ai"],
+        ).where(Trial.unique_id == unique_id).execute()
+        if digest is not None:
+            save_stage_digest([unique_id], "match_results", digest)
+
+
+def save_stage_digest(unique_ids, stage, digest):
+    """
+    Record the digest of the inputs a stage used for some trials.
+
+    :param unique_ids: list, the Unique.IDs
+    :param stage: str, "extract_pros" or "match_results"
+    :param digest: str, the digest
+    """
+    open_store()
+    rows = [{"trial": str(unique_id), "stage": stage, "digest": digest} for unique_id in unique_ids]
+    if rows:
+        StageInput.insert_many(rows).on_conflict_replace().execute()
+
+
+def stage_digests(stage):
+    """
+    :param stage: str, "extract_pros" or "match_results"
+    :return: dict, Unique.ID -> the digest of the inputs the stage used
+    """
+    open_store()
+    return {s.trial_id: s.digest for s in StageInput.select().where(StageInput.stage == stage)}
+
+
+def invalidate(unique_ids, stage):
+    """
+    Drop the results of a stage and of the stages depending on it, so that the next run computes them again.
+
+    :param unique_ids: list, the Unique.IDs
+    :param stage: str, "extract_pros" also drops the matching, "match_results" only the matching
+    """
+    open_store()
+    unique_ids = [str(unique_id) for unique_id in unique_ids]
+    if not unique_ids:
+        return
+    stages = ["extract_pros", "match_results"] if stage == "extract_pros" else ["match_results"]
+    with results_db.atomic():
+        if stage == "extract_pros":
+            AiOutcome.delete().where(AiOutcome.trial.in_(unique_ids)).execute()
+            Trial.update(classified=False).where(Trial.unique_id.in_(unique_ids)).execute()
+        Match.delete().where(Match.trial.in_(unique_ids)).execute()
+        Trial.update(ethical_match_ai=None, publication_match_ai=None).where(Trial.unique_id.in_(unique_ids)).execute()
+        StageInput.delete().where(StageInput.trial.in_(unique_ids) & StageInput.stage.in_(stages)).execute()
+
+
+def _submission_dict(outcome):
+    return {"number": outcome.number, "name": outcome.name, "instrument": outcome.instrument, "is_primary": outcome.is_primary}
+
+
+def to_legacy(trial):
+    """
+    Build the pro_results.json entry of a trial.
+
+    :param trial: Trial, the stored trial
+    :return: dict, the entry with the keys that have been computed so far
+    """
+    data = {"study_data_path": trial.study_data_path, "title": trial.title}
+    outcomes_ai = [o.data for o in trial.outcomes_ai.order_by(AiOutcome.number)]
+    if trial.classified:
+        data["outcomes_ai"] = outcomes_ai
+    if trial.compiled:
+        submission = list(trial.outcomes_submission.order_by(SubmissionOutcome.id))
+        for source in SOURCES:
+            data[f"outcomes_{source}"] = [_submission_dict(o) for o in submission if o.source == source]
+    if trial.ethical_match_ai is None:
+        return data
+
+    by_number = {o["number"]: o for o in outcomes_ai}
+    matches = list(trial.matches.order_by(Match.ai_number))
+    matching = {}
+    for source in SOURCES:
+        matched = []
+        additional = []
+        for m in matches:
+            if m.source != source:
+                continue
+            if m.match_number is None:
+                additional.append(by_number[m.ai_number])
+            else:
+                element = by_number[m.ai_number].copy()
+                element["match"] = m.match_number
+                element["has_changed"] = m.has_changed
+                matched.append(element)
+        matched_numbers = [m["match"] for m in matched]
+        matching[f"outcomes_in_registry_matching_{source}"] = matched
+        matching[f"extra_outcomes_in_registry_wrt_{source}"] = additional
+        matching[f"missing_outcomes_in_registry_wrt_{source}"] = [o for o in data.get(f"outcomes_{source}", []) if o["number"] not in matched_numbers]
+        matching[f"modified_outcomes_in_registry_wrt_{source}"] = [m for m in matched if m["has_changed"]]
+    matching["ethical_match_ai"] = trial.ethical_match_ai
+    matching["publication_match_ai"] = trial.publication_match_ai
+    data["matching"] = matching
+    return data
+
+
+def load_results(unique_id):
+    open_store()
+    trial = Trial.get_or_none(Trial.unique_id == str(unique_id))
+    return to_legacy(trial) if trial else None
+
+
+def pending_matches():
+    """
+    Yield the trials that are classified and compiled but not matched yet.
+
+    :return: generator, (Unique.ID, pro_results.json entry) pairs
+    """
+    open_store()
+    query = Trial.select().where(Trial.classified & Trial.compiled & Trial.ethical_match_ai.is_null())
+    # Materialized first, the caller writes to the store while iterating
+    for trial in list(query):
+        yield trial.unique_id, to_legacy(trial)
+
+
+def export_json(path="pro_results.json", plain_trials=EXPORT_PLAIN_TRIALS):
+    """
+    Write the whole store in the legacy pro_results.json format for downstream consumers. study_data_path points to
+    the gzip compressed study record.
+
+    :param path: str, the output path
+    :param plain_trials: bool, write plain JSON copies of the study records and point study_data_path to them
+    """
+    open_store()
+    results = {}
+    for trial in Trial.select().order_by(Trial.unique_id):
+        results[trial.unique_id] = to_legacy(trial)
+        if plain_trials:
+            results[trial.unique_id]["study_data_path"] = export_trial(trial.study_data_path)
+    write_json(path, results, indent=4)
+    return results
+
+
+def import_legacy_json(path="pro_results.json"):
+    """
+    Load a pro_results.json written by older runs into an empty store.
+
+    :param path: str, the legacy results file
+    :return: int, the number of imported trials
+    """
+    open_store()
+    if Trial.select().exists() or not os.path.exists(path):
+        return 0
+    try:
+        with open(path, "r") as file:
+            results = json.load(file)
+    except json.JSONDecodeError:
+        print(f"Could not import {path}, the file is not valid JSON")
+        return 0
+
+    with results_db.atomic():
+        for unique_id, data in results.items():
+            Trial.create(unique_id=unique_id, study_data_path=data.get("study_data_path"), title=data.get("title"))
+            if "outcomes_ai" in data:
+                save_ai_outcomes([unique_id], None, data.get("study_data_path"), data.get("title"), data["outcomes_ai"])
+            if "outcomes_ethical" in data and "outcomes_publication" in data:
+                save_submission_outcomes({unique_id: data})
+            if "matching" in data:
+                save_matching(unique_id, data["matching"])
+    print(f"Imported {len(results)} trials from {path}")
+    return len(results)
@@ -0,0 +1,179 @@
+import asyncio
+import email.utils
+import inspect
+import random
+import threading
+import time
+
+import httpx
+import openai
+import replicate
+from decouple import config
+
+# Attempts per call including the first one
+RETRY_ATTEMPTS = config("RETRY_ATTEMPTS", default=5, cast=int)
+# Exponential backoff: a random delay up to base * 2^attempt seconds, never more than the cap
+RETRY_BASE_DELAY = config("RETRY_BASE_DELAY", default=0.5, cast=float)
+RETRY_MAX_DELAY = config("RETRY_MAX_DELAY", default=30, cast=float)
+# Longest Retry-After of a server that is waited for instead of giving up
+RETRY_MAX_AFTER = config("RETRY_MAX_AFTER", default=120, cast=float)
+# Retries a provider may spend: this share of its requests plus a reserve that refills every minute
+RETRY_BUDGET_RATIO = config("RETRY_BUDGET_RATIO", default=0.2, cast=float)
+RETRY_BUDGET_RESERVE = config("RETRY_BUDGET_RESERVE", default=10, cast=int)
+
+RETRY_STATUSES = (408, 425, 429, 500, 502, 503, 504)
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def status_code(exc):
+    response = getattr(exc, "response", None)
+    if response is not None and getattr(response, "status_code", None):
+        return response.status_code
+    status = getattr(exc, "status_code", None) or getattr(exc, "status", None)
+    return status if isinstance(status, int) else None
+
+
+def retry_after(exc):
+    """
+    Read the delay a server asked for in the Retry-After (or retry-after-ms) header of a failed response.
+
+    :param exc: Exception, the error of the request
+    :return: float|None, the seconds to wait or None if the server did not say
+    """
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(exc):
+    """
+    Whether a failed request may succeed when sent again.
+    """
+    if isinstance(exc, (httpx.TransportError, openai.APIConnectionError)):
+        return True
+    if getattr(exc, "code", None) == "insufficient_quota":
+        # A 429 that no amount of waiting fixes
+        return False
+    status = status_code(exc)
+    if status is not None:
+        return status in RETRY_STATUSES
+    if isinstance(exc, replicate.exceptions.ModelError):
+        return "please retry" in str(exc)
+    return False
+
+
+class RetryBudget:
+    """
+    Limits the retries of a provider so that an outage does not multiply the load on it.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, reserve=RETRY_BUDGET_RESERVE):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.balance = float(reserve)
+        self.capacity = reserve + 100 * ratio
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.balance = min(self.capacity, self.balance + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            now = time.monotonic()
+            self.balance = min(self.capacity, self.balance + (now - self.updated_at) * self.reserve / 60)
+            self.updated_at = now
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter that honors Retry-After and the retry budget of the provider.
+    """
+
+    def __init__(self, attempts=RETRY_ATTEMPTS, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY, budget=None):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+        self.budget = budget or RetryBudget()
+
+    def delay(self, attempt, exc):
+        hinted = retry_after(exc)
+        if hinted is not None:
+            return hinted
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def _next_delay(self, attempt, exc):
+        # None means the error is final
+        if attempt + 1 >= self.attempts or not is_retryable(exc):
+            return None
+        wait = self.delay(attempt, exc)
+        if wait > RETRY_MAX_AFTER or not self.budget.withdraw():
+            return None
+        return wait
+
+    def call(self, fn, *args, on_retry=None, **kwargs):
+        """
+        Call fn until it succeeds, its error is not retryable, the attempts run out or the budget is spent.
+
+        :param fn: callable, the request
+        :param on_retry: callable, called with the error and the delay before every retry, e.g. to switch proxies
+        :return: the result of fn
+        """
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                wait = self._next_delay(attempt, e)
+                if wait is None:
+                    raise
+                if on_retry:
+                    on_retry(e, wait)
+            time.sleep(wait)
+            attempt += 1
+
+    async def call_async(self, fn, *args, on_retry=None, **kwargs):
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                wait = self._next_delay(attempt, e)
+                if wait is None:
+                    raise
+                if on_retry and inspect.isawaitable(result := on_retry(e, wait)):
+                    await result
+            await asyncio.sleep(wait)
+            attempt += 1
+
+
+def get_retry_policy(provider):
+    """
+    Return the retry policy of a provider, e.g. "openai", "gemini", "replicate" or "registry". The providers
+    have separate budgets.
+    """
+    with _policies_lock:
+        if provider not in _policies:
+            _policies[provider] = RetryPolicy()
+        return _policies[provider]
@@ -0,0 +1,284 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from decouple import config
+
+from usage import price
+
+# Latencies and outcomes kept per model and prompt size
+ROUTER_WINDOW = config("ROUTER_WINDOW", default=200, cast=int)
+# Seconds of latency worth one dollar when ranking models, trades speed against cost
+ROUTER_SECONDS_PER_DOLLAR = config("ROUTER_SECONDS_PER_DOLLAR", default=600, cast=float)
+# Send the prompt to the next model as well if the first one has not answered in time. The async API cancels the
+# slower request, the sync one cannot stop it: it runs to the end in its thread and its tokens are billed and
+# accounted, so a sync hedge can pay for both answers.
+ROUTER_HEDGE = config("ROUTER_HEDGE", default=False, cast=bool)
+# Seconds before the backup request, 0 uses the p95 latency of the first model
+ROUTER_HEDGE_AFTER = config("ROUTER_HEDGE_AFTER", default=0, cast=float)
+# Consecutive failures that open the circuit of a model and the seconds it stays open
+ROUTER_BREAKER_FAILURES = config("ROUTER_BREAKER_FAILURES", default=5, cast=int)
+ROUTER_BREAKER_COOLDOWN = config("ROUTER_BREAKER_COOLDOWN", default=60, cast=float)
+# Latency assumed for a model before it has answered anything
+DEFAULT_LATENCY = 10
+
+SIZE_BUCKETS = (2000, 8000, 30000)
+COMPLETION_TOKENS = 300
+
+
+def size_bucket(tokens):
+    for limit in SIZE_BUCKETS:
+        if tokens < limit:
+            return limit
+    return None
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)] if values else None
+
+
+class ModelStats:
+    """
+    Rolling latency and error statistics of one model with a circuit breaker.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.latencies = {}
+        self.outcomes = deque(maxlen=ROUTER_WINDOW)
+        self.tokens = 0
+        self.dollars = 0.0
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self.probe_at = 0
+
+    def record(self, tokens, latency, ok):
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.setdefault(size_bucket(tokens), deque(maxlen=ROUTER_WINDOW)).append(latency)
+            prompt_price, completion_price = price(self.model)
+            self.tokens += tokens + COMPLETION_TOKENS
+            self.dollars += (tokens * prompt_price + COMPLETION_TOKENS * completion_price) / 1000000
+            self.consecutive_failures = 0
+            self.open_until = 0
+        else:
+            self.consecutive_failures += 1
+            if self.probe_at or self.consecutive_failures >= ROUTER_BREAKER_FAILURES:
+                self.open_until = time.monotonic() + ROUTER_BREAKER_COOLDOWN
+        self.probe_at = 0
+
+    def available(self):
+        # After the cooldown a single probe request is let through, its outcome closes or reopens the circuit
+        now = time.monotonic()
+        return not (now < self.open_until or (self.probe_at and now - self.probe_at < ROUTER_BREAKER_COOLDOWN))
+
+    def sent(self):
+        """
+        Note a request that is being sent. The first one after the cooldown of an open circuit is its probe.
+
+        :return: bool, whether the request is the probe
+        """
+        now = time.monotonic()
+        if not self.open_until or now < self.open_until or (self.probe_at and now - self.probe_at < ROUTER_BREAKER_COOLDOWN):
+            return False
+        self.probe_at = now
+        return True
+
+    def latency(self, tokens, q=0.5):
+        value = percentile(self.latencies.get(size_bucket(tokens), ()), q)
+        if value is None:
+            value = percentile([x for bucket in self.latencies.values() for x in bucket], q)
+        return DEFAULT_LATENCY if value is None else value
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0
+
+    def price_per_token(self):
+        if self.tokens:
+            return self.dollars / self.tokens
+        prompt_price, _ = price(self.model)
+        return prompt_price / 1000000
+
+    def score(self, tokens):
+        # Expected seconds until a usable answer plus the cost converted into seconds
+        expected = self.latency(tokens) / max(1 - self.error_rate(), 0.05)
+        return expected + self.price_per_token() * (tokens + COMPLETION_TOKENS) * ROUTER_SECONDS_PER_DOLLAR
+
+
+class Router:
+    """
+    Orders the models that may answer a prompt by their observed latency, reliability and cost, and runs the
+    prompt through them until one answers.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+
+    def _stats(self, model):
+        if model not in self.stats:
+            self.stats[model] = ModelStats(model)
+        return self.stats[model]
+
+    def plan(self, models, tokens, pinned=False):
+        """
+        Order the candidate models of a prompt. Models with an open circuit are left out, unless all of them are.
+
+        :param models: list, the acceptable models, the preferred one first
+        :param tokens: int, the prompt tokens
+        :param pinned: bool, the caller asked for the preferred model, it is tried first and only the fallbacks
+            are ranked
+        :return: list, the models in the order they should be tried
+        """
+        models = list(dict.fromkeys(models))
+        with self.lock:
+            ranked = sorted(models[1:] if pinned else models, key=lambda m: self._stats(m).score(tokens))
+            if pinned:
+                ranked.insert(0, models[0])
+            available = [m for m in ranked if self._stats(m).available()]
+        return available or models[-1:]
+
+    def record(self, model, tokens, latency, ok):
+        with self.lock:
+            self._stats(model).record(tokens, latency, ok)
+
+    def sent(self, model):
+        with self.lock:
+            return self._stats(model).sent()
+
+    def hedge_after(self, model, tokens):
+        if ROUTER_HEDGE_AFTER:
+            return ROUTER_HEDGE_AFTER
+        with self.lock:
+            return self._stats(model).latency(tokens, 0.95)
+
+    def _call(self, model, tokens, call):
+        self.sent(model)
+        start = time.monotonic()
+        try:
+            response = call(model)
+        except Exception:
+            self.record(model, tokens, time.monotonic() - start, False)
+            raise
+        self.record(model, tokens, time.monotonic() - start, bool(response))
+        return response
+
+    def run(self, models, tokens, call, hedge=ROUTER_HEDGE):
+        """
+        Ask the planned models one after the other until one answers. With hedging, the next model is asked as well
+        once the current one is slower than its p95 latency, and the first answer wins.
+
+        :param models: list, the models from plan()
+        :param tokens: int, the prompt tokens
+        :param call: callable, takes the model and returns the response or a falsy value on failure
+        :param hedge: bool, whether to send backup requests
+        :return: the first response, None if every model failed
+        """
+        if not hedge or len(models) < 2:
+            error = None
+            for model in models:
+                try:
+                    response = self._call(model, tokens, call)
+                except Exception as e:
+                    error = e
+                    continue
+                if response:
+                    return response
+            if error:
+                raise error
+            return None
+
+        pending = {}
+        queue = list(models)
+        error = None
+        while queue or pending:
+            if queue and len(pending) < 2:
+                model = queue.pop(0)
+                # The backup thread accounts its usage to the same stage and trial
+                pending[self.executor.submit(contextvars.copy_context().run, self._call, model, tokens, call)] = model
+            timeout = self.hedge_after(model, tokens) if queue else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if response:
+                    # The slower request keeps running in its thread, its answer is dropped
+                    return response
+        if error:
+            raise error
+        return None
+
+    async def run_async(self, models, tokens, call, hedge=ROUTER_HEDGE):
+        """
+        Async counterpart of run(), call is a coroutine function. The losing request of a hedge is cancelled.
+        """
+        async def attempt(model):
+            probe = self.sent(model)
+            start = time.monotonic()
+            try:
+                response = await call(model)
+            except asyncio.CancelledError:
+                if probe:
+                    # A cancelled probe tells nothing about the model, the next request probes it again
+                    with self.lock:
+                        self._stats(model).probe_at = 0
+                raise
+            except Exception:
+                self.record(model, tokens, time.monotonic() - start, False)
+                raise
+            self.record(model, tokens, time.monotonic() - start, bool(response))
+            return response
+
+        pending = {}
+        queue = list(models)
+        error = None
+        try:
+            while queue or pending:
+                if queue and (not pending or (hedge and len(pending) < 2)):
+                    model = queue.pop(0)
+                    pending[asyncio.create_task(attempt(model))] = model
+                timeout = self.hedge_after(model, tokens) if hedge and queue else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.pop(task)
+                    try:
+                        response = task.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    if response:
+                        return response
+        finally:
+            for task in pending:
+                task.cancel()
+        if error:
+            raise error
+        return None
+
+    def report(self):
+        lines = []
+        with self.lock:
+            for model, stats in self.stats.items():
+                if not stats.outcomes:
+                    continue
+                latencies = [x for bucket in stats.latencies.values() for x in bucket]
+                p50, p95 = percentile(latencies, 0.5), percentile(latencies, 0.95)
+                latency = f"p50 {p50:.1f} s, p95 {p95:.1f} s" if latencies else "no answers"
+                state = ", circuit open" if time.monotonic() < stats.open_until else ""
+                lines.append(f"{model}: {len(stats.outcomes)} requests, {latency}, {stats.error_rate() * 100:.0f}% errors, {stats.price_per_token() * 1000000:.2f} $/M tokens{state}")
+        out = "\n".join(lines)
+        if out:
+            print(out)
+        return out
+
+
+router = Router()
@@ -0,0 +1,70 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+# Prompts whose difficulty is remembered, the least recently routed ones are forgotten first
+ROUTING_CACHE_SIZE = 4096
+
+REASONING_WORDS = re.compile(r"\b(analy[sz]e|assess|compar\w*|classif\w*|determine|evaluat\w*|explain|infer|justify|match\w*|reason\w*|indicate)\b", re.IGNORECASE)
+CONSTRAINT_WORDS = re.compile(r"\b(must|only|exactly|do not|don't|never|boolean|-1 if)\b", re.IGNORECASE)
+STRUCTURE = re.compile(r"[{}\[\]]|^\s*(\d+[.)]|[-*])\s", re.MULTILINE)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def prompt_features(prompt):
+    """
+    Cheap lexical features of the beginning of a prompt.
+
+    :param prompt: str, the prompt or its first words
+    :return: dict, the features
+    """
+    words = prompt.split()
+    return {
+        "words": len(words),
+        "long_words": sum(len(w) > 12 for w in words) / max(len(words), 1),
+        "reasoning": len(REASONING_WORDS.findall(prompt)),
+        "constraints": len(CONSTRAINT_WORDS.findall(prompt)),
+        "structure": len(STRUCTURE.findall(prompt)),
+        "questions": prompt.count("?"),
+        "json": "json" in prompt.lower(),
+    }
+
+
+def difficulty_from_features(features):
+    score = 0
+    score += features["words"] >= 120
+    score += features["long_words"] > 0.08
+    score += min(features["reasoning"], 3)
+    score += features["constraints"] >= 2
+    score += features["structure"] >= 6
+    score += features["questions"] >= 2
+    score += features["json"] and features["reasoning"] >= 2
+    if score <= 1:
+        return "easy"
+    if score <= 4:
+        return "moderate"
+    return "hard"
+
+
+def estimate_prompt_difficulty(prompt):
+    """
+    Grade a prompt as easy, moderate or hard without asking a model. The grade of a prompt prefix is memoized
+    under its hash, so routing a repeated prompt is a dictionary lookup.
+
+    :param prompt: str, the beginning of the prompt
+    :return: str, "easy", "moderate" or "hard"
+    """
+    key = hashlib.sha1(prompt.encode("utf-8")).digest()
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    difficulty = difficulty_from_features(prompt_features(prompt))
+    with _cache_lock:
+        _cache[key] = difficulty
+        if len(_cache) > ROUTING_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return difficulty
@@ -0,0 +1,150 @@
+import copy
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from decouple import config
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+MISSING = object()
+# Identifies the files and accounting of this run among the processes working in the same directory. Worker
+# processes forked by the run inherit it.
+RUN_ID = config("RUN_ID", default=str(os.getpid()))
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """
+    Hold the advisory lock of a state file, shared by the threads and processes working in the directory.
+
+    The lock is taken on a sibling .lock file, which, unlike the state file, is not replaced by atomic_write().
+    The lock is not reentrant, a thread holding it must not take it again.
+
+    :param path: str, the state file
+    :param shared: bool, take a shared lock, for readers that need a consistent view over several files
+    """
+    with open(f"{path}.lock", "a") as lock_file:
+        _lock(lock_file, shared)
+        try:
+            yield
+        finally:
+            _unlock(lock_file)
+
+
+def _lock(lock_file, shared):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        return
+    # msvcrt has no shared locks, readers take the exclusive one. It locks the first byte, which may lie past the
+    # end of the empty lock file, and gives up after 10 seconds, so it is asked again until it gets the lock.
+    lock_file.seek(0)
+    while True:
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def _unlock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return
+    lock_file.seek(0)
+    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def pid_alive(pid):
+    """
+    :param pid: int|None, a process id recorded in a state file
+    :return: bool, whether the process is still running
+    """
+    if not pid:
+        return False
+    if os.name == "nt":
+        # os.kill(pid, 0) would send CTRL_C_EVENT on Windows
+        import ctypes
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def atomic_write(path, write, mode="w"):
+    """
+    Write a file through a temporary file in the same directory renamed over it, so that readers and a crash in
+    the middle of the write only ever leave the old or the new content.
+
+    :param path: str, the file
+    :param write: callable, takes the open temporary file and writes the content
+    :param mode: str, "w" or "wb"
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, mode) as file:
+            write(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json(path, data, **kwargs):
+    atomic_write(path, lambda file: json.dump(data, file, **kwargs))
+
+
+def read_json(path, default=MISSING):
+    """
+    :param path: str, the file
+    :param default: returned, as a copy, when the file does not exist or is empty; without it FileNotFoundError is
+        raised like by open()
+    :return: the parsed content
+    """
+    try:
+        with open(path, "r") as file:
+            content = file.read()
+    except FileNotFoundError:
+        if default is MISSING:
+            raise
+        return copy.deepcopy(default)
+    if not content.strip() and default is not MISSING:
+        return copy.deepcopy(default)
+    return json.loads(content)
+
+
+@contextmanager
+def update_json(path, default=MISSING, **kwargs):
+    """
+    Read, modify and write back a JSON state file under its lock. The block changes the yielded data in place and
+    it is written atomically when the block exits without an error. Concurrent updates from other threads and
+    processes are applied one after the other on the latest content, so none of them is lost.
+
+        with update_json("profiles.json") as data:
+            data["profiles"][name] = profile
+
+    :param path: str, the file
+    :param default: the content of a missing or empty file, see read_json()
+    :param kwargs: passed to json.dump, e.g. indent
+    """
+    with file_lock(path):
+        data = read_json(path, default)
+        yield data
+        write_json(path, data, **kwargs)
@@ -0,0 +1,42 @@
+import itertools
+
+import numpy as np
+
+from assignment import best_assignment, hungarian
+
+
+def brute_force_cost(cost):
+    n, m = cost.shape
+    if n <= m:
+        return min(sum(cost[row, column] for row, column in enumerate(columns)) for columns in itertools.permutations(range(m), n))
+    return brute_force_cost(cost.T)
+
+
+def test_hungarian_finds_the_minimum_cost():
+    rng = np.random.default_rng(7)
+    for shape in [(1, 1), (3, 3), (4, 6), (6, 4), (5, 5)]:
+        cost = rng.random(shape)
+        pairs = hungarian(cost)
+        assert len(pairs) == min(shape)
+        assert len({row for row, _ in pairs}) == len({column for _, column in pairs}) == len(pairs)
+        assert sum(cost[row, column] for row, column in pairs) == brute_force_cost(cost)
+
+
+def test_hungarian_of_an_empty_matrix():
+    assert hungarian(np.zeros((0, 3))) == []
+
+
+def test_best_assignment_beats_the_greedy_choice():
+    # Greedily, row 0 takes column 0 and row 1 is left with 0.1, the assignment gives 0.8 + 0.8
+    scores = [[0.9, 0.8], [0.8, 0.1]]
+    assert best_assignment(scores) == {0: 1, 1: 0}
+
+
+def test_best_assignment_leaves_low_scores_unassigned():
+    scores = [[0.9, 0.2], [0.3, 0.4]]
+    assert best_assignment(scores, min_score=0.5) == {0: 0}
+
+
+def test_best_assignment_of_no_scores():
+    assert best_assignment(np.zeros((0, 0))) == {}
+    assert best_assignment([[0.1, 0.2]], min_score=0.5) == {}
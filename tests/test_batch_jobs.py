@@ -0,0 +1,70 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import batch_jobs
+from batch_jobs import claim_batch, load_state, mark_ingested, save_state, stage_jobs, write_batch_file
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(batch_jobs, "RUN_ID", "run")
+    monkeypatch.setattr(batch_jobs, "_jobs", {})
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def state(status="in_progress", pid=None, ingested=False):
+    return {"batch_id": "batch", "status": status, "ingested": ingested, "pid": pid}
+
+
+def test_mark_ingested_without_a_batch_does_nothing():
+    mark_ingested("match_results")
+    assert load_state("match_results-run") is None
+
+
+def test_write_batch_file():
+    path = write_batch_file("extract_pros-run", [{"custom_id": "a"}, {"custom_id": "b"}])
+    with open(path) as file:
+        assert [json.loads(line)["custom_id"] for line in file] == ["a", "b"]
+    assert not [name for name in os.listdir(batch_jobs.BATCH_DIR) if name.endswith(".tmp")]
+
+
+def test_stage_jobs_do_not_mix_stages():
+    save_state("match_results-1", state())
+    save_state("match_results_global-1", state())
+    save_state("match_results", state())
+    assert stage_jobs("match_results") == ["match_results-1", "match_results"]
+
+
+def test_claim_resumes_the_batch_of_the_run():
+    save_state("extract_pros-run", state())
+    assert claim_batch("extract_pros")["batch_id"] == "batch"
+    assert batch_jobs._job("extract_pros") == "extract_pros-run"
+
+
+def test_claim_takes_over_the_batch_of_a_dead_process():
+    save_state("extract_pros-other", state(pid=dead_pid()))
+    assert claim_batch("extract_pros")["pid"] == os.getpid()
+    assert batch_jobs._job("extract_pros") == "extract_pros-other"
+    mark_ingested("extract_pros")
+    assert load_state("extract_pros-other")["ingested"]
+
+
+def test_claim_leaves_the_batch_of_a_running_process():
+    save_state("extract_pros-other", state(pid=os.getppid()))
+    assert claim_batch("extract_pros") is None
+
+
+def test_claim_skips_finished_batches():
+    save_state("extract_pros-a", state(status="failed"))
+    save_state("extract_pros-b", state(status="completed", ingested=True))
+    assert claim_batch("extract_pros") is None
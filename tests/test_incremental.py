@@ -0,0 +1,77 @@
+import incremental
+from incremental import changed_classifications, changed_matchings, classify_digest, digest, match_digest
+
+
+def record(measure="Fatigue", title="A trial"):
+    return {
+        "protocolSection": {
+            "identificationModule": {"briefTitle": title},
+            "outcomesModule": {"primaryOutcomes": [{"measure": measure, "timeFrame": "12 weeks"}]},
+        }
+    }
+
+
+def results(name="Fatigue", instrument=None):
+    return {
+        "title": "A trial",
+        "outcomes_ai": [{"number": 1, "is_pro": True, "instrument": None, "outcome": {"measure": "Fatigue"}}],
+        "outcomes_ethical": [{"number": 1, "name": name, "instrument": instrument, "is_primary": True}],
+        "outcomes_publication": [],
+    }
+
+
+def test_digest_is_stable_and_order_sensitive():
+    assert digest({"b": 1, "a": 2}, [1, 2]) == digest({"a": 2, "b": 1}, [1, 2])
+    assert digest([1, 2]) != digest([2, 1])
+
+
+def test_classify_digest_follows_the_registry_outcomes():
+    assert classify_digest(record()) == classify_digest(record())
+    assert classify_digest(record()) != classify_digest(record(measure="Pain"))
+    assert classify_digest(record()) != classify_digest(record(title="Another trial"))
+    assert classify_digest(record()) != classify_digest(record(), model="gpt-3.5-turbo-0125")
+
+
+def test_match_digest_ignores_how_empty_cells_are_read():
+    # The workbook reads empty cells as NaN, the store returns None
+    assert match_digest(results(instrument=float("nan"))) == match_digest(results(instrument=None))
+
+
+def test_match_digest_follows_the_inputs_and_the_mode():
+    assert match_digest(results()) != match_digest(results(name="Pain"))
+    assert match_digest(results()) != match_digest(results(), assignment=True)
+
+
+def fake_store(monkeypatch, stored, matched=(), classified=()):
+    saved = {}
+    monkeypatch.setattr(incremental, "stage_digests", lambda stage: dict(stored))
+    monkeypatch.setattr(incremental, "matched_unique_ids", lambda: set(matched))
+    monkeypatch.setattr(incremental, "classified_unique_ids", lambda: set(classified))
+    monkeypatch.setattr(incremental, "save_stage_digest", lambda unique_ids, stage, value: saved.update({u: value for u in unique_ids}))
+    return saved
+
+
+def test_changed_matchings(monkeypatch):
+    current = match_digest(results())
+    saved = fake_store(monkeypatch, {"1": current, "2": "outdated"}, matched={"1", "2", "3"})
+    monkeypatch.setattr(incremental, "load_results", lambda unique_id: results())
+    assert changed_matchings() == ["2"]
+    # Trials matched before digests were recorded adopt the current one
+    assert saved == {"3": current}
+
+
+def test_changed_matchings_against_new_workbook_outcomes(monkeypatch):
+    fake_store(monkeypatch, {"1": match_digest(results())}, matched={"1"})
+    monkeypatch.setattr(incremental, "load_results", lambda unique_id: results())
+    new = {"1": {"outcomes_ethical": results(name="Pain")["outcomes_ethical"]}}
+    assert changed_matchings(["1"], submissions=new) == ["1"]
+    assert changed_matchings(["1"]) == []
+
+
+def test_changed_classifications(monkeypatch):
+    current = classify_digest(record())
+    saved = fake_store(monkeypatch, {"1": current, "2": "outdated"}, classified={"1", "2", "3"})
+    monkeypatch.setattr(incremental, "load_trial", lambda nct_id: record())
+    assert changed_classifications([("NCT00000001", ["1", "2", "3", "4"])]) == ["2"]
+    assert saved == {"3": current}
+    assert changed_classifications([("NCT00000001", ["4"])]) == []
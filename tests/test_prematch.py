@@ -0,0 +1,81 @@
+import prematch
+from prematch import instrument_changed, instruments, normalize, prematch as prematch_outcome
+
+
+def trial(*outcomes):
+    return {
+        "title": "A trial",
+        "outcomes_ethical": [{"number": i + 1, "name": name, "instrument": instrument, "is_primary": i == 0} for i, (name, instrument) in enumerate(outcomes)],
+    }
+
+
+def registry_outcome(measure, instrument=None, number=1):
+    return {"number": number, "is_pro": True, "instrument": instrument, "outcome": {"measure": measure, "description": ""}}
+
+
+def test_normalize():
+    assert normalize("EQ-5D, (5L) Score") == "eq 5d 5l score"
+    assert normalize(None) == ""
+    assert normalize(float("nan")) == ""
+
+
+def test_instruments_use_the_canonical_name():
+    assert instruments(normalize("EuroQol EQ-5D and the SF-36")) == {"eq5d", "sf36"}
+
+
+def test_instruments_match_whole_words_only():
+    # "vas" inside another word, and ambiguous abbreviations like CAT, are no instruments
+    assert instruments(normalize("canvas cat allergy")) == set()
+    assert instruments(normalize("pain on a VAS")) == {"vas"}
+
+
+def test_instrument_changed():
+    assert instrument_changed({"sf36"}, {"sf12"}, None, None)
+    assert not instrument_changed({"sf36"}, {"sf36"}, "SF-36", "sf36 questionnaire")
+    # Without known instruments the instrument fields are compared
+    assert instrument_changed(set(), set(), "diary", "questionnaire")
+    assert not instrument_changed(set(), set(), "diary", None)
+
+
+def test_clear_match_is_resolved_locally():
+    data = trial(("Quality of life measured with the EQ-5D", "EQ-5D"), ("Serum creatinine", None))
+    answer = prematch_outcome(data, registry_outcome("Quality of life (EQ-5D)", "EQ-5D"), "ethical", count=False)
+    assert answer == {"match_number": 1, "has_changed": False}
+
+
+def test_changed_instrument_of_a_local_match_is_reported():
+    measure = "Health related quality of life questionnaire total"
+    data = trial((measure, "paper"), ("Serum creatinine", None))
+    answer = prematch_outcome(data, registry_outcome(measure, "electronic"), "ethical", count=False)
+    assert answer == {"match_number": 1, "has_changed": True}
+
+
+def test_conflicting_instruments_are_escalated():
+    data = trial(("Quality of life", "SF-36"), ("Serum creatinine", None))
+    assert prematch_outcome(data, registry_outcome("Quality of life", "SF-12"), "ethical", count=False) is None
+
+
+def test_unrelated_outcome_has_no_match():
+    data = trial(("Serum creatinine", None), ("Blood pressure", None))
+    answer = prematch_outcome(data, registry_outcome("Fatigue severity"), "ethical", count=False)
+    assert answer == {"match_number": -1, "has_changed": False}
+
+
+def test_no_candidates_left():
+    data = trial(("Fatigue", None))
+    answer = prematch_outcome(data, registry_outcome("Fatigue"), "ethical", reserved_numbers=[1], count=False)
+    assert answer == {"match_number": -1, "has_changed": False}
+
+
+def test_ambiguous_pair_is_escalated():
+    data = trial(("Pain at rest", None), ("Pain at night", None))
+    assert prematch_outcome(data, registry_outcome("Pain"), "ethical", count=False) is None
+
+
+def test_stats_are_only_counted_when_asked():
+    before = dict(prematch.stats)
+    data = trial(("Serum creatinine", None))
+    prematch_outcome(data, registry_outcome("Fatigue severity"), "ethical", count=False)
+    assert prematch.stats == before
+    prematch_outcome(data, registry_outcome("Fatigue severity"), "ethical")
+    assert prematch.stats["non_matches"] == before["non_matches"] + 1
@@ -0,0 +1,91 @@
+import asyncio
+
+import rate_limit
+from rate_limit import RateLimiter, TokenBucket
+
+
+class Clock:
+    """
+    Stands in for time.monotonic and time.sleep, sleeping advances the clock.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def fake_clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(rate_limit.time, "sleep", clock.sleep)
+    return clock
+
+
+def test_bucket_hands_out_its_capacity_without_waiting(monkeypatch):
+    fake_clock(monkeypatch)
+    bucket = TokenBucket(10, 1)
+    assert bucket.acquire(4) == 0
+    assert bucket.acquire(6) == 0
+
+
+def test_bucket_waits_for_the_refill(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    bucket = TokenBucket(10, 2)
+    bucket.acquire(10)
+    start = clock.now
+    assert bucket.acquire(4) == 2
+    assert clock.now - start == 2
+
+
+def test_bucket_caps_requests_larger_than_its_capacity(monkeypatch):
+    fake_clock(monkeypatch)
+    bucket = TokenBucket(10, 1)
+    assert bucket.acquire(50) == 0
+
+
+def test_bucket_never_refills_above_its_capacity(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    bucket = TokenBucket(10, 1)
+    clock.sleep(100)
+    bucket.acquire(10)
+    assert bucket._take(1) == 1
+
+
+def test_drain_empties_the_bucket(monkeypatch):
+    fake_clock(monkeypatch)
+    bucket = TokenBucket(10, 5)
+    bucket.drain()
+    assert bucket.acquire(5) == 1
+
+
+def test_limiter_waits_for_both_budgets(monkeypatch):
+    fake_clock(monkeypatch)
+    limiter = RateLimiter(rpm=60, tpm=600)
+    assert limiter.acquire(600) == 0
+    # One request per second is fine, but the next 600 tokens take a minute to refill
+    assert limiter.acquire(600) == 60
+
+
+def test_acquire_async(monkeypatch):
+    fake_clock(monkeypatch)
+    waits = []
+
+    async def sleep(seconds):
+        waits.append(seconds)
+        rate_limit.time.sleep(seconds)
+
+    monkeypatch.setattr(rate_limit.asyncio, "sleep", sleep)
+    bucket = TokenBucket(10, 10)
+    bucket.drain()
+    assert asyncio.run(bucket.acquire_async(5)) == 0.5
+    assert waits == [0.5]
+
+
+def test_limiters_are_shared_per_model():
+    assert rate_limit.get_rate_limiter("test-model") is rate_limit.get_rate_limiter("test-model")
+    assert rate_limit.get_rate_limiter("test-model") is not rate_limit.get_rate_limiter("other-test-model")
@@ -0,0 +1,39 @@
+import json
+import zipfile
+
+import pytest
+
+from registry_dump import has_index, indexed, ingest, lookup
+
+
+@pytest.fixture
+def index(tmp_path):
+    archive_path = tmp_path / "ctg-studies.json.zip"
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        archive.writestr("ctg-studies/NCT00000001.json", json.dumps({"id": "NCT00000001"}), compress_type=zipfile.ZIP_DEFLATED)
+        archive.writestr("ctg-studies/NCT00000002.json", json.dumps({"id": "NCT00000002"}), compress_type=zipfile.ZIP_STORED)
+        archive.writestr("ctg-studies/README.txt", "not a study")
+    index_path = str(tmp_path / "registry_index.sqlite")
+    assert ingest(str(archive_path), index_path) == 2
+    return index_path
+
+
+def test_lookup_reads_deflated_and_stored_studies(index):
+    assert lookup("NCT00000001", index) == {"id": "NCT00000001"}
+    assert lookup("NCT00000002", index) == {"id": "NCT00000002"}
+
+
+def test_lookup_of_a_study_that_is_not_indexed(index):
+    assert lookup("NCT99999999", index) is None
+
+
+def test_indexed(index):
+    assert indexed(["NCT00000001", "NCT99999999"], index) == {"NCT00000001"}
+    assert indexed([], index) == set()
+
+
+def test_without_an_index(tmp_path):
+    missing = str(tmp_path / "missing.sqlite")
+    assert not has_index(missing)
+    assert lookup("NCT00000001", missing) is None
+    assert indexed(["NCT00000001"], missing) == set()
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+import router
+from router import ROUTER_BREAKER_COOLDOWN, ROUTER_BREAKER_FAILURES, ModelStats, Router
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(router.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def open_circuit(stats):
+    for _ in range(ROUTER_BREAKER_FAILURES):
+        stats.record(100, 1, False)
+
+
+def test_failures_open_the_circuit(clock):
+    stats = ModelStats("gpt-4o")
+    open_circuit(stats)
+    assert not stats.available()
+    clock.now += ROUTER_BREAKER_COOLDOWN
+    assert stats.available()
+
+
+def test_available_has_no_side_effect(clock):
+    stats = ModelStats("gpt-4o")
+    open_circuit(stats)
+    clock.now += ROUTER_BREAKER_COOLDOWN
+    assert stats.available()
+    assert stats.available()
+    assert stats.probe_at == 0
+
+
+def test_a_single_probe_after_the_cooldown(clock):
+    stats = ModelStats("gpt-4o")
+    open_circuit(stats)
+    clock.now += ROUTER_BREAKER_COOLDOWN
+    assert stats.sent()
+    assert not stats.available()
+    assert not stats.sent()
+
+
+def test_a_successful_probe_closes_the_circuit(clock):
+    stats = ModelStats("gpt-4o")
+    open_circuit(stats)
+    clock.now += ROUTER_BREAKER_COOLDOWN
+    stats.sent()
+    stats.record(100, 1, True)
+    assert stats.available()
+    assert not stats.sent()
+
+
+def test_a_failed_probe_reopens_the_circuit(clock):
+    stats = ModelStats("gpt-4o")
+    open_circuit(stats)
+    clock.now += ROUTER_BREAKER_COOLDOWN
+    stats.sent()
+    stats.record(100, 1, False)
+    assert not stats.available()
+    clock.now += ROUTER_BREAKER_COOLDOWN
+    assert stats.available()
+
+
+def test_plan_ranks_by_score(clock):
+    planner = Router()
+    for _ in range(10):
+        planner.record("llama3", 100, 0.5, True)
+        planner.record("gpt-4o", 100, 30, True)
+    assert planner.plan(["gpt-4o", "llama3"], 100) == ["llama3", "gpt-4o"]
+
+
+def test_plan_keeps_a_pinned_model_first(clock):
+    planner = Router()
+    for _ in range(10):
+        planner.record("llama3", 100, 0.5, True)
+        planner.record("gpt-4o", 100, 30, True)
+    assert planner.plan(["gpt-4o", "llama3"], 100, pinned=True) == ["gpt-4o", "llama3"]
+
+
+def test_plan_skips_open_circuits_unless_all_are_open(clock):
+    planner = Router()
+    open_circuit(planner._stats("llama3"))
+    assert planner.plan(["llama3", "gpt-4o"], 100) == ["gpt-4o"]
+    open_circuit(planner._stats("gpt-4o"))
+    assert planner.plan(["llama3", "gpt-4o"], 100) == ["gpt-4o"]
+
+
+def test_run_falls_back_to_the_next_model(clock):
+    planner = Router()
+
+    def call(model):
+        if model == "llama3":
+            raise ValueError("down")
+        return f"answer of {model}"
+
+    assert planner.run(["llama3", "gpt-4o"], 100, call, hedge=False) == "answer of gpt-4o"
+    assert planner._stats("llama3").consecutive_failures == 1
+
+
+def test_run_raises_when_every_model_fails(clock):
+    def call(model):
+        raise ValueError(model)
+
+    with pytest.raises(ValueError):
+        Router().run(["llama3", "gpt-4o"], 100, call, hedge=False)
+
+
+def test_run_async_falls_back_to_the_next_model(clock):
+    planner = Router()
+
+    async def call(model):
+        return None if model == "llama3" else f"answer of {model}"
+
+    assert asyncio.run(planner.run_async(["llama3", "gpt-4o"], 100, call, hedge=False)) == "answer of gpt-4o"
@@ -0,0 +1,75 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from state import atomic_write, pid_alive, read_json, update_json, write_json
+
+
+def test_write_and_read_json(tmp_path):
+    path = str(tmp_path / "state.json")
+    write_json(path, {"a": 1})
+    assert read_json(path) == {"a": 1}
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_read_json_default(tmp_path):
+    path = str(tmp_path / "state.json")
+    with pytest.raises(FileNotFoundError):
+        read_json(path)
+    default = {"runs": {}}
+    assert read_json(path, default) == default
+    assert read_json(path, default) is not default
+    open(path, "w").close()
+    assert read_json(path, default) == default
+
+
+def test_failed_write_keeps_the_old_content(tmp_path):
+    path = str(tmp_path / "state.json")
+    write_json(path, {"a": 1})
+
+    def write(file):
+        file.write("{")
+        raise ValueError("interrupted")
+
+    with pytest.raises(ValueError):
+        atomic_write(path, write)
+    assert read_json(path) == {"a": 1}
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_concurrent_updates_are_not_lost(tmp_path):
+    path = str(tmp_path / "state.json")
+
+    def add(i):
+        with update_json(path, {"items": []}) as data:
+            data["items"].append(i)
+
+    threads = [threading.Thread(target=add, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(path) as file:
+        assert sorted(json.load(file)["items"]) == list(range(20))
+
+
+def test_failed_update_is_not_written(tmp_path):
+    path = str(tmp_path / "state.json")
+    write_json(path, {"a": 1})
+    with pytest.raises(KeyError):
+        with update_json(path) as data:
+            data["a"] = 2
+            raise KeyError("b")
+    assert read_json(path) == {"a": 1}
+
+
+def test_pid_alive():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    assert pid_alive(os.getpid())
+    assert not pid_alive(process.pid)
+    assert not pid_alive(None)
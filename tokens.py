@@ -0,0 +1,46 @@
+import functools
+
+import tiktoken
+from decouple import config
+
+DEFAULT_ENCODING = "cl100k_base"
+# Threads tiktoken uses to encode a batch of texts
+TOKEN_THREADS = config("TOKEN_THREADS", default=8, cast=int)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name=DEFAULT_ENCODING):
+    return tiktoken.get_encoding(encoding_name)
+
+
+def encode(text, encoding_name=DEFAULT_ENCODING):
+    # Special token strings in registry texts are counted as plain text instead of raising
+    return get_encoding(encoding_name).encode(text, disallowed_special=())
+
+
+def count_tokens(text, encoding_name=DEFAULT_ENCODING):
+    return len(encode(text, encoding_name))
+
+
+def count_tokens_batch(texts, encoding_name=DEFAULT_ENCODING, num_threads=TOKEN_THREADS):
+    """
+    Count the tokens of many texts with one encode_batch call, which encodes them on several threads.
+
+    :param texts: list, the texts
+    :return: list, the token counts in the order of the texts
+    """
+    return [len(ids) for ids in get_encoding(encoding_name).encode_batch(list(texts), num_threads=num_threads, disallowed_special=())]
+
+
+def truncate_to_tokens(text, max_tokens, encoding_name=DEFAULT_ENCODING):
+    """
+    Cut a text to its first max_tokens tokens. The text is encoded once and the token ids are sliced.
+
+    :param text: str, the text
+    :param max_tokens: int, the token limit
+    :return: tuple, the truncated text and its token count before truncation
+    """
+    ids = encode(text, encoding_name)
+    if len(ids) <= max_tokens:
+        return text, len(ids)
+    return get_encoding(encoding_name).decode(ids[:max_tokens]), len(ids)
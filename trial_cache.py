@@ -0,0 +1,109 @@
+import gzip
+import json
+import os
+import time
+
+from decouple import config
+
+from state import atomic_write
+
+TRIALS_DIR = "trials"
+# Plain JSON copies of the cached records, for the consumers of pro_results.json
+EXPORT_DIR = "trials_json"
+# Seconds a cached trial record is considered current, 0 always refetches
+TRIAL_CACHE_TTL = config("TRIAL_CACHE_TTL", default=7 * 24 * 3600, cast=int)
+# "ttl" trusts the cache for TRIAL_CACHE_TTL seconds, "last_update" asks the registry for the last update dates
+TRIAL_CACHE_POLICY = config("TRIAL_CACHE_POLICY", default="ttl")
+
+
+def trial_path(nct_id):
+    return f"{TRIALS_DIR}/trial_{nct_id}.json.gz"
+
+
+def legacy_trial_path(nct_id):
+    return f"{TRIALS_DIR}/trial_{nct_id}.json"
+
+
+def save_trial(nct_id, record):
+    """
+    Store a study record as compressed compact JSON.
+
+    :param nct_id: str, the NCT id of the study
+    :param record: dict, the study record
+    """
+    os.makedirs(TRIALS_DIR, exist_ok=True)
+
+    def write(file):
+        with gzip.open(file, "wt", compresslevel=6) as f:
+            json.dump(record, f, separators=(",", ":"))
+    atomic_write(trial_path(nct_id), write, mode="wb")
+    if os.path.exists(legacy_trial_path(nct_id)):
+        os.remove(legacy_trial_path(nct_id))
+
+
+def load_trial(nct_id, migrate=True):
+    """
+    Load a cached study record. Records stored by older runs as pretty JSON are compressed on the way.
+
+    :param nct_id: str, the NCT id of the study
+    :param migrate: bool, compress a record stored by older runs, False leaves the cache untouched
+    :return: dict|None, the study record or None if it is not cached
+    """
+    try:
+        with gzip.open(trial_path(nct_id), "rt") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    try:
+        with open(legacy_trial_path(nct_id), "r") as f:
+            record = json.load(f)
+    except FileNotFoundError:
+        return None
+    if not migrate:
+        return record
+    # Keep the original fetch time so that the TTL still applies to migrated records
+    fetched_at = os.path.getmtime(legacy_trial_path(nct_id))
+    save_trial(nct_id, record)
+    os.utime(trial_path(nct_id), (fetched_at, fetched_at))
+    return record
+
+
+def export_trial(path):
+    """
+    Write a plain JSON copy of a compressed study record, unless an up to date one exists.
+
+    :param path: str, the path of the cached record, e.g. the study_data_path of a trial
+    :return: str, the path of the copy, or path itself if it is not a compressed record
+    """
+    if not path or not path.endswith(".gz") or not os.path.exists(path):
+        return path
+    export_path = os.path.join(EXPORT_DIR, os.path.basename(path)[:-len(".gz")])
+    if not os.path.exists(export_path) or os.path.getmtime(export_path) < os.path.getmtime(path):
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        with gzip.open(path, "rt") as f:
+            record = json.load(f)
+        atomic_write(export_path, lambda file: json.dump(record, file, indent=4))
+    return export_path
+
+
+def cached_at(nct_id):
+    for path in (trial_path(nct_id), legacy_trial_path(nct_id)):
+        if os.path.exists(path):
+            return os.path.getmtime(path)
+    return None
+
+
+def is_fresh(nct_id, ttl=TRIAL_CACHE_TTL):
+    fetched_at = cached_at(nct_id)
+    return fetched_at is not None and time.time() - fetched_at < ttl
+
+
+def last_update(record):
+    """
+    Return the last update post date of a study record, e.g. "2024-05-21".
+
+    :param record: dict, the study record
+    :return: str|None, the date or None if the record does not have one
+    """
+    status = record.get("protocolSection", {}).get("statusModule", {})
+    return status.get("lastUpdatePostDateStruct", {}).get("date")
@@ -0,0 +1,158 @@
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from decouple import config
+
+from state import RUN_ID, file_lock, read_json, write_json
+
+RUN_DETAILS = 'run_details.json'
+# Seconds between writes of the accumulated usage to run_details.json
+USAGE_FLUSH_INTERVAL = config("USAGE_FLUSH_INTERVAL", default=30, cast=float)
+
+# Dollars per million prompt and completion tokens
+PRICING = {
+    'gpt-4o': (5.00, 15.00),
+    'gpt-4-turbo-preview': (10.00, 30.00),
+    'gpt-4': (30.00, 60.00),
+    'gpt-3.5-turbo-0125': (0.50, 1.50),
+    'llama3': (0.65, 2.75),
+    'gemini-pro': (0.50, 1.50),
+}
+DEFAULT_PRICE = (10.00, 30.00)
+BREAKDOWNS = ("model", "stage", "trial")
+
+_context = contextvars.ContextVar("usage_context", default={})
+
+
+def price(model):
+    return PRICING.get(model, DEFAULT_PRICE)
+
+
+def request_cost(usage, model, price_factor=1.0):
+    prompt_price, completion_price = price(model)
+    return (usage.prompt_tokens * prompt_price + usage.completion_tokens * completion_price) / 1000000 * price_factor
+
+
+@contextmanager
+def usage_context(stage=None, trial=None):
+    """
+    Attribute the usage of the requests made inside the block to a pipeline stage and a trial. Nested blocks
+    only override what they set. Worker threads need contextvars.copy_context() to inherit it.
+    """
+    current = _context.get()
+    token = _context.set({
+        "stage": stage if stage is not None else current.get("stage"),
+        "trial": trial if trial is not None else current.get("trial"),
+    })
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def current_context():
+    return _context.get()
+
+
+def _counters():
+    return {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cost": 0.0}
+
+
+def _add_counters(counters, other):
+    for key, value in other.items():
+        counters[key] = counters.get(key, 0) + value
+
+
+class UsageAccumulator:
+    """
+    Sums the token usage and cost of the requests in memory and merges it into run_details.json every
+    USAGE_FLUSH_INTERVAL seconds. Every process keeps its own sums and merges them under a file lock, so
+    concurrent processes do not overwrite each other.
+    """
+
+    def __init__(self, path=RUN_DETAILS, flush_interval=USAGE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._reset()
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flushed_at = time.monotonic()
+        self.timer = None
+
+    def _flush_periodically(self):
+        # add() only flushes when a request ends, this flushes the usage left pending before a long wait, e.g.
+        # while polling a batch
+        while True:
+            time.sleep(self.flush_interval)
+            if self.pending and time.monotonic() - self.flushed_at >= self.flush_interval:
+                self.flush()
+
+    def add(self, usage, model, project='default', price_factor=1.0, stage=None, trial=None):
+        context = current_context()
+        keys = {"model": model, "stage": stage or context.get("stage"), "trial": trial or context.get("trial")}
+        delta = {
+            "requests": 1,
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens,
+            "cost": request_cost(usage, model, price_factor),
+        }
+        with self.lock:
+            pending = self.pending.setdefault(project, {"totals": _counters(), **{b: {} for b in BREAKDOWNS}})
+            _add_counters(pending["totals"], delta)
+            for breakdown, key in keys.items():
+                if key is not None:
+                    _add_counters(pending[breakdown].setdefault(str(key), _counters()), delta)
+            due = time.monotonic() - self.flushed_at >= self.flush_interval
+            if self.timer is None:
+                self.timer = threading.Thread(target=self._flush_periodically, name="usage-flush", daemon=True)
+                self.timer.start()
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Merge the usage accumulated since the last flush into run_details.json.
+
+        :return: bool, False if run_details.json could not be read, the usage is then dropped like before
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flushed_at = time.monotonic()
+        if not pending:
+            return True
+        with file_lock(self.path):
+            try:
+                data = read_json(self.path)
+            except (FileNotFoundError, json.JSONDecodeError):
+                print("Please call start_run() if you want get up to date cost analysis.")
+                return False
+            for project, usage in pending.items():
+                details = data.setdefault(project, {})
+                totals = usage["totals"]
+                for key in ("total_tokens", "prompt_tokens", "completion_tokens"):
+                    details[key] = details.get(key, 0) + totals[key]
+                details["total_cost"] = details.get("total_cost", 0) + totals["cost"]
+                # Each run accounts its own cost, concurrent runs of the project do not reset each other's
+                run = details.setdefault("runs", {}).setdefault(RUN_ID, {"pid": os.getpid()})
+                run["current_run_cost"] = run.get("current_run_cost", 0) + totals["cost"]
+                run_usage = run.setdefault("current_run_usage", {})
+                for breakdown in BREAKDOWNS:
+                    merged = run_usage.setdefault(breakdown, {})
+                    for key, counters in usage[breakdown].items():
+                        _add_counters(merged.setdefault(key, _counters()), counters)
+            write_json(self.path, data)
+        return True
+
+
+accumulator = UsageAccumulator()
+# A forked worker starts with empty sums, the parent flushes what it had accumulated
+os.register_at_fork(after_in_child=accumulator._reset)
+atexit.register(accumulator.flush)
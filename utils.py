@@ -1,25 +1,94 @@
+import asyncio
 import os
-import random
-import time
 from decouple import config
 from fp.fp import FreeProxy
-import requests
+import httpx
 import json
 import replicate
-import tiktoken
-from openai import OpenAI
+from clients import (
+    drop_async_http_client, drop_http_client, get_async_http_client, get_async_openai_client, get_http_client,
+    get_openai_client, get_replicate_client,
+)
+import tokens as token_utils
+from openai import RateLimitError
 import re
-import threading
+import weakref
+from rate_limit import get_rate_limiter
+from routing import estimate_prompt_difficulty
+from router import router
+from retry import get_retry_policy
+from state import RUN_ID, file_lock, pid_alive, read_json, update_json, write_json
+from usage import RUN_DETAILS, accumulator, usage_context
+from llm_cache import LLM_CACHE, LLM_CACHE_BYPASS_STAGES, cache_key, cache_report, delete_cached_response, get_cached_response, put_cached_response
 
 DEBUG = False
 
+OPENAI_SAMPLING = {"temperature": 0.6, "top_p": 1, "frequency_penalty": 0, "presence_penalty": 0}
+LLAMA3_SAMPLING = {"top_p": 0.95, "temperature": 0.7, "presence_penalty": 0, "max_tokens": 2048}
+# Completion tokens reserved from the tokens-per-minute budget for every request
+COMPLETION_TOKENS_ESTIMATE = 300
+MODELS = ('gemini-pro', 'llama3', 'gpt-3.5-turbo-0125', 'gpt-4o')
+# Requests in flight at once per event loop in the async API
+ASYNC_CONCURRENCY = config("ASYNC_CONCURRENCY", default=64, cast=int)
+
+_semaphores = weakref.WeakKeyDictionary()
+
 
 def parse_json_from_file(filename):
     with open(filename, 'r') as file:
         return json.load(file)
     
 
-def ask_ai(content, system_role=None, model=False, json_mode=False):
+def usable(response, validate=None):
+    """
+    :param response: str, a response of a model
+    :param validate: callable, takes the response and returns whether the caller can use it, may raise instead
+    :return: bool
+    """
+    if not response:
+        return False
+    if validate is None:
+        return True
+    try:
+        return bool(validate(response))
+    except Exception:
+        return False
+
+
+def ask_ai(content, system_role=None, model=False, json_mode=False, cache=LLM_CACHE, stage=None, trial=None, validate=None):
+    """
+    Ask a language model, reusing the cached response of an identical earlier request.
+
+    :param content: str, the prompt
+    :param system_role: str, the system prompt
+    :param model: str|bool, the model to ask or False to choose one based on the prompt
+    :param json_mode: bool, whether the response must be a JSON object
+    :param cache: bool|str, False bypasses the response cache, "refresh" asks the model but stores the new response
+    :param stage: str, the pipeline stage of the prompt, e.g. "extract_pros"
+    :param trial: str, the trial the prompt is about, for the usage breakdown
+    :param validate: callable, see usable(); responses it rejects are not cached, so that the next run asks again
+    :return: str, the response
+    """
+    with usage_context(stage=stage, trial=trial):
+        if not cache:
+            return _ask_ai(content, system_role, model, json_mode)
+        key = cache_key(model or "auto", system_role, content, json_mode, sampling_params(model))
+        if cache != "refresh" and stage not in LLM_CACHE_BYPASS_STAGES:
+            response = get_cached_response(key)
+            if usable(response, validate):
+                say(f"Cached answer of {model or 'auto'}: {content[:150]}...")
+                return response
+            if response is not None:
+                # Cached before the answers were validated
+                delete_cached_response(key)
+        response = _ask_ai(content, system_role, model, json_mode)
+        if usable(response, validate):
+            put_cached_response(key, response, model or "auto", stage)
+        return response
+
+
+def _ask_ai(content, system_role=None, model=False, json_mode=False):
+    pinned = bool(model)
     if not model:
         model, tokens, difficulty = choose_model(content, json_mode)
     else:
@@ -28,37 +97,43 @@ def ask_ai(content, system_role=None, model=False, json_mode=False):
     if tokens > 100000 or (tokens > 10000 and DEBUG):
         if prompt(f"The prompt length is {tokens} tokens. Would you like to shorten it to 8k tokens?", default=True):
             content = trucate_to_tokens(content, 8000)
-            tokens = count_tokens(content)
+            tokens = min(tokens, 8000)
     say(f"Asking {model}: {content[:150]}... [{tokens} tokens, {difficulty}]")
+    if model not in MODELS:
+        return False
+    # gpt-4o backs up every other model, the router orders them, unless the caller asked for a model, and skips failing providers
+    models = router.plan([model, 'gpt-4o'], tokens, pinned)
+    response = router.run(models, tokens, lambda m: query_model(m, content, system_role, json_mode, tokens))
+    if response:
+        return response
+    raise Exception("Failed to get a response from OpenAI API")
+
+
+def query_model(model, content, system_role=None, json_mode=False, tokens=None):
     if model == 'gemini-pro':
-        gemini_response = query_gemini(content, system_role)
-        if gemini_response:
-            return gemini_response
-        return ask_ai(content, system_role, 'gpt-4o')
-    elif model == 'llama3':
-        llama3_response = query_llama3(content, system_role)
-        if llama3_response:
-            return llama3_response
-        return ask_ai(content, system_role, 'gpt-4o')
-    elif model == 'gpt-3.5-turbo-0125':
-        openai_response = query_openai(content, system_role, 'gpt-3.5-turbo-0125', json_mode)
-        if openai_response:
-            return openai_response
-        return ask_ai(content, system_role, 'gpt-4o')
-    elif model == 'gpt-4o':
-        openai_response = query_openai(content, system_role, 'gpt-4o', json_mode)
-        if openai_response:
-            return openai_response
-        raise Exception("Failed to get a response from OpenAI API")
-    
-    return False
+        return query_gemini(content, system_role)
+    if model == 'llama3':
+        return query_llama3(content, system_role)
+    return query_openai(content, system_role, model, json_mode, tokens)
+
+
+def sampling_params(model=False):
+    """
+    Return the sampling parameters a request to the model is sent with.
+
+    :param model: str|bool, the model or False when the model is chosen per prompt
+    :return: dict, the sampling parameters
+    """
+    if model == 'llama3':
+        return LLAMA3_SAMPLING
+    if model in ('gpt-3.5-turbo-0125', 'gpt-4o'):
+        return OPENAI_SAMPLING
+    return {"openai": OPENAI_SAMPLING, "llama3": LLAMA3_SAMPLING}
 
 
 def count_tokens(string: str, encoding_name="cl100k_base") -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return token_utils.count_tokens(string, encoding_name)
 
 
 def choose_model(content, json_mode=False):
@@ -66,8 +141,6 @@ def choose_model(content, json_mode=False):
     prompt_start = " ".join(content.split(" ")[:200])
     difficulty = estimate_prompt_difficulty(prompt_start)
 
-    if not difficulty:
-        return 'llama3', tokens, difficulty
     if difficulty == "easy":
         if tokens < 8000 and not json_mode:
             model = 'llama3'
@@ -93,19 +166,6 @@ def choose_model(content, json_mode=False):
     return model, tokens, difficulty
             
 
-def estimate_prompt_difficulty(prompt, tries=0):
-    response = query_openai(prompt, "Please estimate the difficulty and complexity grade of the following prompt. If the prompt is too long, you will only receive the beginning. Only provide a JSON string with the following keys: 'difficulty' enumerating options (easy, moderate, hard)", model='gpt-3.5-turbo-0125', json_mode=True)
-    try:
-        response = json.loads(response)
-    except:
-        response = False
-    if response and response.get("difficulty") in ["easy", "moderate", "hard"]:
-        return response.get("difficulty")
-    if tries > 3:
-        return False
-    return estimate_prompt_difficulty(prompt, tries+1)
-
-
 def query_gemini(content, system_role=None):
     # Load the last working proxy from the json file
     try:
@@ -122,35 +182,35 @@ def query_gemini(content, system_role=None):
         proxy = FreeProxy(country_id=['US'], https=True).get()
 
     # Save the current proxy to the json file
-    with open('last_proxy.json', 'w') as file:
-        json.dump(proxy, file)
+    write_json('last_proxy.json', proxy)
 
     if system_role:
         prompt = f"Role description: {system_role}\n\nPrompt:\n{content}"
     else:
         prompt = content
-    response = False
-    for i in range(3):
-        proxies = {
-            'https': str(proxy)
-        }
-        url = f'https://generativelanguage.googleapis.com/v1/models/gemini-pro:generateContent?key={config("GEMINI_API_KEY")}'
-        data = {"contents": [{"parts": [{"text": prompt}]}]}
-        try:
-            response = requests.post(url, proxies=proxies, json=data, timeout=10)
-            # print(response.text)
-            if not response.status_code == 200:
-                raise Exception("Failed to send request due to status code", response.status_code)
-            with open('last_proxy.json', 'w') as file:
-                json.dump(proxy, file)
-            break
-        except requests.exceptions.HTTPError as e:
-            if response.status_code == 429:
-                time.sleep(random.random()*5)
-        except Exception as e:
-            say("Failed to send request due to the following error:", e)
+    url = f'https://generativelanguage.googleapis.com/v1/models/gemini-pro:generateContent?key={config("GEMINI_API_KEY")}'
+    data = {"contents": [{"parts": [{"text": prompt}]}]}
+
+    def send():
+        response = get_http_client("gemini", proxy=str(proxy)).post(url, json=data, timeout=10)
+        response.raise_for_status()
+        return response
+
+    def on_retry(e, wait):
+        nonlocal proxy
+        say("Failed to send request due to the following error:", e)
+        # Throttling is waited out, any other failure is blamed on the proxy
+        if not isinstance(e, httpx.HTTPStatusError):
+            drop_http_client("gemini", proxy=str(proxy))
             proxy = FreeProxy(country_id=['US'], https=True).get()
-    
+
+    try:
+        response = get_retry_policy("gemini").call(send, on_retry=on_retry)
+        write_json('last_proxy.json', proxy)
+    except Exception as e:
+        say("Failed to send request due to the following error:", e)
+        response = False
+
     if response:
         try:
             return response.json()["candidates"][0]["content"]["parts"][0]["text"]
@@ -164,43 +224,32 @@ def query_gemini(content, system_role=None):
 def query_llama3(content, system_role):
     if system_role is None:
         system_role = "You are a helpful assistant."
-    os.environ["REPLICATE_API_TOKEN"] = config('REPLICATE_API_KEY')
     prompt = {
-        "top_p": 0.95,
         "prompt": content,
         "system_prompt": system_role,
-        "temperature": 0.7,
         "prompt_template": "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{system_prompt}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n",
-        "presence_penalty": 0,
-        "max_tokens": 2048,
+        **LLAMA3_SAMPLING,
     }
     output = False
     try:
-        output = replicate.run(
+        output = get_retry_policy("replicate").call(
+            get_replicate_client().run,
             "meta/meta-llama-3-70b-instruct",
             input=prompt
         )
     except replicate.exceptions.ModelError as e:
-        if "please retry" in str(e):
-            output = replicate.run(
-                "meta/meta-llama-3-70b-instruct",
-                input=prompt
-            )
+        say(f"Llama 3 failed: {e}")
     if output:
         return "".join(output)
     return output
 
 
-def query_openai(content, system_role, model='gpt-4o', json_mode=False):
+def query_openai(content, system_role, model='gpt-4o', json_mode=False, tokens=None):
     if system_role is None:
         system_role = "You are a helpful assistant."
 
-    ai_client = OpenAI(
-        organization='org-OjCSzLcscYwYrWwsc7EWJZs7',
-        project='proj_LL7UZDSKgr42Lp0P7QnO30i1',
-        api_key=config('OPENAI_API_KEY')
-    )
-    
+    ai_client = get_openai_client()
+
     messages = [
         {
             "role": "system",
@@ -212,17 +261,38 @@ def query_openai(content, system_role, model='gpt-4o', json_mode=False):
         },
     ]
 
+    limiter = get_rate_limiter(model)
+    # The prompt tokens are passed in when the caller already counted them
+    if tokens is None:
+        tokens = count_tokens(content)
+    reserved = count_tokens(system_role) + tokens + COMPLETION_TOKENS_ESTIMATE
+
+    def create(**kwargs):
+        # Every attempt goes through the rate limiter, retries after a 429 included
+        waited = limiter.acquire(reserved)
+        if waited:
+            say(f"Waited {waited:.1f} s for the {model} rate limit")
+        return ai_client.chat.completions.create(**kwargs)
+
+    def on_retry(e, wait):
+        if isinstance(e, RateLimitError):
+            limiter.drain()
+        say(f"Retrying {model} in {wait:.1f} s after: {e}")
+
     try:
-        response = ai_client.chat.completions.create(
+        response = get_retry_policy("openai").call(
+            create,
             model=model,
             messages=messages,
-            temperature=0.6,
             response_format={ "type": "json_object" } if json_mode else { "type": "text" },
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
+            on_retry=on_retry,
+            **OPENAI_SAMPLING
         )
 
+    except RateLimitError as e:
+        limiter.drain()
+        say(f"Rate limited by OpenAI API: {e}")
+        return None
     except Exception as e:
         say(f"Error querying OpenAI API: {e}")
         return None
@@ -235,13 +305,208 @@ def query_openai(content, system_role, model='gpt-4o', json_mode=False):
         return None
 
 
+def _async_semaphore():
+    # asyncio primitives belong to one event loop, every loop gets its own cap
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    return _semaphores[loop]
+
+
+async def ask_ai_async(content, system_role=None, model=False, json_mode=False, cache=LLM_CACHE, stage=None, trial=None, validate=None):
+    """
+    Async counterpart of ask_ai(). At most ASYNC_CONCURRENCY requests of the event loop wait on a model at once,
+    the rest queue on a semaphore. Cancelling the task cancels the request in flight.
+
+    :return: str, the response
+    """
+    with usage_context(stage=stage, trial=trial):
+        if not cache:
+            async with _async_semaphore():
+                return await _ask_ai_async(content, system_role, model, json_mode)
+        key = cache_key(model or "auto", system_role, content, json_mode, sampling_params(model))
+        if cache != "refresh" and stage not in LLM_CACHE_BYPASS_STAGES:
+            response = await asyncio.to_thread(get_cached_response, key)
+            if usable(response, validate):
+                say(f"Cached answer of {model or 'auto'}: {content[:150]}...")
+                return response
+            if response is not None:
+                await asyncio.to_thread(delete_cached_response, key)
+        async with _async_semaphore():
+            response = await _ask_ai_async(content, system_role, model, json_mode)
+        if usable(response, validate):
+            await asyncio.to_thread(put_cached_response, key, response, model or "auto", stage)
+        return response
+
+
+async def _ask_ai_async(content, system_role=None, model=False, json_mode=False):
+    pinned = bool(model)
+    if not model:
+        model, tokens, difficulty = choose_model(content, json_mode)
+    else:
+        tokens = count_tokens(content)
+        difficulty = None
+    if tokens > 100000 or (tokens > 10000 and DEBUG):
+        if await asyncio.to_thread(prompt, f"The prompt length is {tokens} tokens. Would you like to shorten it to 8k tokens?", True):
+            content = trucate_to_tokens(content, 8000)
+            tokens = min(tokens, 8000)
+    say(f"Asking {model}: {content[:150]}... [{tokens} tokens, {difficulty}]")
+    if model not in MODELS:
+        return False
+    models = router.plan([model, 'gpt-4o'], tokens, pinned)
+    response = await router.run_async(models, tokens, lambda m: query_model_async(m, content, system_role, json_mode, tokens))
+    if response:
+        return response
+    raise Exception("Failed to get a response from OpenAI API")
+
+
+async def query_model_async(model, content, system_role=None, json_mode=False, tokens=None):
+    if model == 'gemini-pro':
+        return await query_gemini_async(content, system_role)
+    if model == 'llama3':
+        return await query_llama3_async(content, system_role)
+    return await query_openai_async(content, system_role, model, json_mode, tokens)
+
+
+async def ask_ai_many(contents, timeout=None, **kwargs):
+    """
+    Ask many prompts concurrently from one event loop.
+
+    :param contents: list, the prompts
+    :param timeout: float, seconds after which the prompts still running are cancelled, None waits for all
+    :param kwargs: further ask_ai_async() arguments shared by all prompts
+    :return: list, the responses in the order of the prompts
+    """
+    tasks = [asyncio.create_task(ask_ai_async(content, **kwargs)) for content in contents]
+    try:
+        return await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+    except BaseException:
+        # One failed prompt, a timeout or the caller's cancellation stops the rest as well
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def query_gemini_async(content, system_role=None):
+    try:
+        last_proxy = await asyncio.to_thread(parse_json_from_file, 'last_proxy.json')
+    except FileNotFoundError:
+        last_proxy = None
+
+    if last_proxy:
+        proxy = last_proxy
+    else:
+        proxy = await asyncio.to_thread(FreeProxy(country_id=['US'], https=True).get)
+
+    if system_role:
+        prompt = f"Role description: {system_role}\n\nPrompt:\n{content}"
+    else:
+        prompt = content
+    url = f'https://generativelanguage.googleapis.com/v1/models/gemini-pro:generateContent?key={config("GEMINI_API_KEY")}'
+    data = {"contents": [{"parts": [{"text": prompt}]}]}
+
+    async def send():
+        response = await get_async_http_client("gemini", proxy=str(proxy)).post(url, json=data, timeout=10)
+        response.raise_for_status()
+        return response
+
+    async def on_retry(e, wait):
+        nonlocal proxy
+        say("Failed to send request due to the following error:", e)
+        if not isinstance(e, httpx.HTTPStatusError):
+            await drop_async_http_client("gemini", proxy=str(proxy))
+            proxy = await asyncio.to_thread(FreeProxy(country_id=['US'], https=True).get)
+
+    try:
+        response = await get_retry_policy("gemini").call_async(send, on_retry=on_retry)
+        write_json('last_proxy.json', proxy)
+    except Exception as e:
+        say("Failed to send request due to the following error:", e)
+        response = False
+
+    if response:
+        try:
+            return response.json()["candidates"][0]["content"]["parts"][0]["text"]
+        except Exception as e:
+            say(response.text)
+            say("Failed to parse response due to the following error:", e)
+            return None
+    return None
+
+
+async def query_llama3_async(content, system_role):
+    if system_role is None:
+        system_role = "You are a helpful assistant."
+    prompt = {
+        "prompt": content,
+        "system_prompt": system_role,
+        "prompt_template": "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n{system_prompt}<|eot_id|><|start_header_id|>user<|end_header_id|>\n\n{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n",
+        **LLAMA3_SAMPLING,
+    }
+    output = False
+    try:
+        output = await get_retry_policy("replicate").call_async(get_replicate_client().async_run, "meta/meta-llama-3-70b-instruct", input=prompt)
+    except replicate.exceptions.ModelError as e:
+        say(f"Llama 3 failed: {e}")
+    # Streaming models return an async iterator of text pieces
+    if hasattr(output, "__aiter__"):
+        output = [piece async for piece in output]
+    if output:
+        return "".join(output)
+    return output
+
+
+async def query_openai_async(content, system_role, model='gpt-4o', json_mode=False, tokens=None):
+    if system_role is None:
+        system_role = "You are a helpful assistant."
+
+    messages = [
+        {"role": "system", "content": system_role},
+        {"role": "user", "content": content},
+    ]
+
+    limiter = get_rate_limiter(model)
+    if tokens is None:
+        tokens = count_tokens(content)
+    reserved = count_tokens(system_role) + tokens + COMPLETION_TOKENS_ESTIMATE
+
+    async def create(**kwargs):
+        waited = await limiter.acquire_async(reserved)
+        if waited:
+            say(f"Waited {waited:.1f} s for the {model} rate limit")
+        return await get_async_openai_client().chat.completions.create(**kwargs)
+
+    def on_retry(e, wait):
+        if isinstance(e, RateLimitError):
+            limiter.drain()
+        say(f"Retrying {model} in {wait:.1f} s after: {e}")
+
+    try:
+        response = await get_retry_policy("openai").call_async(
+            create,
+            model=model,
+            messages=messages,
+            response_format={"type": "json_object"} if json_mode else {"type": "text"},
+            on_retry=on_retry,
+            **OPENAI_SAMPLING
+        )
+    except RateLimitError as e:
+        limiter.drain()
+        say(f"Rate limited by OpenAI API: {e}")
+        return None
+    except Exception as e:
+        say(f"Error querying OpenAI API: {e}")
+        return None
+
+    await asyncio.to_thread(_update_tokens, response.usage, model)
+    return response.choices[0].message.content
+
+
 def trucate_to_tokens(prompt, max_tokens=8000):
-    tokens = count_tokens(prompt)
-    say("Tokens before truncation:", tokens)
-    while tokens > max_tokens:
-        prompt = " ".join(prompt.split(" ")[:int(max_tokens/tokens*len(prompt.split(" ")))-5])
-        tokens = count_tokens(prompt)
-    say("Tokens after truncation:", tokens)
+    prompt, before = token_utils.truncate_to_tokens(prompt, max_tokens)
+    say("Tokens before truncation:", before)
+    say("Tokens after truncation:", min(before, max_tokens))
     return prompt
 
 
@@ -292,10 +557,11 @@ def clean_string(input_string):
 
 
 def cost_report():
-    with open(f'run_details.json', 'r') as file:
-        data = json.load(file)
+    accumulator.flush()
+    data = read_json(RUN_DETAILS).get('default', {})
+    run = data.get("runs", {}).get(RUN_ID, {})
 
-    out = f"The current run has costed {round(data['current_run_cost'], 2)}$ so far while the project costs are {round(data['total_cost'], 2)}$ in total."
+    out = f"The current run has costed {round(run.get('current_run_cost', 0), 2)}$ so far while the project costs are {round(data.get('total_cost', 0), 2)}$ in total."
     print(out)
     return out
 
@@ -367,17 +633,10 @@ def save_question(savefile, question):
     :param savefile: str, the path to the savefile file
     :param profile: tuple, the question
     """
-    # Load existing questions from the savefile file
-    with open(savefile, "r") as file:
-        data = json.load(file)
-
-    # Save the question to the questions list
-    if question[0] not in [q[0] for q in data["questions"]]:
-        data["questions"].append(question)
-
-    # Save the data to the savefile file
-    with open(savefile, "w") as file:
-        json.dump(data, file, indent=4)
+    with update_json(savefile, indent=4) as data:
+        # Save the question to the questions list
+        if question[0] not in [q[0] for q in data["questions"]]:
+            data["questions"].append(question)
 
 def save_profile(savefile, organization_name, profile):
     """
@@ -387,20 +646,10 @@ def save_profile(savefile, organization_name, profile):
     :param organization_name: str, the name of the organization
     :param profile: dict, the organization profile
     """
-    lock = threading.Lock()  # Create a lock object
-
-    with lock:
-        # Load existing profiles from the savefile file
-        with open(savefile, "r") as file:
-            data = json.load(file)
-
+    with update_json(savefile, indent=4) as data:
         # Save the organization profile to the profiles dictionary
         data["profiles"][organization_name] = profile
 
-        # Save the profiles dictionary to the savefile file
-        with open(savefile, "w") as file:
-            json.dump(data, file, indent=4)
-
 def say(*args):
     if DEBUG:
         print(*args)
@@ -408,90 +657,51 @@ def say(*args):
         pass
 
 def start_run(project='default'):
-    with open(f'run_details.json', 'a') as _:
-        pass
-
-    try:
-        with open(f'run_details.json', 'r') as file:
-            data = json.load(file)
-    except:
-        data = {project: {} }
-    
-    if project not in data.keys():
-        data[project] = {}
-    data[project]["current_run_cost"] = 0
+    accumulator.flush()
+    with file_lock(RUN_DETAILS):
+        try:
+            data = read_json(RUN_DETAILS, {})
+        except json.JSONDecodeError:
+            data = {project: {} }
 
-    with open(f'run_details.json', 'w') as file:
-        json.dump(data, file)
+        if project not in data.keys():
+            data[project] = {}
+        runs = data[project].setdefault("runs", {})
+        # Forget the runs whose process died before finish_run()
+        for run_id in [run_id for run_id, run in runs.items() if not pid_alive(run.get("pid"))]:
+            del runs[run_id]
+        runs[RUN_ID] = {"pid": os.getpid(), "current_run_cost": 0, "current_run_usage": {}}
 
+        write_json(RUN_DETAILS, data)
 
-def _update_tokens(usage, model, project='default'):
 
-    try:
-        with open(f'run_details.json', 'r') as file:
-            data = json.load(file)
-    except:
-        print("Please call start_run() if you want get up to date cost analysis.")
-        return
-
-    if "current_run_cost" not in data[project].keys():
-        data[project]["current_run_cost"] = 0
-    if "total_tokens" in data[project].keys():
-        data[project]["total_tokens"] += usage.total_tokens
-    else:
-        data[project]["total_tokens"] = usage.total_tokens
-    if "prompt_tokens" in data[project].keys():
-        data[project]["prompt_tokens"] += usage.prompt_tokens
-    else:
-        data[project]["prompt_tokens"] = usage.prompt_tokens
-    if "completion_tokens" in data[project].keys():
-        data[project]["completion_tokens"] += usage.completion_tokens
-    else:
-        data[project]["completion_tokens"] = usage.completion_tokens
-
-    if "total_cost" not in data[project].keys():
-        data[project]["total_cost"] = 0
-    if model == 'gpt-4-turbo-preview':
-        cost_add = usage.prompt_tokens / 1000000 * 10.00 + usage.completion_tokens / 1000000 * 30.00
-        data[project]["total_cost"] += cost_add
-        data[project]["current_run_cost"] += cost_add
-    elif model == 'gpt-4o':
-        cost_add = usage.prompt_tokens / 1000000 * 5.00 + usage.completion_tokens / 1000000 * 15.00
-        data[project]["total_cost"] += cost_add
-        data[project]["current_run_cost"] += cost_add
-    elif model == 'gpt-4':
-        cost_add = usage.prompt_tokens / 1000000 * 30.00 + usage.completion_tokens / 1000000 * 60.00
-        data[project]["total_cost"] += cost_add
-        data[project]["current_run_cost"] += cost_add
-    else:
-        cost_add = usage.prompt_tokens / 1000000 * 10.00 + usage.completion_tokens / 1000000 * 30.00
-        data[project]["total_cost"] += cost_add
-        data[project]["current_run_cost"] += cost_add
-
-    with open(f'run_details.json', 'w') as file:
-        json.dump(data, file)
+def _update_tokens(usage, model, project='default', price_factor=1.0, stage=None, trial=None):
+    """
+    Account the usage of a response. It is summed in memory and written to run_details.json in batches.
 
+    :param stage: str, the pipeline stage, defaults to the one of the enclosing usage_context()
+    :param trial: str, the trial, defaults to the one of the enclosing usage_context()
+    """
+    accumulator.add(usage, model, project, price_factor, stage, trial)
 
 
 def finish_run(project='default'):
-    with open(f'run_details.json', 'a') as _:
-        pass
-
-    try:
-        with open(f'run_details.json', 'r') as file:
-            data = json.load(file)
-    except:
-        data = {project: {}}
-
-    if "current_run_cost" not in data[project].keys():
-        data[project]["current_run_cost"] = 0
+    accumulator.flush()
+    with file_lock(RUN_DETAILS):
+        try:
+            data = read_json(RUN_DETAILS, {})
+        except json.JSONDecodeError:
+            data = {}
+        if project not in data.keys():
+            data[project] = {}
 
-    if "total_cost" not in data[project].keys():
-        data[project]["total_cost"] = 0
+        run = data[project].setdefault("runs", {}).pop(RUN_ID, {})
 
-    print("The current run has costed", round(data[project]["current_run_cost"], 2), f"$ so far while the project '{project}' costs are", round(data[project]["total_cost"], 2), "$ in total.")
+        if "total_cost" not in data[project].keys():
+            data[project]["total_cost"] = 0
 
-    data[project]["current_run_cost"] = 0
+        print("The current run has costed", round(run.get("current_run_cost", 0), 2), f"$ so far while the project '{project}' costs are", round(data[project]["total_cost"], 2), "$ in total.")
+        cache_report()
+        router.report()
 
-    with open(f'run_details.json', 'w') as file:
-        json.dump(data, file)
\ No newline at end of file
+        write_json(RUN_DETAILS, data)